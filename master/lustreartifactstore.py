@@ -0,0 +1,289 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Content addressed store for the build products published by the master.
+#
+# Every file is stored once under <root>/objects/<sha256[:2]>/<sha256[2:]> and
+# the published paths (public_html/downloads/...) are hard links to those
+# objects. Byte identical RPMs, debs and tarballs from different patchsets and
+# builders therefore share their disk space. Objects are read only, paths are
+# only ever replaced by rename, never written through.
+#
+# When the published paths are removed, for instance by
+# cleanupBuildProducts.sh, an object is left with just the store's link and
+# is deleted by gc.
+#
+# A build's results can be recorded under a key as the objects it published,
+# relative to its change directory. A later build with the same key republishes
+# them under its own change directory instead of building them again. Results
+# whose objects were deleted are dropped by gc.
+#
+# Run this module as a script for gc and usage statistics:
+#
+#   python lustreartifactstore.py gc <root>
+#   python lustreartifactstore.py stats <root>
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+class ArtifactStore(object):
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.results = os.path.join(root, 'results')
+
+    def hash(self, path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def objectPath(self, digest):
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def objectDigest(self, obj):
+        head, tail = os.path.split(obj)
+        return os.path.basename(head) + tail
+
+    def store(self, path):
+        """Adds the file at path to the store, unless an identical one is
+        already there. Returns the object path and True if it was new."""
+        obj = self.objectPath(self.hash(path))
+        if os.path.exists(obj):
+            return obj, False
+
+        if not os.path.isdir(os.path.dirname(obj)):
+            try:
+                os.makedirs(os.path.dirname(obj))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        os.chmod(path, 0o444)
+        try:
+            os.link(path, obj)
+        except OSError as e:
+            # another build stored the same content first
+            if e.errno != errno.EEXIST:
+                raise
+            return obj, False
+
+        return obj, True
+
+    def publish(self, obj, dest):
+        # replace dest atomically, a reader never sees a partial file
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+
+        # rename() between two links to the same object does nothing
+        if os.path.exists(dest) and os.path.samefile(obj, dest):
+            return
+
+        # link() never overwrites, so the unique name cannot be taken over
+        tmp = tempfile.mktemp(prefix=os.path.basename(dest) + '.tmp-',
+                              dir=os.path.dirname(dest))
+        try:
+            os.link(obj, tmp)
+            os.rename(tmp, dest)
+        finally:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+
+    def ingest(self, src, dest=None, published=None):
+        """Stores every file under src (a file or a directory) and publishes
+        it under dest as a link to its object. Without dest the files are
+        replaced in place. src is removed when it differs from dest. If
+        published is a dict, the path of every published file is added to it,
+        mapped to its object.
+
+        Returns a dict of statistics: the number of files, their total bytes,
+        the bytes which were new to the store and the bytes saved by reusing
+        objects already stored."""
+        if dest is None:
+            dest = src
+
+        stats = {'files': 0, 'bytes': 0, 'new_bytes': 0, 'saved_bytes': 0}
+
+        if os.path.isdir(src):
+            paths = []
+            for dirpath, dirnames, filenames in os.walk(src):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    paths.append((path, os.path.join(dest,
+                                  os.path.relpath(path, src))))
+        else:
+            paths = [(src, dest)]
+
+        for path, target in paths:
+            if os.path.islink(path):
+                if path != target:
+                    if not os.path.isdir(os.path.dirname(target)):
+                        os.makedirs(os.path.dirname(target))
+                    if os.path.lexists(target):
+                        os.remove(target)
+                    os.symlink(os.readlink(path), target)
+                continue
+
+            size = os.path.getsize(path)
+            obj, new = self.store(path)
+
+            stats['files'] += 1
+            stats['bytes'] += size
+            if published is not None:
+                published[target] = obj
+            if new:
+                stats['new_bytes'] += size
+            else:
+                stats['saved_bytes'] += size
+
+            if new and path == target:
+                continue
+            self.publish(obj, target)
+
+        if src != dest:
+            if os.path.isdir(src):
+                shutil.rmtree(src)
+            elif os.path.lexists(src):
+                os.remove(src)
+
+        return stats
+
+    def resultPath(self, key):
+        return os.path.join(self.results, key + '.json')
+
+    def saveResult(self, key, base, published, properties=None, source=None):
+        """Records the published files under base, a dict of their paths and
+        objects as filled in by ingest(), as the result for key. properties
+        are returned with the result, source describes where it came from."""
+        files = {}
+        for path, obj in published.items():
+            relpath = os.path.relpath(path, base)
+            if relpath.startswith(os.pardir):
+                continue
+            files[relpath] = self.objectDigest(obj)
+
+        if not os.path.isdir(self.results):
+            try:
+                os.makedirs(self.results)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        path = self.resultPath(key)
+        tmp = "%s.tmp-%d" % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'files': files, 'properties': properties or {},
+                       'source': source}, f, sort_keys=True)
+        os.rename(tmp, path)
+
+    def loadResult(self, key):
+        # the recorded result for key, or None if it is unknown or incomplete
+        try:
+            with open(self.resultPath(key)) as f:
+                result = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        for digest in result['files'].values():
+            if not os.path.exists(self.objectPath(digest)):
+                return None
+
+        return result
+
+    def restoreResult(self, key, base):
+        """Publishes the files recorded for key under base. Returns the
+        result, with the bytes published and a dict of the published paths
+        and their objects added, or None when there is none."""
+        result = self.loadResult(key)
+        if result is None:
+            return None
+
+        result['bytes'] = 0
+        result['published'] = {}
+        for relpath, digest in result['files'].items():
+            obj = self.objectPath(digest)
+            self.publish(obj, os.path.join(base, relpath))
+            result['bytes'] += os.path.getsize(obj)
+            result['published'][os.path.join(base, relpath)] = obj
+
+        return result
+
+    def scan(self):
+        # yields (path, size, links) for every object
+        for dirpath, dirnames, filenames in os.walk(self.objects):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                yield path, st.st_size, st.st_nlink
+
+    def usage(self):
+        """Returns the bytes stored, the bytes published (counting every link
+        except the store's own) and the ratio of the two."""
+        stored = 0
+        published = 0
+        for path, size, links in self.scan():
+            stored += size
+            published += size * (links - 1)
+
+        ratio = float(published) / stored if stored else 1.0
+        return {'stored_bytes': stored, 'published_bytes': published,
+                'dedup_ratio': ratio}
+
+    def gc(self):
+        """Deletes objects no longer published anywhere, returns the number
+        of objects and bytes removed."""
+        removed = 0
+        freed = 0
+        for path, size, links in self.scan():
+            if links == 1:
+                os.remove(path)
+                removed += 1
+                freed += size
+
+        return removed, freed
+
+    def gcResults(self):
+        """Deletes the results of which an object was deleted, returns the
+        number of results removed."""
+        if not os.path.isdir(self.results):
+            return 0
+
+        removed = 0
+        for name in os.listdir(self.results):
+            if name.endswith('.json') and self.loadResult(name[:-5]) is None:
+                os.remove(os.path.join(self.results, name))
+                removed += 1
+
+        return removed
+
+def main(args):
+    if len(args) != 2 or args[0] not in ('gc', 'stats'):
+        sys.stderr.write("usage: lustreartifactstore.py gc|stats <root>\n")
+        return 1
+
+    store = ArtifactStore(args[1])
+    if not os.path.isdir(store.objects):
+        return 0
+
+    if args[0] == 'gc':
+        removed, freed = store.gc()
+        sys.stdout.write("removed %d object(s), %.1f MiB\n" %
+                         (removed, freed / (1024.0 * 1024.0)))
+        sys.stdout.write("removed %d stale result(s)\n" % store.gcResults())
+
+    usage = store.usage()
+    sys.stdout.write("stored %.1f MiB, published %.1f MiB, dedup ratio %.2f\n" %
+                     (usage['stored_bytes'] / (1024.0 * 1024.0),
+                      usage['published_bytes'] / (1024.0 * 1024.0),
+                      usage['dedup_ratio']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
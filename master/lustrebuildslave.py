@@ -1,44 +1,270 @@
 # -*- python -*-
 # ex: set syntax=python:
 
+import json
 import string
 import random
 import re
 from password import *
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.python import log
 from buildbot.plugins import util
-from buildbot.buildslave import BuildSlave
+from buildbot.util import now
+from buildbot.status.results import SUCCESS, WARNINGS
+from buildbot.process.slavebuilder import LATENT, SUBSTANTIATING
+from buildbot.buildslave import BuildSlave, AbstractLatentBuildSlave
 from buildbot.buildslave.ec2 import EC2LatentBuildSlave
+from lustrescheduling import WarmSlavePolicy, CriticalPathPolicy
+from lustrescheduling import DurationEstimate, criticalPath
+from lustrescheduling import InstanceCostPolicy
+from lustreinstances import instance_resources, instanceCandidates
 
 ### BUILDER CLASSES
-class LustreBuilderConfig(util.BuilderConfig):
-    @staticmethod
-    def nextSlave(builder, slaves):
-        availableSlave = None
+class LustreSlaveChooser(object):
+    """Picks the slave for a builder's next build using a selection policy.
+
+    The inputs for each available slave are gathered from the master's objects
+    and handed to the policy (see lustrescheduling). The scores behind every
+    choice are logged. Without an idle slave, one pending request is left for
+    each slave prewarmed for the builder which is still booting. If the policy
+    fails, the error is logged and a random slave is picked, as buildbot does
+    without a nextSlave.
+    """
+
+    # a slave which built the same branch within this many seconds is warm
+    branch_window = 2 * 60 * 60
+
+    # expected seconds for a latent slave to boot until one has been timed
+    substantiate_seconds = 5 * 60
+
+    def __init__(self, policy):
+        self.policy = policy
+
+    @defer.inlineCallbacks
+    def __call__(self, builder, slaves):
+        if not slaves:
+            defer.returnValue(None)
+            return
+
+        # the build request distributor drops a failing nextSlave's error
+        # along with the builds it was to start
+        try:
+            brdicts = yield builder.master.db.buildrequests.getBuildRequests(
+                buildername=builder.name, claimed=False)
+
+            # each slave prewarmed for this builder is booting for one of the
+            # pending requests, leave it that one rather than starting a
+            # second instance and give the others to the available slaves
+            if not [sb for sb in slaves if sb.isIdle()]:
+                prewarming = [sb for sb in builder.slaves
+                              if getattr(sb.slave, 'prewarming', False)]
+                if len(brdicts) <= len(prewarming):
+                    defer.returnValue(None)
+                    return
+
+            branch = yield self.getRequestedBranch(builder, brdicts)
+            props = builder.config.properties
+
+            candidates = [(sb, self.getInputs(sb, props, branch)) for sb in slaves]
+            chosen = self.policy.choose(candidates)
+        except Exception:
+            log.err(None, "%s: slave selection failed, picking a random slave" %
+                    builder.name)
+            defer.returnValue(random.choice(slaves))
+            return
+
+        log.msg("%s: picked slave %s for branch %s" %
+                (builder.name, chosen.slave.slavename, branch))
+        for line in self.policy.describe():
+            log.msg("%s:   %s" % (builder.name, line))
 
-        for slave in slaves:
-            # if we found an idle slave, immediate use this one
-            if slave.isIdle():
-                return slave
+        defer.returnValue(chosen)
 
-            # hold onto the first slave thats not spun up but free
-            if availableSlave is None and slave.isAvailable():
-                availableSlave = slave
+    @defer.inlineCallbacks
+    def getRequestedBranch(self, builder, brdicts):
+        # the branch of the oldest pending request, if the change has one
+        if not brdicts:
+            defer.returnValue(None)
+            return
 
-        # we got here because there was no idle slave
-        if availableSlave is not None:
-            return availableSlave
+        brdict = min(brdicts, key=lambda br: br['submitted_at'])
+        props = yield builder.master.db.buildsets.getBuildsetProperties(
+            brdict['buildsetid'])
+        defer.returnValue(props.get('event.change.branch', (None,))[0])
 
-        # randomly choose among all our busy slaves
-        return (random.choice(slaves) if slaves else None)
+    def getInputs(self, sb, props, branch):
+        slave = sb.slave
+        # the slots of an instance share what is installed on it
+        warm = getattr(getInstanceSlave(slave), 'warm_state', {})
 
-    def __init__(self, mergeRequests=False, nextSlave=None, **kwargs):
+        inputs = {}
+        inputs['name'] = slave.slavename
+        inputs['deps'] = bool(warm.get('deps'))
+        inputs['zfs'] = ('spltag' in warm and
+                         warm.get('spltag') == props.get('spltag') and
+                         warm.get('zfstag') == props.get('zfstag'))
+        inputs['branch'] = (branch is not None and warm.get('branch') == branch
+                            and now() - warm.get('time', 0) < self.branch_window)
+        inputs['load'] = len([b for b in slave.slavebuilders.values()
+                              if b.isBusy()])
+        inputs['substantiate_seconds'] = self.getSubstantiateSeconds(sb)
+        return inputs
+
+    def getSubstantiateSeconds(self, sb):
+        # a slot is ready about when the instance hosting it is
+        slave = getInstanceSlave(sb.slave)
+        if not hasattr(slave, 'substantiated') or slave.substantiated:
+            return 0
+
+        seconds = getattr(slave, 'substantiate_seconds', None)
+        if seconds is None:
+            seconds = self.substantiate_seconds
+
+        # a booting slave is part way there
+        started = getattr(slave, 'substantiate_started', None)
+        if slave.substantiation_deferred is not None and started is not None:
+            seconds = max(0, seconds - (now() - started))
+
+        return int(seconds)
+
+class LustreBuilderConfig(util.BuilderConfig):
+    def __init__(self, mergeRequests=False, nextSlave=None, slavePolicy=None,
+                 **kwargs):
         if nextSlave is None:
-            nextSlave = LustreBuilderConfig.nextSlave
+            if slavePolicy is None:
+                slavePolicy = WarmSlavePolicy()
+            nextSlave = LustreSlaveChooser(slavePolicy)
 
         util.BuilderConfig.__init__(self, nextSlave=nextSlave, 
                                     mergeRequests=mergeRequests, **kwargs)
 
+class LustreBuilderPrioritizer(object):
+    """Orders builders with pending requests for the build request distributor.
+
+    Keeps a rolling duration estimate per builder from its finished builds and
+    hands the builders to a policy (see lustrescheduling) along with their
+    critical path. downstream maps a builder name to the names of the builders
+    its builds trigger. Builders with an idle slave come first, then those
+    whose slaves are all free but latent, then busy ones; the policy orders
+    the builders within each of these. Estimates are only updated
+    when a builder has finished a new build, so a call costs one pending
+    request query per builder. Each ordering is logged as a single JSON line.
+    """
+
+    # number of finished builds used to seed a new estimate
+    history = 20
+
+    def __init__(self, downstream=None, policy=None):
+        if policy is None:
+            policy = CriticalPathPolicy()
+
+        self.downstream = downstream or {}
+        self.policy = policy
+        self.estimates = {}
+
+    def getEstimate(self, builder):
+        status = builder.builder_status
+        last = status.getLastFinishedBuild()
+        number = last.getNumber() if last is not None else None
+
+        seen, estimate = self.estimates.get(builder.name, (None, None))
+        if estimate is not None and seen == number:
+            return estimate
+
+        if estimate is None:
+            estimate = DurationEstimate()
+
+        # fold in the builds finished since we last looked, oldest first
+        durations = []
+        for build in status.generateFinishedBuilds(num_builds=self.history,
+                                                   results=[SUCCESS, WARNINGS]):
+            if seen is not None and build.getNumber() <= seen:
+                break
+
+            start, finish = build.getTimes()
+            if finish is not None:
+                durations.append(finish - start)
+
+        for seconds in reversed(durations):
+            estimate.add(seconds)
+
+        self.estimates[builder.name] = (number, estimate)
+        return estimate
+
+    def getAvailability(self, builder):
+        # 0 with an idle slave, 1 with none busy, 2 otherwise
+        busy = False
+        for sb in builder.slaves:
+            if sb.isIdle():
+                return 0
+            if sb.isBusy():
+                busy = True
+
+        return 2 if busy else 1
+
+    @defer.inlineCallbacks
+    def __call__(self, buildmaster, builders):
+        allBuilders = buildmaster.botmaster.builders
+
+        names = set(b.name for b in builders)
+        for b in builders:
+            names.update(self.downstream.get(b.name, []))
+
+        durations = {}
+        for name in names:
+            if name in allBuilders:
+                durations[name] = self.getEstimate(allBuilders[name]).get()
+
+        oldest = yield defer.gatherResults(
+            [b.getOldestRequestTime() for b in builders])
+
+        entries = []
+        for b, submitted in zip(builders, oldest):
+            entries.append({
+                'name': b.name,
+                'seconds': int(durations.get(b.name, 0)),
+                'path': int(criticalPath(b.name, durations, self.downstream)),
+                'gated': len(self.downstream.get(b.name, [])),
+                'oldest': submitted,
+                'availability': self.getAvailability(b),
+                'builder': b,
+            })
+
+        # a builder which can start now goes ahead of one which cannot
+        ranked = []
+        for availability in range(3):
+            ranked.extend(self.policy.rank(
+                [e for e in entries if e['availability'] == availability]))
+
+        log.msg("prioritized %s" % json.dumps(
+            [[e['name'], e['path'], e['seconds'], e['gated']] for e in ranked],
+            separators=(',', ':')))
+
+        defer.returnValue([e['builder'] for e in ranked])
+
 ### BUILD SLAVE CLASSES
+
+def slotMakeJobs(instance_type, slots, job_memory):
+    """Returns the make jobs of one of slots builds sharing an instance, its
+    share of the vCPUs bounded by its share of the memory at job_memory MiB a
+    job, or None if the instance type is unknown."""
+    if instance_type not in instance_resources:
+        return None
+
+    cpus, memory = instance_resources[instance_type]
+    return max(1, min(cpus // slots, memory // slots // job_memory))
+
+def getInstanceSlave(slave):
+    # the slave which owns the instance a slot runs on
+    return getattr(slave, 'owner', slave)
+
+def withSlots(slaves):
+    """Returns the given slaves followed by the slot slaves of each, for
+    the master's slave list and the slavenames of builders."""
+    return [s for slave in slaves
+            for s in [slave] + getattr(slave, 'slot_slaves', [])]
+
 class LustreEC2Slave(EC2LatentBuildSlave):
     default_user_data = """#!/bin/bash
 set -e
@@ -67,30 +293,269 @@ export BB_MASTER='%s'
 export BB_NAME='%s'
 export BB_PASSWORD='%s'
 export BB_URL='%s'
+export BB_PKG_PROXY='%s'
+export BB_SLOTS='%s'
+export BB_SCRIPTS_URL='%s'
 
 if [ -z "$BB_URL" ]; then
     export BB_URL="https://raw.githubusercontent.com/opensfs/lustre-buildbot-config/master/scripts/"
 fi
 
-# Get the runurl utility.
-wget -qO/usr/bin/runurl $BB_URL/runurl
-chmod 755 /usr/bin/runurl
+# Run the bootstrap script from the master's script bundle, or get the runurl
+# utility and run it from BB_URL when the master does not serve one.
+if [ -n "$BB_SCRIPTS_URL" ] && wget -qO/usr/bin/bbrun $BB_SCRIPTS_URL/bbrun; then
+    chmod 755 /usr/bin/bbrun
+    bbrun bb-bootstrap.sh
+else
+    wget -qO/usr/bin/runurl $BB_URL/runurl
+    chmod 755 /usr/bin/runurl
+    runurl $BB_URL/bb-bootstrap.sh
+fi"""
 
-# Run the bootstrap script
-runurl $BB_URL/bb-bootstrap.sh"""
+    # set while an instance is started ahead of any build by prewarm()
+    prewarming = False
+
+    # rolling average of how long the instance took to boot and connect, and
+    # the number and total time of all boots for the metrics
+    substantiate_seconds = None
+    substantiate_started = None
+    substantiate_count = 0
+    substantiate_total = 0
+
+    # number of finished builds of a builder its durations per instance type
+    # are estimated from
+    instance_history = 20
 
     @staticmethod
     def pass_generator(size=24, chars=string.ascii_uppercase + string.digits):
         return ''.join(random.choice(chars) for _ in range(size))
 
+    def prewarm(self, sb, owner, hold):
+        """Start this slave's instance before a build has been requested.
+
+        The instance is kept for at least hold seconds, even while idle, unless
+        the owner (the build which asked for it) cancels it first with
+        cancelPrewarm(). Returns the substantiation deferred."""
+        self.prewarm_holds[owner] = now() + hold
+
+        if self.substantiated:
+            if not self.building:
+                self._setBuildWaitTimer()
+            return None
+
+        log.msg("%s: prewarming for %ds" % (self.slavename, hold))
+        self.prewarming = True
+        d = sb.substantiate(None)
+
+        def done(res):
+            self.prewarming = False
+            # no build owns the slave builder, put it back if the boot failed
+            if not self.substantiated and sb.state == SUBSTANTIATING:
+                sb.state = LATENT
+            return res
+
+        def failed(failure):
+            log.err(failure, "%s: prewarm failed" % self.slavename)
+            # the builds the chooser held back for this boot are started
+            # on other slaves, or retry this one
+            if self.botmaster is not None:
+                self.botmaster.maybeStartBuildsForSlave(self.slavename)
+
+            # the deferred is shared with any build waiting on this slave,
+            # the failure is left for those to handle
+            waiting = [other for other in self.slavebuilders.values()
+                       if other is not sb and other.state == SUBSTANTIATING]
+            if waiting:
+                return failure
+            return None
+        d.addBoth(done)
+        d.addErrback(failed)
+        return d
+
+    def cancelPrewarm(self, owner):
+        """Release the hold owner has on this slave. An idle instance then
+        shuts down after the usual build_wait_timeout."""
+        if self.prewarm_holds.pop(owner, None) is None:
+            return
+
+        log.msg("%s: prewarm cancelled" % self.slavename)
+        if self.substantiated and not self.building:
+            self._setBuildWaitTimer()
+
+    def substantiate(self, sb, build):
+        if self.substantiated or self.substantiation_deferred is not None:
+            return EC2LatentBuildSlave.substantiate(self, sb, build)
+
+        self.substantiate_started = now()
+        d = EC2LatentBuildSlave.substantiate(self, sb, build)
+
+        def timed(res):
+            if self.substantiated:
+                seconds = now() - self.substantiate_started
+                self.substantiate_count += 1
+                self.substantiate_total += seconds
+                if self.substantiate_seconds is None:
+                    self.substantiate_seconds = seconds
+                else:
+                    self.substantiate_seconds = \
+                        (3 * self.substantiate_seconds + seconds) / 4
+            return res
+        d.addBoth(timed)
+        return d
+
+    def start_instance(self, build):
+        if not self.instance_types or self.price_feed is None:
+            return EC2LatentBuildSlave.start_instance(self, build)
+
+        d = self.selectInstance(build)
+        d.addCallback(lambda _: EC2LatentBuildSlave.start_instance(self, build))
+        return d
+
+    @defer.inlineCallbacks
+    def selectInstance(self, build):
+        """Picks the instance type and bid of the instance about to start.
+
+        The durations of the builds recorded on each of instance_types and the
+        prices from price_feed are handed to instance_policy (see
+        InstanceCostPolicy). The builds are those of the builder which asked
+        for the instance or, for a prewarmed one, the slowest of the slave's
+        builders. Without prices the configured type and bid are used."""
+        if build is not None:
+            builders = [build.builder]
+        else:
+            builders = self.botmaster.getBuildersForSlave(self.slavename)
+
+        measured = {}
+        for builder in builders:
+            for instance_type, seconds in self.getInstanceDurations(builder).items():
+                measured[instance_type] = max(seconds, measured.get(instance_type, 0))
+
+        try:
+            prices = yield defer.maybeDeferred(self.price_feed.getPrices, self,
+                                               self.instance_types)
+        except Exception:
+            log.err(None, "%s: cannot get spot prices" % self.slavename)
+            prices = {}
+
+        boot = self.substantiate_seconds or LustreSlaveChooser.substantiate_seconds
+        candidates = instanceCandidates(self.instance_types, measured, prices,
+                                        boot, self.default_instance_type)
+        choice = self.instance_policy.choose(candidates, self.deadline,
+                                             self.max_bid)
+        for line in self.instance_policy.describe():
+            log.msg("%s:   %s" % (self.slavename, line))
+
+        if choice is None:
+            instance_type, bid = self.default_instance_type, self.max_price
+            log.msg("%s: no spot prices, starting a %s bidding up to %.4f" %
+                    (self.slavename, instance_type, bid))
+        else:
+            instance_type, bid = choice[0]['instance_type'], choice[1]
+            log.msg("%s: starting a %s bidding %.4f" %
+                    (self.slavename, instance_type, bid))
+
+        self.setInstanceType(instance_type)
+        self.max_spot_price = bid
+
+    def getInstanceDurations(self, builder):
+        """Returns the expected duration of a builder's builds on each
+        instance type they finished on, from the builds' instance_type"""
+        durations = []
+        for build in builder.builder_status.generateFinishedBuilds(
+                num_builds=self.instance_history, results=[SUCCESS, WARNINGS]):
+            start, finish = build.getTimes()
+            instance_type = build.getProperty('instance_type', None)
+            if finish is not None and instance_type is not None:
+                durations.append((instance_type, finish - start))
+
+        estimates = {}
+        for instance_type, seconds in reversed(durations):
+            estimates.setdefault(instance_type, DurationEstimate()).add(seconds)
+        return dict((t, e.get()) for t, e in estimates.items())
+
+    def setInstanceType(self, instance_type):
+        # builds record the type they ran on, and slots get their share of it
+        self.instance_type = instance_type
+        for slave in [self] + self.slot_slaves:
+            slave.properties.setProperty('instance_type', instance_type,
+                                         'BuildSlave')
+            if self.slot_slaves:
+                jobs = slotMakeJobs(instance_type, self.slots, self.job_memory)
+                if jobs is not None:
+                    slave.properties.setProperty('makejobs', jobs, 'BuildSlave')
+
+    def insubstantiate(self, fast=False):
+        # whatever the instance had installed goes with it
+        self.warm_state = {}
+        return EC2LatentBuildSlave.insubstantiate(self, fast)
+
+    def slotsBusy(self):
+        return [s for s in self.slot_slaves if s.building]
+
+    def resetIdleTimer(self):
+        # an idle instance goes build_wait_timeout after its last slot's build
+        if self.substantiated and not self.building and not self.slotsBusy():
+            self._setBuildWaitTimer()
+
+    def _setBuildWaitTimer(self):
+        self._clearBuildWaitTimer()
+        if self.build_wait_timeout <= 0 or self.slotsBusy():
+            return
+
+        # an idle slave is kept until the longest prewarm hold expires
+        timeout = self.build_wait_timeout
+        for owner, until in self.prewarm_holds.items():
+            if until <= now():
+                del self.prewarm_holds[owner]
+            else:
+                timeout = max(timeout, until - now())
+
+        self.build_wait_timer = reactor.callLater(timeout, self._soft_disconnect)
+
     def __init__(self, name, password=None, master='', url='', instance_type="m3.large",
                 identifier=ec2_default_access, secret_identifier=ec2_default_secret,
                 keypair_name=ec2_default_keypair_name, security_name='LustreBuilder',
                 user_data=None, region="us-west-1", placement="b", max_builds=1,
                 build_wait_timeout=60 * 1, spot_instance=True, max_spot_price=.08,
-                price_multiplier=None, **kwargs):
+                price_multiplier=None, pkg_proxy='', scripts_url='', slots=1,
+                job_memory=1024, instance_types=None, price_feed=None, deadline=None,
+                instance_policy=None, max_bid=None, **kwargs):
 
         self.name = name
+        self.prewarm_holds = {}
+        self.warm_state = {}
+
+        # with instance_types and a price_feed every instance's type and bid
+        # are picked when it starts, max_bid caps the bid. Without prices the
+        # configured instance_type is started bidding max_spot_price.
+        self.instance_types = instance_types or []
+        self.price_feed = price_feed
+        self.deadline = deadline
+        if instance_policy is None:
+            instance_policy = InstanceCostPolicy()
+        self.instance_policy = instance_policy
+        self.default_instance_type = instance_type
+        self.max_price = float(max_spot_price)
+        if max_bid is None:
+            max_bid = max_spot_price
+        self.max_bid = float(max_bid)
+        self.slots = slots
+        self.job_memory = job_memory
+
+        # further builds on the instance connect as slot slaves of their own,
+        # each given an equal share of the instance
+        self.slot_slaves = []
+        properties = dict(kwargs.pop('properties', {}))
+        properties['instance_type'] = instance_type
+        if slots > 1:
+            properties['slots'] = slots
+            jobs = slotMakeJobs(instance_type, slots, job_memory)
+            if jobs is not None:
+                properties['makejobs'] = jobs
+
+            self.slot_slaves = [LustreEC2SlotSlave("%s-slot%d" % (name, i), self,
+                                                   properties=properties)
+                                for i in range(2, slots + 1)]
 
         tags = kwargs.get('tags')
         if not tags or tags is None:
@@ -107,7 +572,9 @@ runurl $BB_URL/bb-bootstrap.sh"""
             password = LustreEC2Slave.pass_generator()
 
         if user_data is None:
-            user_data = LustreEC2Slave.default_user_data % (master, name, password, url)
+            user_data = LustreEC2Slave.default_user_data % (master, name, password, url,
+                pkg_proxy, ' '.join("%s:%s" % (s.slavename, s.password)
+                                    for s in self.slot_slaves), scripts_url)
 
         EC2LatentBuildSlave.__init__(
             self, name=name, password=password, instance_type=instance_type, 
@@ -116,12 +583,65 @@ runurl $BB_URL/bb-bootstrap.sh"""
             max_builds=max_builds, spot_instance=spot_instance, tags=tags,
             max_spot_price=max_spot_price, placement=placement,
             price_multiplier=price_multiplier, build_wait_timeout=build_wait_timeout, 
-            **kwargs)
+            properties=properties, **kwargs)
+
+class LustreEC2SlotSlave(AbstractLatentBuildSlave):
+
+    """A further build slot of a LustreEC2Slave's instance.
+
+    The instance runs one buildslave for each slot, so several builds, even
+    of the same builder, run on it at once. A slot substantiates by
+    substantiating its owner, the LustreEC2Slave which starts and stops the
+    instance, and then waiting for its own buildslave to connect. The owner
+    keeps the instance up while any of its slots is building.
+    """
+
+    def __init__(self, name, owner, password=None, **kwargs):
+        if password is None:
+            password = LustreEC2Slave.pass_generator()
+
+        self.name = name
+        self.owner = owner
+        # a slot never shuts down by itself, its connection goes with the
+        # instance
+        AbstractLatentBuildSlave.__init__(self, name, password, max_builds=1,
+                                          build_wait_timeout=-1, **kwargs)
+
+    def substantiate(self, sb, build):
+        # like the owner's own builds, a slot's restarts the idle timer
+        self.owner.resetIdleTimer()
+        return AbstractLatentBuildSlave.substantiate(self, sb, build)
+
+    def start_instance(self, build):
+        if self.owner.substantiated:
+            return defer.succeed(True)
+
+        log.msg("%s: starting instance of %s" % (self.slavename,
+                                                 self.owner.slavename))
+        return self.owner.substantiate(None, build)
+
+    def stop_instance(self, fast=False):
+        return defer.succeed(None)
+
+    def detached(self, mind):
+        AbstractLatentBuildSlave.detached(self, mind)
+        self.substantiated = False
+
+    def buildStarted(self, sb):
+        AbstractLatentBuildSlave.buildStarted(self, sb)
+        self.owner._clearBuildWaitTimer()
+
+    def buildFinished(self, sb):
+        AbstractLatentBuildSlave.buildFinished(self, sb)
+        self.owner.resetIdleTimer()
 
 class LustreEC2SuseSlave(LustreEC2Slave):
     def __init__(self, name, **kwargs):
-        LustreEC2Slave.__init__(self, name, max_spot_price="0.16",
-                                     instance_type="m3.large",
+        # SUSE instances cost more, the defaults may be overridden along with
+        # instance_types and a price_feed
+        kwargs.setdefault('max_spot_price', 0.16)
+        kwargs.setdefault('instance_type', "m3.large")
+        LustreEC2Slave.__init__(self, name,
                                      product_description="SUSE Linux (Amazon VPC)",
                                      **kwargs)
 
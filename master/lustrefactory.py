@@ -1,13 +1,35 @@
 # -*- python -*-
 # ex: set syntax=python:
 
+import os
+import re
+import time
+
 from buildbot.plugins import util
+from buildbot.util import now
+from buildbot.process import logobserver
+from buildbot.process.buildstep import BuildStep, LogLineObserver
 from buildbot.steps.source.gerrit import Gerrit
 from buildbot.steps.shell import ShellCommand, Configure, SetPropertyFromCommand
-from buildbot.steps.master import SetProperty
+from buildbot.steps.master import SetProperty, MasterShellCommand
 from buildbot.steps.transfer import FileUpload, FileDownload, DirectoryUpload
 from buildbot.steps.trigger import Trigger
 from buildbot.status.results import SUCCESS, FAILURE, SKIPPED, WARNINGS 
+from twisted.internet import defer
+from twisted.internet import threads
+from twisted.python import log
+from lustregerritscheduler import supersededBy
+from lustreartifactstore import ArtifactStore
+from lustreretention import RetentionIndex
+from lustrelogs import LogDigest
+from lustreimpact import analyzeImpact
+
+@defer.inlineCallbacks
+def is_superseded(build):
+    newer = yield supersededBy(build.builder.botmaster.master,
+                               build.getProperty('event.change.number'),
+                               build.getProperty('event.patchSet.number'))
+    defer.returnValue(newer is not None)
 
 def do_step_if_value(step, name, value):
     props = step.build.getProperties()
@@ -25,6 +47,86 @@ def do_step_installdeps(step):
 def do_step_collectpacks(step):
     return do_step_if_value(step, 'buildstyle', 'rpm') or do_step_if_value(step, 'buildstyle', 'deb')
 
+def do_step_gitmirror(step):
+    props = step.build.getProperties()
+    return bool(props.getProperty('gitmirror'))
+
+def do_step_ccache(step):
+    return do_step_if_value(step, 'ccache', 'yes')
+
+def do_step_ccache_upload(step):
+    return do_step_ccache(step) and step.build.getProperty('cache_delta_bytes', 0) > 0
+
+def do_step_configcache(step):
+    return do_step_if_value(step, 'configcache', 'yes')
+
+def do_step_configcache_upload(step):
+    return do_step_configcache(step) and step.build.getProperty('configcache_bytes', 0) > 0
+
+def do_step_zfs_upload(step):
+    return do_step_if_value(step, 'zfscache', 'yes') and step.build.getProperty('zfs_cache_bytes', 0) > 0
+
+def do_step_resultcache_enabled(step):
+    return do_step_if_value(step, 'resultcache', 'yes')
+
+def do_step_resultcache(step):
+    # the forcebuild property makes a build ignore the results of earlier ones
+    return do_step_resultcache_enabled(step) and \
+        bool(step.build.getProperty('tree')) and \
+        not do_step_if_value(step, 'forcebuild', 'yes')
+
+def do_step_save_result(step):
+    # a forced build replaces the result it ignored
+    return do_step_resultcache_enabled(step) and \
+        bool(step.build.getProperty('tree')) and not is_result_cached(step) and \
+        step.build.result in (SUCCESS, WARNINGS)
+
+def do_step_save_tarball(step):
+    return do_step_save_result(step) and bool(getattr(step.build, 'published', None))
+
+def is_result_cached(step):
+    return bool(step.build.getProperty('result_cached', False))
+
+def unless_cached(do_step=None):
+    # steps which make what a reused result already provides are skipped
+    def do_step_unless_cached(step):
+        if is_result_cached(step):
+            return False
+        return do_step is None or do_step(step)
+    return do_step_unless_cached
+
+def do_step_impact(step):
+    # tags always build the full matrix
+    return do_step_if_value(step, 'category', 'patchset')
+
+@defer.inlineCallbacks
+def do_step_trigger(step):
+    # a newer patchset of the change makes packaging this one pointless, as
+    # does a change which none of the package builders need
+    if step.build.getProperty('impacted_builders', None) == []:
+        defer.returnValue(False)
+        return
+    superseded = yield is_superseded(step.build)
+    defer.returnValue(not superseded)
+
+@defer.inlineCallbacks
+def do_step_cancel_prewarm(step):
+    prewarmed = getattr(step.build, 'prewarmed_slaves', None)
+    if not prewarmed:
+        defer.returnValue(False)
+        return
+
+    if step.build.result not in (SUCCESS, WARNINGS):
+        defer.returnValue(True)
+        return
+    superseded = yield is_superseded(step.build)
+    if superseded:
+        defer.returnValue(True)
+        return
+
+    impacted = step.build.getProperty('impacted_builders', None)
+    defer.returnValue(impacted is not None and bool(set(prewarmed) - set(impacted)))
+
 def do_step_buildrepo(step):
     return do_step_if_value(step, 'buildstyle', 'rpm')
 
@@ -34,18 +136,770 @@ def hide_if_skipped(results, step):
 def hide_except_error(results, step):
     return results in (SUCCESS, SKIPPED)
 
+def format_statistic(name, value):
+    if name.endswith('_bytes'):
+        return "%.1f MiB" % (value / (1024.0 * 1024.0))
+    elif name.endswith('_seconds'):
+        return "%ds" % value
+    elif name.endswith('_hit'):
+        return "cache %s" % ("hit" if value else "miss")
+
+    return "%s %s" % (name.replace('_', ' '), value)
+
+def parse_statistics(out):
+    # the 'bb-stat: name=value' lines of a script's output, integers converted
+    stats = []
+    for name, value in StatsShellCommand.statPattern.findall(out):
+        try:
+            value = int(value)
+        except ValueError:
+            pass
+        stats.append((name, value))
+    return stats
+
+class StatsShellCommand(ShellCommand):
+    """ShellCommand which collects statistics printed by a script.
+
+    Lines of the form 'bb-stat: name=value' in the step's stdio log are recorded
+    as step statistics and appended to the step text once the command completes.
+    Statistics named in statProperties are also set as build properties so later
+    steps can act on them.
+    """
+
+    statPattern = re.compile(r'^bb-stat: (\w+)=(\S+)$', re.M)
+
+    def __init__(self, statProperties=None, **kwargs):
+        ShellCommand.__init__(self, **kwargs)
+        self.statProperties = statProperties or []
+        self.stats = []
+
+    def commandComplete(self, cmd):
+        out = cmd.logs['stdio'].getText()
+        for name, value in parse_statistics(out):
+            self.setStatistic(name, value)
+            self.stats.append((name, value))
+
+            if name in self.statProperties:
+                self.setProperty(name, value, self.name)
+
+    def getText(self, cmd, results):
+        text = ShellCommand.getText(self, cmd, results)
+        return text + [format_statistic(name, value) for name, value in self.stats]
+
+class StatsMasterShellCommand(MasterShellCommand):
+    """MasterShellCommand which collects statistics printed by a script.
+
+    As for StatsShellCommand, 'bb-stat: name=value' lines in the stdio log are
+    recorded as step statistics and appended to the step text.
+    """
+
+    def __init__(self, **kwargs):
+        MasterShellCommand.__init__(self, **kwargs)
+        self.stats = []
+
+    def processEnded(self, status_object):
+        for name, value in parse_statistics(self.stdio_log.getText()):
+            self.setStatistic(name, value)
+            self.stats.append((name, value))
+
+        MasterShellCommand.processEnded(self, status_object)
+
+    def describe(self, done=False):
+        desc = MasterShellCommand.describe(self, done)
+        if done:
+            desc = desc + [format_statistic(name, value)
+                           for name, value in self.stats]
+        return desc
+
+def masterPathSize(path):
+    # the bytes of a file, or of the files in a directory, on the master
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            size += os.path.getsize(os.path.join(dirpath, name))
+    return size
+
+class StatsFileUpload(FileUpload):
+    """FileUpload which records the bytes it uploaded as the upload_bytes
+    step statistic"""
+
+    def finished(self, results):
+        if results in (SUCCESS, WARNINGS):
+            self.setStatistic('upload_bytes',
+                              masterPathSize(os.path.expanduser(self.masterdest)))
+        return FileUpload.finished(self, results)
+
+class StatsDirectoryUpload(DirectoryUpload):
+    """DirectoryUpload which records the bytes it uploaded as the
+    upload_bytes step statistic"""
+
+    def finished(self, results):
+        if results in (SUCCESS, WARNINGS):
+            self.setStatistic('upload_bytes',
+                              masterPathSize(os.path.expanduser(self.masterdest)))
+        return DirectoryUpload.finished(self, results)
+
+class StatsFileDownload(FileDownload):
+    """FileDownload which records the bytes it downloaded as the
+    download_bytes step statistic"""
+
+    def finished(self, results):
+        if results in (SUCCESS, WARNINGS):
+            self.setStatistic('download_bytes',
+                              masterPathSize(os.path.expanduser(self.mastersrc)))
+        return FileDownload.finished(self, results)
+
+class LogDigestObserver(LogLineObserver):
+    # feeds every line of stdout and stderr to a LogDigest
+    def __init__(self, digest):
+        LogLineObserver.__init__(self)
+        self.digest = digest
+
+    def outLineReceived(self, line):
+        self.digest.feed(line)
+
+    def errLineReceived(self, line):
+        self.digest.feed(line)
+
+class DigestShellCommand(StatsShellCommand):
+    """StatsShellCommand which adds a digest of its compiler output.
+
+    The warnings, errors and failing make target in the stdio log are collected
+    (see lustrelogs) into a small 'digest' log next to it, and their counts are
+    recorded as step statistics and appended to the step text. The Gerrit
+    summary quotes the digest of failed builds.
+    """
+
+    def __init__(self, maxDigestLines=50, **kwargs):
+        StatsShellCommand.__init__(self, **kwargs)
+        self.digest = LogDigest(maxLines=maxDigestLines)
+        self.addLogObserver('stdio', LogDigestObserver(self.digest))
+
+    def createSummary(self, log):
+        StatsShellCommand.createSummary(self, log)
+        self.setStatistic('warnings', self.digest.warnings)
+        self.setStatistic('errors', self.digest.errors)
+        if not self.digest.empty():
+            self.addCompleteLog('digest', self.digest.getText())
+
+    def getText(self, cmd, results):
+        text = StatsShellCommand.getText(self, cmd, results)
+        for name in ('warnings', 'errors'):
+            count = getattr(self.digest, name)
+            if count:
+                text.append("%d %s" % (count, name))
+        return text
+
+def publishedSizes(published):
+    # the bytes of each published file, for the retention index
+    return dict((path, os.path.getsize(obj)) for path, obj in published.items())
+
+class IngestArtifacts(BuildStep):
+    """Moves build products uploaded to the master into its artifact store.
+
+    Every file under src is stored by content (see lustreartifactstore) and
+    published at dest as a hard link to the stored copy, or replaced in place
+    when dest is not given. Paths are relative to the master's base directory.
+    The hashing runs in a thread. The new and reused bytes are recorded as step
+    statistics and shown in the step text.
+
+    If the 'retentionindex' property names an index, the published bytes are
+    recorded there against the build's change directory (see lustreretention).
+    The published files are remembered for SaveResult.
+    """
+
+    name = 'ingest'
+    description = ['storing artifacts']
+    descriptionDone = ['stored artifacts']
+    renderables = ['src', 'dest', 'store', 'index', 'changedir']
+
+    def __init__(self, src, dest=None, store=util.Property('artifactstore'),
+                 index=util.Property('retentionindex', default=''),
+                 changedir=None, **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.src = src
+        self.dest = dest
+        self.store = store
+        self.index = index
+        self.changedir = changedir or changeDirectory
+
+    def start(self):
+        basedir = self.build.builder.master.basedir
+        store = ArtifactStore(os.path.join(basedir, self.store))
+
+        src = os.path.join(basedir, self.src)
+        dest = self.dest and os.path.join(basedir, self.dest)
+
+        index = self.index and os.path.join(basedir, self.index)
+
+        d = threads.deferToThread(self.ingest, store, src, dest, index)
+        d.addCallback(self.ingested)
+        d.addErrback(self.failed)
+
+    def ingest(self, store, src, dest, index):
+        # runs in a thread
+        published = {}
+        stats = store.ingest(src, dest, published)
+
+        if index and self.changedir:
+            retention = RetentionIndex(index)
+            try:
+                retention.record(self.changedir, publishedSizes(published))
+            finally:
+                retention.close()
+
+        return stats, published
+
+    def ingested(self, result):
+        stats, published = result
+        if not hasattr(self.build, 'published'):
+            self.build.published = {}
+        self.build.published.update(published)
+
+        for name in ('new_bytes', 'saved_bytes'):
+            self.setStatistic('artifact_' + name, stats[name])
+
+        text = self.describe(done=True) + ["%d files" % stats['files'],
+            "%s new" % format_statistic('new_bytes', stats['new_bytes']),
+            "%s reused" % format_statistic('saved_bytes', stats['saved_bytes'])]
+
+        self.step_status.setText(text)
+        self.finished(SUCCESS)
+
+class RestoreResult(BuildStep):
+    """Reuses the result of an earlier build of the same source.
+
+    Results are recorded by SaveResult under a key made of the 'tree' property,
+    the git tree of the source, and of the properties which decide how it is
+    built (see getResultKey). When a result is recorded for this build's key,
+    its files are published under this build's change directory as links to
+    the artifact store's objects and the properties it recorded are set. The
+    'result_cached' property is then set, which skips the steps the result
+    replaces. A result which cannot be restored counts as not cached, the
+    build then makes everything itself. Runs on the master, the linking in a
+    thread.
+    """
+
+    name = 'reuse result'
+    description = ['looking up result']
+    descriptionDone = ['result']
+    renderables = ['store', 'index']
+
+    def __init__(self, kind, store=util.Property('artifactstore'),
+                 index=util.Property('retentionindex', default=''), **kwargs):
+        kwargs.setdefault('doStepIf', do_step_resultcache)
+        BuildStep.__init__(self, **kwargs)
+        self.kind = kind
+        self.store = store
+        self.index = index
+
+    def start(self):
+        basedir = self.build.builder.master.basedir
+        store = ArtifactStore(os.path.join(basedir, self.store))
+        props = self.build.getProperties()
+
+        key = getResultKey(props, self.kind)
+        base = os.path.join(basedir, getBaseMasterDest(props))
+        index = self.index and os.path.join(basedir, self.index)
+
+        d = threads.deferToThread(self.restore, store, key, base, index,
+                                  getChangeDirectory(props))
+        d.addCallback(self.restored)
+        d.addErrback(self.restoreFailed)
+        d.addErrback(self.failed)
+
+    def restore(self, store, key, base, index, changedir):
+        # runs in a thread
+        result = store.restoreResult(key, base)
+
+        if result is not None and index and changedir:
+            retention = RetentionIndex(index)
+            try:
+                retention.record(changedir, publishedSizes(result['published']))
+            finally:
+                retention.close()
+
+        return result
+
+    def restored(self, result):
+        self.setStatistic('result_cache_hit', int(result is not None))
+        if result is None:
+            self.step_status.setText(self.describe(done=True) + ["not cached"])
+            self.finished(SUCCESS)
+            return
+
+        for name, value in result['properties'].items():
+            self.setProperty(name, value, self.name)
+        self.setProperty('result_cached', True, self.name)
+        self.setProperty('result_source', result['source'], self.name)
+
+        self.step_status.setText(['reused', result['source'],
+                                  "%d files" % len(result['files'])])
+        self.finished(SUCCESS)
+
+    def restoreFailed(self, failure):
+        # the build goes on as if nothing had been cached
+        log.err(failure, "%s: cannot restore result" % self.name)
+        self.setStatistic('result_cache_hit', 0)
+        self.addCompleteLog('error', failure.getTraceback())
+        self.step_status.setText(self.describe(done=True) + ["restore failed"])
+        self.finished(WARNINGS)
+
+class SaveResult(BuildStep):
+    """Records what the build published as the result for its key, so later
+    builds of the same source can reuse it (see RestoreResult). The given
+    properties are recorded with it. Builds which published nothing record an
+    empty result, their success is all there is to reuse.
+    """
+
+    name = 'save result'
+    description = ['saving result']
+    descriptionDone = ['saved result']
+    renderables = ['store']
+
+    def __init__(self, kind, properties=None, store=util.Property('artifactstore'),
+                 **kwargs):
+        kwargs.setdefault('doStepIf', do_step_save_result)
+        BuildStep.__init__(self, **kwargs)
+        self.kind = kind
+        self.properties = properties or []
+        self.store = store
+
+    def start(self):
+        basedir = self.build.builder.master.basedir
+        store = ArtifactStore(os.path.join(basedir, self.store))
+        props = self.build.getProperties()
+
+        key = getResultKey(props, self.kind)
+        base = os.path.join(basedir, getBaseMasterDest(props))
+        published = getattr(self.build, 'published', {})
+        recorded = dict((name, props.getProperty(name)) for name in self.properties)
+        source = "%s build %s of %s" % (props.getProperty('buildername'),
+                                        props.getProperty('buildnumber'),
+                                        getChangeDirectory(props).strip('/') or 'unknown')
+
+        d = threads.deferToThread(store.saveResult, key, base, published,
+                                  recorded, source)
+        d.addCallback(lambda _: self.saved(len(published)))
+        d.addErrback(self.failed)
+
+    def saved(self, count):
+        self.step_status.setText(self.describe(done=True) + ["%d files" % count])
+        self.finished(SUCCESS)
+
+class LustreGerrit(Gerrit):
+    """Gerrit source step which records the clone time as a step statistic"""
+
+    def __init__(self, **kwargs):
+        Gerrit.__init__(self, **kwargs)
+        # Source.start fails the step before startVC without a sourcestamp
+        self.vc_started = None
+
+    def startVC(self, branch, revision, patch):
+        self.vc_started = now()
+        return Gerrit.startVC(self, branch, revision, patch)
+
+    def finished(self, results):
+        if self.vc_started is not None:
+            self.setStatistic('clone_seconds', int(now() - self.vc_started))
+        return Gerrit.finished(self, results)
+
+def prewarm_allowed(props, when=None):
+    # prewarm is enabled per builder and may be limited to certain hours
+    if props.get('prewarm') != 'yes':
+        return False
+
+    hours = props.get('prewarmhours')
+    if not hours:
+        return True
+
+    start, end = [int(h) for h in hours.split('-')]
+    hour = time.localtime(when).tm_hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+class PrewarmSlaves(BuildStep):
+    """Starts one latent slave for each builder of the given schedulers.
+
+    Runs on the master when a build begins so the slaves of the builders it will
+    later trigger boot in parallel with it instead of after it. A builder is
+    prewarmed when its 'prewarm' property is 'yes' and the local hour is within
+    its optional 'prewarmhours' range (for example '6-22'). Builders with a slave
+    already up or booting are left alone. Prewarmed slaves stay up for at least
+    'prewarmhold' seconds unless CancelPrewarmSlaves releases them.
+    """
+
+    name = 'prewarm'
+    description = ['prewarming']
+    descriptionDone = ['prewarmed']
+
+    def __init__(self, schedulerNames, **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.schedulerNames = schedulerNames
+
+    def start(self):
+        botmaster = self.build.builder.botmaster
+        schedulers = dict((sch.name, sch) for sch in botmaster.parent.allSchedulers())
+
+        builderNames = []
+        for name in self.schedulerNames:
+            if name in schedulers:
+                builderNames.extend(schedulers[name].builderNames)
+
+        prewarmed = {}
+        for name in builderNames:
+            builder = botmaster.builders.get(name)
+            if builder is None or not prewarm_allowed(builder.config.properties):
+                continue
+
+            slaves = [sb for sb in builder.slaves if hasattr(sb.slave, 'prewarm')]
+            if [sb for sb in slaves if sb.slave.substantiated or
+                                       sb.slave.substantiation_deferred is not None]:
+                continue
+
+            available = [sb for sb in slaves if sb.isAvailable()]
+            if not available:
+                continue
+
+            hold = int(builder.config.properties.get('prewarmhold', 3600))
+            available[0].slave.prewarm(available[0], self.build, hold)
+            prewarmed[name] = available[0].slave
+
+        # remembered so the hold can be released if this build fails or the
+        # change turns out not to need the builder
+        self.build.prewarmed_slaves = prewarmed
+
+        self.step_status.setText(self.describe(done=True) +
+                                 ["%d slave(s)" % len(prewarmed)])
+        self.finished(SUCCESS)
+
+class CancelPrewarmSlaves(BuildStep):
+    """Releases the slaves prewarmed by this build when it did not succeed,
+    or those of the builders which the change impact analysis skipped"""
+
+    name = 'cancel prewarm'
+    description = ['cancelling prewarm']
+    descriptionDone = ['cancelled prewarm']
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('alwaysRun', True)
+        kwargs.setdefault('doStepIf', do_step_cancel_prewarm)
+        BuildStep.__init__(self, **kwargs)
+
+    def start(self):
+        d = is_superseded(self.build)
+        d.addCallback(self.cancel)
+        d.addErrback(self.failed)
+
+    def cancel(self, superseded):
+        prewarmed = getattr(self.build, 'prewarmed_slaves', {})
+        impacted = self.build.getProperty('impacted_builders', None)
+        if self.build.result in (SUCCESS, WARNINGS) and \
+                not superseded and impacted is not None:
+            prewarmed = dict((name, slave) for name, slave in prewarmed.items()
+                             if name not in impacted)
+
+        slaves = prewarmed.values()
+        for slave in slaves:
+            slave.cancelPrewarm(self.build)
+
+        self.step_status.setText(self.describe(done=True) +
+                                 ["%d slave(s)" % len(slaves)])
+        self.finished(SUCCESS)
+
+class ImpactAnalysis(ShellCommand):
+    """Decides which builders of the given schedulers a patchset needs.
+
+    Lists the files the checked out commit changes and matches them against
+    the impact rules, see analyzeImpact() in lustreimpact.py, using the
+    properties the builders are configured with. The needed builders are set
+    in the 'impacted_builders' property, which LustreImpactTriggerable acts on,
+    and the others with the reason they were skipped in 'skipped_builders'. If
+    the files cannot be listed both properties are left unset and every
+    builder is triggered.
+    """
+
+    name = 'impact'
+    description = ['analyzing impact']
+    descriptionDone = ['impact']
+
+    def __init__(self, schedulerNames, rules, **kwargs):
+        kwargs.setdefault('command', ['git', 'diff', '--name-only', 'HEAD~1', 'HEAD'])
+        kwargs.setdefault('logEnviron', False)
+        kwargs.setdefault('flunkOnFailure', False)
+        kwargs.setdefault('warnOnFailure', True)
+        kwargs.setdefault('doStepIf', do_step_impact)
+        ShellCommand.__init__(self, **kwargs)
+        self.schedulerNames = schedulerNames
+        self.rules = rules
+        self.observer = logobserver.BufferLogObserver(wantStdout=True)
+        self.addLogObserver('stdio', self.observer)
+        self.impacted = None
+        self.builderCount = 0
+
+    def getBuilders(self):
+        botmaster = self.build.builder.botmaster
+        schedulers = dict((sch.name, sch) for sch in botmaster.parent.allSchedulers())
+
+        builders = {}
+        for name in self.schedulerNames:
+            if name not in schedulers:
+                continue
+            for builderName in schedulers[name].builderNames:
+                builder = botmaster.builders.get(builderName)
+                if builder is not None:
+                    builders[builderName] = builder.config.properties
+        return builders
+
+    def commandComplete(self, cmd):
+        if cmd.didFail():
+            return
+
+        files = [f for f in self.observer.getStdout().splitlines() if f]
+        builders = self.getBuilders()
+        self.impacted, skipped = analyzeImpact(files, builders, self.rules)
+
+        self.setProperty('impacted_builders', self.impacted, self.name)
+        self.setProperty('skipped_builders', skipped, self.name)
+
+        lines = ["%d changed file(s)" % len(files)]
+        lines.extend("build %s" % name for name in self.impacted)
+        lines.extend("skip %s: %s" % item for item in sorted(skipped.items()))
+        self.addCompleteLog('impact', "\n".join(lines) + "\n")
+        self.builderCount = len(builders)
+
+    def getText(self, cmd, results):
+        if self.impacted is None:
+            return ShellCommand.getText(self, cmd, results)
+
+        return self.describe(done=True) + \
+            ["%d of %d builders" % (len(self.impacted), self.builderCount)]
+
+@util.renderer
+def slaveWarmState(props):
+    # what a successful package build leaves installed on its slave
+    state = {'deps': True, 'branch': props.getProperty('event.change.branch')}
+    if props.getProperty('buildzfs') == 'yes':
+        state['spltag'] = props.getProperty('spltag')
+        state['zfstag'] = props.getProperty('zfstag')
+
+    return state
+
+class RecordSlaveState(BuildStep):
+    """Records what the build left installed on its slave.
+
+    The state is kept on the master's slave object, where the builders' slave
+    selection policy scores it when choosing a slave for later builds. It is
+    forgotten when a latent slave shuts down.
+    """
+
+    name = 'record slave state'
+    description = ['recording slave state']
+    descriptionDone = ['recorded slave state']
+    renderables = ['state']
+
+    def __init__(self, state, **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.state = state
+
+    def start(self):
+        # the slots of an instance share what is installed on it
+        slave = self.build.slavebuilder.slave
+        slave = getattr(slave, 'owner', slave)
+        if getattr(slave, 'warm_state', None) is None:
+            slave.warm_state = {}
+
+        slave.warm_state.update(self.state)
+        slave.warm_state['time'] = now()
+
+        self.step_status.setText(self.describe(done=True))
+        self.finished(SUCCESS)
+
+def scriptCommand(props, script):
+    # run a slave script from the master's bundle, pinned to the version the
+    # master published (see lustrescripts), or fetch it from bburl without one
+    digest = props.getProperty('bbscripts')
+    if digest:
+        return ["bbrun", "-u", "http://%s/scripts" % props.getProperty('bbmaster'),
+                "-v", digest, script]
+
+    return ["runurl", props.getProperty('bburl') + script]
+
 @util.renderer
 def dependencyCommand(props):
-    args = ["runurl"]
-    bb_url = props.getProperty('bburl')
-    args.extend([bb_url + "bb-dependencies.sh"])
+    return scriptCommand(props, "bb-dependencies.sh")
+
+@util.renderer
+def makeDistCmd(props):
+    # pack the tarball with a parallel compressor in the configured format
+    args = scriptCommand(props, "bb-tarball.sh")
+    args.extend(["create", "-f", props.getProperty('tarballformat', 'gz')])
+    return args
+
+@util.renderer
+def extractTarballCmd(props):
+    args = scriptCommand(props, "bb-tarball.sh")
+    args.extend(["extract", "-t", props.getProperty('tarball')])
+    return args
+
+@util.renderer
+def gitMirrorCommand(props):
+    args = scriptCommand(props, "bb-git-mirror.sh")
+    args.extend(["-u", props.getProperty('gitmirror'), "-d", "lustre-release.git"])
     return args
 
+@util.renderer
+def gitMirrorReference(props):
+    # the mirror lives next to the build directory so it survives clean up
+    if props.getProperty('gitmirror'):
+        return "../../mirror/lustre-release.git"
+
+    return None
+
+# scripts which run on the build master, relative to the master's basedir
+master_scripts_dir = "../scripts/"
+
+# properties which select the compiler cache a build may share
+ccache_key_props = ['distro', 'distrover', 'arch', 'kernelver', 'withzfs', 'withldiskfs']
+
+# properties which select the configure results a build may reuse, a hash of
+# the configure inputs is added on the slave
+configcache_key_props = ccache_key_props + ['spltag', 'zfstag']
+
+# properties which, with the source tree, select the packages a build may reuse
+result_key_props = ['distro', 'distrover', 'arch', 'withzfs', 'withldiskfs',
+                    'buildstyle', 'spltag', 'zfstag']
+
+# properties which select the prebuilt spl and zfs packages a build may install
+zfs_key_props = ['distro', 'distrover', 'arch', 'kernelver', 'spltag', 'zfstag']
+
+def getCacheKey(props, names):
+    # a cache key is the builder's value for each property, safe for a file name
+    key = '-'.join(str(props.getProperty(name, 'none')) for name in names)
+    return re.sub(r'[^\w.-]', '_', key)
+
+def getResultKey(props, kind):
+    # patchset and tag results are kept apart, so a tag never publishes packages
+    # versioned for a patchset
+    names = result_key_props if kind == 'package' else ['tarballformat']
+    return '%s-%s-%s-%s' % (kind, props.getProperty('tree'),
+                            props.getProperty('category') or 'none',
+                            getCacheKey(props, names))
+
+def getCacheUrl(props, kind, key):
+    # caches are served by the master next to the build products
+    bb_url = props.getProperty('bbmaster')
+    return "http://%s/cache/%s/%s.tar.gz" % (bb_url, kind, key)
+
+def getCacheDeltaPath(props, kind, key):
+    # uploaded deltas wait on the master, outside public_html, until merged
+    return "cache/incoming/%s-%s-%s.tar.gz" % (kind, key, props.getProperty('buildnumber'))
+
+def isSlotBuild(props):
+    # the builds in the slots of a shared instance run side by side
+    return props.getProperty('slots', 1) > 1
+
+def slotTmpDir(props):
+    # rpmbuild's trees go into the builder directory of a slot, where its
+    # clean up finds them without touching the other slots'
+    if isSlotBuild(props):
+        return props.getProperty('builddir')
+    return None
+
+def ccacheDir(props):
+    # the cache is kept in ccache's default location so every compiler finds
+    # it, each slot has its own so their stamps and statistics stay apart
+    if isSlotBuild(props):
+        return "$HOME/.ccache-%s" % props.getProperty('slavename')
+    return "$HOME/.ccache"
+
+@util.renderer
+def ccacheFetchCmd(props):
+    key = getCacheKey(props, ccache_key_props)
+    fetchcmd = ("%s fetch -u %s -d \"$CCACHE_DIR\"" %
+                (" ".join(scriptCommand(props, "bb-cache.sh")),
+                 getCacheUrl(props, "ccache", key)))
+    return ["sh", "-c", "export CCACHE_DIR=%s; %s && ccache -z" %
+            (ccacheDir(props), fetchcmd)]
+
+@util.renderer
+def ccacheDeltaCmd(props):
+    # report the hit rate of this build, then pack what it added or used
+    statscmd = ("ccache -s | awk '"
+                "/cache hit/ { hits += $NF } "
+                "/cache miss/ { misses += $NF } "
+                "END { printf \"bb-stat: ccache_hits=%d\\n"
+                "bb-stat: ccache_misses=%d\\n\", hits, misses }'")
+    deltacmd = ("%s delta -d \"$CCACHE_DIR\" -x stats -o ccache-delta.tar.gz" %
+                " ".join(scriptCommand(props, "bb-cache.sh")))
+    return ["sh", "-c", "export CCACHE_DIR=%s; %s; %s" %
+            (ccacheDir(props), statscmd, deltacmd)]
+
+@util.renderer
+def ccacheDeltaMasterDest(props):
+    key = getCacheKey(props, ccache_key_props)
+    return getCacheDeltaPath(props, "ccache", key)
+
+@util.renderer
+def ccacheMergeCmd(props):
+    key = getCacheKey(props, ccache_key_props)
+    delta = getCacheDeltaPath(props, "ccache", key)
+    return ["bash", master_scripts_dir + "bb-cache-merge.sh", "-r", "cache/ccache",
+            "-k", key, "-i", delta, "-b", "public_html/cache/ccache",
+            "-m", str(props.getProperty('ccachesize', 4096))]
+
+def getSlotEnv(props):
+    tmpdir = slotTmpDir(props)
+    if tmpdir is None:
+        return {}
+    return { "TMPDIR" : tmpdir }
+
+@util.renderer
+def slotEnv(props):
+    return getSlotEnv(props)
+
+@util.renderer
+def buildEnv(props):
+    # put the ccache compiler wrappers first in the path of compiling steps
+    env = getSlotEnv(props)
+    if props.getProperty('ccache') != 'yes':
+        return env
+
+    env.update({
+        "PATH"           : "/usr/lib64/ccache:/usr/lib/ccache:${PATH}",
+        "CCACHE_DIR"     : ccacheDir(props).replace("$HOME", "${HOME}"),
+        "CCACHE_BASEDIR" : slotTmpDir(props) or "/tmp",
+    })
+    return env
+
+@util.renderer
+def cleanupCmd(props):
+    if slotTmpDir(props) is not None:
+        return ["sh", "-c", "rm -rvf ./* ../rpmbuild-*"]
+    return ["sh", "-c", "rm -rvf ./* /tmp/rpmbuild-*"]
+
+@util.renderer
+def configCacheFetchCmd(props):
+    key = getCacheKey(props, configcache_key_props)
+    cache_url = "http://%s/cache/configure" % props.getProperty('bbmaster')
+    return scriptCommand(props, "bb-configcache.sh") + ["fetch", "-u", cache_url, "-k", key]
+
+@util.renderer
+def configCacheSaveCmd(props):
+    return scriptCommand(props, "bb-configcache.sh") + ["save", "-o", "config.cache.upload"]
+
+@util.renderer
+def configCacheMasterDest(props):
+    # the key includes the configure input hash the fetch step reported
+    return "public_html/cache/configure/%s.cache" % props.getProperty('configcache_key')
+
 @util.renderer
 def buildzfsCommand(props):
-    args = ["runurl"]
-    bb_url = props.getProperty('bburl')
-    args.extend([bb_url + "bb-build-zfs-pkg.sh"])
+    args = scriptCommand(props, "bb-build-zfs-pkg.sh")
 
     spltag = props.getProperty('spltag')
     if spltag:
@@ -55,8 +909,20 @@ def buildzfsCommand(props):
     if zfstag:
         args.extend(["-z", zfstag])
 
+    # install prebuilt packages from the master, or build and bundle them
+    if props.getProperty('zfscache') == 'yes':
+        key = getCacheKey(props, zfs_key_props)
+        args.extend(["-c", getCacheUrl(props, "zfs", key)])
+        args.extend(["-o", "spl-zfs-pkgs.tar.gz"])
+
     return args
 
+@util.renderer
+def zfsCacheMasterDest(props):
+    # the first slave to build a key publishes its packages for the others
+    key = getCacheKey(props, zfs_key_props)
+    return "public_html/cache/zfs/%s.tar.gz" % key
+
 @util.renderer
 def configureCmd(props):
     args = ["./configure"]
@@ -75,6 +941,10 @@ def configureCmd(props):
         else:
             args.extend(["--disable-ldiskfs"])
 
+    # run with the cached results of earlier builds, dropping them if they fail
+    if props.getProperty('configcache') == 'yes':
+        args = scriptCommand(props, "bb-configcache.sh") + ["configure", "--"] + args
+
     return args
 
 @util.renderer
@@ -82,12 +952,19 @@ def makeCmd(props):
     args = ["sh", "-c"]
     style = props.getProperty('buildstyle')
 
+    # a slot of a shared instance gets its share, see LustreEC2Slave's slots
+    jobs = props.getProperty('makejobs')
+    if jobs is None:
+        slots = props.getProperty('slots', 1)
+        jobs = "$(nproc)" if slots <= 1 else \
+            "$(( $(nproc) / %d > 1 ? $(nproc) / %d : 1 ))" % (slots, slots)
+
     if style == "deb":
-        args.extend(["make -j$(nproc) debs"])
+        args.extend(["make -j%s debs" % jobs])
     elif style == "rpm":
-        args.extend(["make -j$(nproc) rpms"])
+        args.extend(["make -j%s rpms" % jobs])
     else:
-        args.extend(["make -j$(nproc)"])
+        args.extend(["make -j%s" % jobs])
 
     return args
 
@@ -125,6 +1002,10 @@ def getChangeDirectory(props):
 
     return ''
 
+@util.renderer
+def changeDirectory(props):
+    return getChangeDirectory(props)
+
 def getBaseUrl(props):
     # generate the base url for build products of a change
     bb_url = props.getProperty('bbmaster')
@@ -138,30 +1019,37 @@ def getBaseMasterDest(props):
     masterdest += getChangeDirectory(props)
     return masterdest
 
+def getRollingRepo(props):
+    # patchsets roll into a repository for their branch, tags into one for all
+    if props.getProperty('category') == 'tag':
+        name = 'tags'
+    else:
+        name = props.getProperty('event.change.branch') or 'master'
+    name = re.sub(r'[^\w.-]+', '_', name)
+    return "repos/%s/%s/%s" % (name, props.getProperty('distro'), props.getProperty('distrover'))
+
 @util.renderer
 def buildRepoCmd(props):
-    # generate a repository to be sent to the build master
-    # currently only support RPM based platforms
-    args = ["sh", "-c"]
-    style = props.getProperty('buildstyle')
-    arch = props.getProperty('arch')
-    distro = props.getProperty('distro')
-    distrover = props.getProperty('distrover')
-    url = getBaseUrl(props)
-    url += ('%s/%s' % (distro, distrover))
+    # generate the repositories on the master once the RPMs are published,
+    # currently only RPM based platforms are supported
+    repo = '%s/%s' % (props.getProperty('distro'), props.getProperty('distrover'))
+    rolling = getRollingRepo(props)
+    build = getChangeDirectory(props).strip('/').replace('/', '-')
+    builder = re.sub(r'[^\w.-]+', '_', props.getProperty('buildername'))
 
-    if style == "deb":
-        args = []
-    elif style == "rpm":
-        # call create repo for the SRPM directory
-        # call create repo for this architecture
-        # generate a lustre.repo file for public consumption
-        repocmd = "createrepo SRPM && createrepo %s/kmod && printf \"[lustre-SRPM]\nname=lustre-SRPM\nbaseurl=%s/SRPM/\nenabled=1\ngpgcheck=0\n\n[lustre-RPM]\nname=lustre-RPM\nbaseurl=%s/%s/kmod/\nenabled=1\ngpgcheck=0\" > lustre.repo" % (arch, url, url, arch)
-        args.extend([repocmd])
-    else:
-        args = []
+    # every tag is kept, patchsets only for the last repokeep builds
+    keep = 0
+    if props.getProperty('category') != 'tag':
+        keep = props.getProperty('repokeep', 5)
 
-    return args
+    return ["bash", master_scripts_dir + "bb-repo.sh",
+            "-d", getBaseMasterDest(props) + repo,
+            "-u", getBaseUrl(props) + repo,
+            "-a", props.getProperty('arch'),
+            "-c", "cache/createrepo",
+            "-r", "public_html/" + rolling,
+            "-U", "http://%s/%s" % (props.getProperty('bbmaster'), rolling),
+            "-n", build, "-b", builder, "-k", str(keep)]
 
 @util.renderer
 def tarballMasterDest(props):
@@ -188,6 +1076,14 @@ def repoMasterDest(props):
     masterdest += ('%s/%s' % (distro, distrover))
     return masterdest
 
+@util.renderer
+def repoStagingMasterDest(props):
+    # deliverables are uploaded next to the artifact store, then ingested
+    store = props.getProperty('artifactstore')
+    builder = re.sub(r'[^\w.-]+', '_', props.getProperty('buildername'))
+    buildnumber = props.getProperty('buildnumber')
+    return "%s/incoming/%s-%s" % (store, builder, buildnumber)
+
 @util.renderer
 def repoUrl(props):
     # create a repo for each distro and distro version combination
@@ -202,15 +1098,20 @@ def buildCategory(props):
     # category is generated by the scheduler name so we don't have to
     # look at the individual changes
     sched = props.getProperty('scheduler')
-    if sched == 'master-patchset':
+    if sched in ('master-patchset', 'master-patchset-rebuild'):
         return 'patchset'
     elif sched == 'tag-changes':
         return 'tag'
 
     return ''
 
-def createTarballFactory(gerrit_repo):
+def createTarballFactory(gerrit_repo, impact_rules=None):
     """ Generates a build factory for a tarball generating builder.
+    Args:
+        gerrit_repo (str): Repository the patchsets are fetched from.
+        impact_rules (list): Rules deciding which package builders a patchset
+            needs, see analyzeImpact(). When None every patchset triggers all
+            package builders.
     Returns:
         BuildFactory: Build factory with steps for generating tarballs.
     """
@@ -222,8 +1123,14 @@ def createTarballFactory(gerrit_repo):
         value=buildCategory, 
         hideStepIf=hide_except_error))
 
+    # boot the package builders' slaves while the tarball is made
+    bf.addStep(PrewarmSlaves(
+        schedulerNames=["package-builders"],
+        flunkOnFailure=False,
+        hideStepIf=hide_except_error))
+
     # update dependencies
-    bf.addStep(ShellCommand(
+    bf.addStep(StatsShellCommand(
         command=dependencyCommand,
         decodeRC={0 : SUCCESS, 1 : FAILURE, 2 : WARNINGS, 3 : SKIPPED },
         haltOnFailure=True,
@@ -233,12 +1140,26 @@ def createTarballFactory(gerrit_repo):
         description=["installing dependencies"],
         descriptionDone=["installed dependencies"]))
 
+    # update the local reference mirror so the clone only transfers new objects
+    bf.addStep(StatsShellCommand(
+        workdir="mirror",
+        command=gitMirrorCommand,
+        decodeRC={0 : SUCCESS, 1 : FAILURE, 2 : WARNINGS, 3 : SKIPPED },
+        logEnviron=False,
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        doStepIf=do_step_gitmirror,
+        hideStepIf=hide_if_skipped,
+        description=["updating mirror"],
+        descriptionDone=["updated mirror"]))
+
     # Pull the patch from Gerrit
-    bf.addStep(Gerrit(
+    bf.addStep(LustreGerrit(
         repourl=gerrit_repo,
         workdir="build/lustre",
         mode="full",
         method="fresh",
+        reference=gitMirrorReference,
         retry=[60,60],
         timeout=3600,
         logEnviron=False,
@@ -247,44 +1168,112 @@ def createTarballFactory(gerrit_repo):
         description=["cloning"],
         descriptionDone=["cloned"]))
 
+    # objects not borrowed from the mirror are what the clone transferred
+    bf.addStep(StatsShellCommand(
+        workdir="build/lustre",
+        command=["sh", "-c", "echo \"bb-stat: clone_bytes=$(du -sb .git/objects | cut -f1)\""],
+        logEnviron=False,
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        hideStepIf=hide_except_error,
+        description=["measuring clone"],
+        descriptionDone=["clone"]))
+
+    # the source tree's hash keys the results earlier builds may share
+    bf.addStep(SetPropertyFromCommand(
+        command=['git', 'rev-parse', 'HEAD^{tree}'],
+        property='tree',
+        workdir="build/lustre",
+        logEnviron=False,
+        flunkOnFailure=False,
+        doStepIf=do_step_resultcache_enabled,
+        hideStepIf=hide_except_error))
+
+    bf.addStep(RestoreResult(
+        kind='tarball',
+        hideStepIf=hide_if_skipped))
+
     # make tarball
     bf.addStep(ShellCommand(
         command=['sh', './autogen.sh'],
         haltOnFailure=True,
+        doStepIf=unless_cached(),
+        hideStepIf=hide_if_skipped,
         description=["autogen"],
         descriptionDone=["autogen"],
         workdir="build/lustre"))
 
     bf.addStep(Configure(
         command=['./configure', '--enable-dist'],
+        doStepIf=unless_cached(),
+        hideStepIf=hide_if_skipped,
         workdir="build/lustre"))
 
-    bf.addStep(ShellCommand(
-        command=['make', 'dist'],
+    bf.addStep(StatsShellCommand(
+        command=makeDistCmd,
         haltOnFailure=True,
+        logEnviron=False,
+        doStepIf=unless_cached(),
+        hideStepIf=hide_if_skipped,
         description=["making dist"],
         descriptionDone=["make dist"],
         workdir="build/lustre"))
 
     # upload it to the master
     bf.addStep(SetPropertyFromCommand(
-        command=['sh', '-c', 'echo *.tar.gz'],
+        command=['sh', '-c', 'ls lustre-[0-9]*.tar.* | head -1'],
         property='tarball',
         workdir="build/lustre",
+        doStepIf=unless_cached(),
         hideStepIf=hide_except_error,
         haltOnFailure=True))
 
-    bf.addStep(FileUpload(
+    bf.addStep(StatsFileUpload(
         workdir="build/lustre",
         slavesrc=util.Interpolate("%(prop:tarball)s"),
         masterdest=tarballMasterDest,
+        doStepIf=unless_cached(),
+        hideStepIf=hide_if_skipped,
         url=tarballUrl))
 
+    bf.addStep(IngestArtifacts(
+        src=tarballMasterDest,
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        doStepIf=unless_cached(),
+        hideStepIf=hide_if_skipped))
+
+    # let later builds of the same source reuse the tarball
+    bf.addStep(SaveResult(
+        kind='tarball',
+        properties=['tarball'],
+        doStepIf=do_step_save_tarball,
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        hideStepIf=hide_except_error))
+
+    # leave out the package builders the patchset cannot affect
+    if impact_rules is not None:
+        bf.addStep(ImpactAnalysis(
+            schedulerNames=["package-builders"],
+            rules=impact_rules,
+            workdir="build/lustre",
+            hideStepIf=hide_if_skipped))
+
     # trigger our builders to generate packages
     bf.addStep(Trigger(
         schedulerNames=["package-builders"],
-        copy_properties=['tarball', 'category'],
-        waitForFinish=False))
+        copy_properties=['tarball', 'category', 'event.change.branch',
+                         'event.change.number', 'event.patchSet.number',
+                         'impacted_builders', 'skipped_builders',
+                         'tree', 'forcebuild'],
+        waitForFinish=False,
+        doStepIf=do_step_trigger,
+        hideStepIf=hide_if_skipped))
+
+    # release prewarmed slaves if no package builds were triggered
+    bf.addStep(CancelPrewarmSlaves(
+        hideStepIf=hide_if_skipped))
 
     return bf
 
@@ -295,101 +1284,230 @@ def createPackageBuildFactory():
     """
     bf = util.BuildFactory()
 
+    # reuse the packages of an earlier build of the same source
+    bf.addStep(RestoreResult(
+        kind='package',
+        hideStepIf=hide_if_skipped))
+
+    # update dependencies, these include the tarball's decompressor
+    bf.addStep(StatsShellCommand(
+        command=dependencyCommand,
+        decodeRC={0 : SUCCESS, 1 : FAILURE, 2 : WARNINGS, 3 : SKIPPED },
+        haltOnFailure=True,
+        logEnviron=False,
+        doStepIf=unless_cached(do_step_installdeps),
+        hideStepIf=hide_if_skipped,
+        description=["installing dependencies"],
+        descriptionDone=["installed dependencies"]))
+
     # download our tarball and extract it
-    bf.addStep(FileDownload(
+    bf.addStep(StatsFileDownload(
         workdir="build/lustre",
         slavedest=util.Interpolate("%(prop:tarball)s"),
-        mastersrc=tarballMasterDest))
+        mastersrc=tarballMasterDest,
+        doStepIf=unless_cached(),
+        hideStepIf=hide_if_skipped))
 
-    bf.addStep(ShellCommand(
+    bf.addStep(StatsShellCommand(
         workdir="build/lustre",
-        command=["tar", "-xvzf", util.Interpolate("%(prop:tarball)s"), "--strip-components=1"],
+        command=extractTarballCmd,
         haltOnFailure=True,
         logEnviron=False,
+        doStepIf=unless_cached(),
+        hideStepIf=hide_if_skipped,
         lazylogfiles=True,
         description=["extracting tarball"],
         descriptionDone=["extract tarball"]))
 
-    # update dependencies
-    bf.addStep(ShellCommand(
-        command=dependencyCommand,
-        decodeRC={0 : SUCCESS, 1 : FAILURE, 2 : WARNINGS, 3 : SKIPPED },
-        haltOnFailure=True,
+    # record the kernel we build against, caches are keyed on it
+    bf.addStep(SetPropertyFromCommand(
+        command=["uname", "-r"],
+        property="kernelver",
         logEnviron=False,
-        doStepIf=do_step_installdeps,
-        hideStepIf=hide_if_skipped,
-        description=["installing dependencies"],
-        descriptionDone=["installed dependencies"]))
+        doStepIf=unless_cached(),
+        hideStepIf=hide_except_error,
+        haltOnFailure=True))
 
     # build spl and zfs if necessary
-    bf.addStep(ShellCommand(
+    bf.addStep(StatsShellCommand(
         command=buildzfsCommand,
+        env=slotEnv,
+        statProperties=['zfs_cache_hit', 'zfs_cache_bytes'],
         decodeRC={0 : SUCCESS, 1 : FAILURE, 2 : WARNINGS, 3 : SKIPPED },
         haltOnFailure=True,
         logEnviron=False,
-        doStepIf=do_step_zfs,
+        doStepIf=unless_cached(do_step_zfs),
         hideStepIf=hide_if_skipped,
         description=["building spl and zfs"],
         descriptionDone=["built spl and zfs"]))
 
+    # publish freshly built spl and zfs packages to the master's cache
+    bf.addStep(StatsFileUpload(
+        slavesrc="spl-zfs-pkgs.tar.gz",
+        masterdest=zfsCacheMasterDest,
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        doStepIf=unless_cached(do_step_zfs_upload),
+        hideStepIf=hide_if_skipped))
+
+    # fetch the shared compiler cache for this platform and configuration
+    bf.addStep(StatsShellCommand(
+        command=ccacheFetchCmd,
+        logEnviron=False,
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        doStepIf=unless_cached(do_step_ccache),
+        hideStepIf=hide_if_skipped,
+        description=["fetching compiler cache"],
+        descriptionDone=["fetched compiler cache"]))
+
+    # fetch the configure results of earlier builds with the same inputs
+    bf.addStep(StatsShellCommand(
+        workdir="build/lustre",
+        command=configCacheFetchCmd,
+        statProperties=['configcache_key'],
+        logEnviron=False,
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        doStepIf=unless_cached(do_step_configcache),
+        hideStepIf=hide_if_skipped,
+        description=["fetching configure cache"],
+        descriptionDone=["fetched configure cache"]))
+
     # Build Lustre 
-    bf.addStep(ShellCommand(
+    bf.addStep(DigestShellCommand(
         workdir="build/lustre",
         command=configureCmd,
+        env=buildEnv,
         haltOnFailure=True,
         logEnviron=False,
+        doStepIf=unless_cached(),
         hideStepIf=hide_if_skipped,
         lazylogfiles=True,
         description=["configuring lustre"],
         descriptionDone=["configure lustre"]))
 
-    bf.addStep(ShellCommand(
+    # publish configure results which are new to the master's cache
+    bf.addStep(StatsShellCommand(
+        workdir="build/lustre",
+        command=configCacheSaveCmd,
+        statProperties=['configcache_bytes'],
+        decodeRC={0 : SUCCESS, 1 : FAILURE, 2 : WARNINGS, 3 : SKIPPED },
+        logEnviron=False,
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        doStepIf=unless_cached(do_step_configcache),
+        hideStepIf=hide_if_skipped,
+        description=["saving configure cache"],
+        descriptionDone=["configure cache"]))
+
+    bf.addStep(StatsFileUpload(
+        workdir="build/lustre",
+        slavesrc="config.cache.upload",
+        masterdest=configCacheMasterDest,
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        doStepIf=unless_cached(do_step_configcache_upload),
+        hideStepIf=hide_if_skipped))
+
+    bf.addStep(DigestShellCommand(
         workdir="build/lustre",
         command=makeCmd,
+        env=buildEnv,
         haltOnFailure=True,
         logEnviron=False,
+        doStepIf=unless_cached(),
         hideStepIf=hide_if_skipped,
         lazylogfiles=True,
         description=["making lustre"],
         descriptionDone=["make lustre"]))
 
+    # send the new and used compiler cache entries back to the master
+    bf.addStep(StatsShellCommand(
+        command=ccacheDeltaCmd,
+        statProperties=['cache_delta_bytes'],
+        decodeRC={0 : SUCCESS, 1 : FAILURE, 2 : WARNINGS, 3 : SKIPPED },
+        logEnviron=False,
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        doStepIf=unless_cached(do_step_ccache),
+        hideStepIf=hide_if_skipped,
+        description=["packing compiler cache"],
+        descriptionDone=["compiler cache"]))
+
+    bf.addStep(StatsFileUpload(
+        slavesrc="ccache-delta.tar.gz",
+        masterdest=ccacheDeltaMasterDest,
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        doStepIf=unless_cached(do_step_ccache_upload),
+        hideStepIf=hide_if_skipped))
+
+    bf.addStep(MasterShellCommand(
+        command=ccacheMergeCmd,
+        haltOnFailure=False,
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        doStepIf=unless_cached(do_step_ccache_upload),
+        hideStepIf=hide_if_skipped,
+        description=["merging compiler cache"],
+        descriptionDone=["merged compiler cache"]))
+
     # Build Products
     bf.addStep(ShellCommand(
         workdir="build/lustre",
         command=collectProductsCmd,
         haltOnFailure=True,
         logEnviron=False,
-        doStepIf=do_step_collectpacks,
+        doStepIf=unless_cached(do_step_collectpacks),
         hideStepIf=hide_if_skipped,
         lazylogfiles=True,
         description=["collect deliverables"],
         descriptionDone=["collected deliverables"]))
 
-    # Build repo
-    bf.addStep(ShellCommand(
-        workdir="build/lustre/deliverables",
+    # Upload repo to master
+    bf.addStep(StatsDirectoryUpload(
+        workdir="build/lustre",
+        doStepIf=unless_cached(do_step_collectpacks),
+        hideStepIf=hide_if_skipped,
+        slavesrc="deliverables",
+        masterdest=repoStagingMasterDest,
+        url=repoUrl))
+
+    # publish the deliverables, sharing files identical to earlier builds'
+    bf.addStep(IngestArtifacts(
+        src=repoStagingMasterDest,
+        dest=repoMasterDest,
+        haltOnFailure=True,
+        doStepIf=unless_cached(do_step_collectpacks),
+        hideStepIf=hide_if_skipped))
+
+    # update the published repository and the rolling one of the branch
+    bf.addStep(StatsMasterShellCommand(
         command=buildRepoCmd,
         haltOnFailure=True,
-        logEnviron=False,
         doStepIf=do_step_buildrepo,
         hideStepIf=hide_if_skipped,
-        lazylogfiles=True,
         description=["building repo"],
         descriptionDone=["build repo"]))
 
-    # Upload repo to master
-    bf.addStep(DirectoryUpload(
-        workdir="build/lustre",
-        doStepIf=do_step_collectpacks,
-        hideStepIf=hide_if_skipped,
-        slavesrc="deliverables",
-        masterdest=repoMasterDest,
-        url=repoUrl))
+    # let later builds of the same source reuse the packages
+    bf.addStep(SaveResult(
+        kind='package',
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        hideStepIf=hide_except_error))
+
+    # let later builds prefer this slave while it is warm
+    bf.addStep(RecordSlaveState(
+        state=slaveWarmState,
+        flunkOnFailure=False,
+        hideStepIf=hide_except_error))
 
     # Cleanup
     bf.addStep(ShellCommand(
         workdir="build",
-        command=["sh", "-c", "rm -rvf ./* /tmp/rpmbuild-*"],
+        command=cleanupCmd,
         haltOnFailure=True,
         logEnviron=False,
         lazylogfiles=True,
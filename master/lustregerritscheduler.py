@@ -0,0 +1,123 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+from twisted.internet import defer
+from twisted.python import log
+from buildbot.process.buildrequest import BuildRequest
+from buildbot.process.properties import Properties
+from buildbot.schedulers.basic import AnyBranchScheduler
+
+def getPatchset(props):
+    # the change number and patchset number of a Gerrit change, or None
+    try:
+        return (int(props['event.change.number'][0]),
+                int(props['event.patchSet.number'][0]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+@defer.inlineCallbacks
+def supersededBy(master, change, patchset):
+    """Returns a Deferred firing with the newest patchset of a change which
+    has an incomplete buildset, if it is newer than the given patchset, or
+    None if the patchset is still current.
+
+    This is read from the properties of the buildsets in the database, so it
+    holds across restarts of the master."""
+    try:
+        change, patchset = int(change), int(patchset)
+    except (TypeError, ValueError):
+        defer.returnValue(None)
+        return
+
+    newest = None
+    db = master.db
+    for bsdict in (yield db.buildsets.getBuildsets(complete=False)):
+        props = yield db.buildsets.getBuildsetProperties(bsdict['bsid'])
+        other = getPatchset(props)
+        if other is not None and other[0] == change and other[1] > patchset:
+            newest = max(newest, other[1])
+    defer.returnValue(newest)
+
+class LustreGerritScheduler(AnyBranchScheduler):
+
+    """Schedules builds for Gerrit patchsets, superseding older patchsets.
+
+    When a change arrives for a new patchset, the pending build requests of all
+    incomplete buildsets for older patchsets of the same change are cancelled.
+    This includes the buildsets the older patchsets' builds triggered, which
+    must copy the 'event.change.number' and 'event.patchSet.number' properties
+    this scheduler adds to its buildsets. If stopBuilds is True, builds already
+    running for those buildsets are stopped too.
+
+    Steps and status targets can check whether a patchset was superseded with
+    supersededBy(), for instance to skip triggering more builds or to report
+    the patchset as superseded instead of failed.
+    """
+
+    compare_attrs = ['supersede', 'stopBuilds']
+
+    def __init__(self, name, supersede=True, stopBuilds=False, **kwargs):
+        self.supersede = supersede
+        self.stopBuilds = stopBuilds
+
+        AnyBranchScheduler.__init__(self, name, **kwargs)
+
+    @defer.inlineCallbacks
+    def addBuildsetForChanges(self, reason='', external_idstring=None,
+                              changeids=[], builderNames=None, properties=None):
+        patchset = None
+        for changeid in changeids:
+            chdict = yield self.master.db.changes.getChange(changeid)
+            patchset = getPatchset(chdict['properties']) or patchset
+
+        if patchset is not None:
+            if properties is None:
+                properties = Properties()
+            properties.setProperty('event.change.number', patchset[0], self.name)
+            properties.setProperty('event.patchSet.number', patchset[1], self.name)
+
+            if self.supersede:
+                yield self.supersedeOlder(*patchset)
+
+        rv = yield AnyBranchScheduler.addBuildsetForChanges(self,
+                reason=reason, external_idstring=external_idstring,
+                changeids=changeids, builderNames=builderNames,
+                properties=properties)
+        defer.returnValue(rv)
+
+    @defer.inlineCallbacks
+    def supersedeOlder(self, change, patchset):
+        db = self.master.db
+
+        older = {}
+        for bsdict in (yield db.buildsets.getBuildsets(complete=False)):
+            props = yield db.buildsets.getBuildsetProperties(bsdict['bsid'])
+            other = getPatchset(props)
+            if other is not None and other[0] == change and other[1] < patchset:
+                older[bsdict['bsid']] = other[1]
+
+        if not older:
+            return
+
+        cancelled = 0
+        for bsid in older:
+            brdicts = yield db.buildrequests.getBuildRequests(bsid=bsid,
+                                                              claimed=False)
+            for brdict in brdicts:
+                br = yield BuildRequest.fromBrdict(self.master, brdict)
+                yield br.cancelBuildRequest()
+                cancelled += 1
+
+        stopped = 0
+        if self.stopBuilds:
+            reason = "superseded by patchset %d" % patchset
+            for builder in self.master.botmaster.builders.values():
+                for build in builder.building:
+                    if [r for r in build.requests if r.bsid in older]:
+                        build.stopBuild(reason)
+                        stopped += 1
+
+        log.msg("%s: change %d patchset %d superseded patchset(s) %s, "
+                "cancelled %d request(s), stopped %d build(s)" %
+                (self.name, change, patchset, sorted(set(older.values())),
+                 cancelled, stopped))
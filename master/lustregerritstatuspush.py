@@ -1,40 +1,359 @@
+import os
+import time
+
 from buildbot.status.status_gerrit import GerritStatusPush
+from buildbot.status.status_gerrit import _old_add_label, _new_add_label
+from buildbot.status.results import EXCEPTION
+from distutils.version import LooseVersion
+from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.internet import utils
+from twisted.python import log
+
+from lustregerritscheduler import supersededBy
 
 class LustreGerritStatusPush(GerritStatusPush):
 
-    def __init__(self, notify="OWNER", **kwargs):
+    """Pushes build results to Gerrit through a queue of reviews.
+
+    All ssh commands share one multiplexed connection to the Gerrit server
+    (OpenSSH ControlMaster), kept open for controlPersist seconds after the last
+    command, so a review does not pay for its own handshake. The connection is
+    started by an ssh of its own, detached from the master's pipes, and the
+    commands only use it, so waiting for their output never waits for it to
+    close. A command connects directly when the connection is not up. Set
+    controlPath to None to disable multiplexing.
+
+    Reviews are queued per revision and at most maxConcurrentReviews are sent
+    at once. A review queued for a revision which already has one waiting has
+    its message and labels merged into the waiting one. A failed review is
+    retried up to maxRetries times, waiting retryDelay seconds and doubling
+    that up to maxRetryDelay for each further retry. Counters for sent, failed,
+    retried and coalesced reviews and the send latency are kept in reviewStats.
+
+    sshCommand replaces the ssh binary, for example with tests/fake-gerrit.sh
+    acting as a local fake Gerrit server.
+    """
+
+    def __init__(self, notify="OWNER", sshCommand="ssh",
+                 controlPath="~/.ssh/bb-gerrit-%r@%h:%p", controlPersist=600,
+                 maxConcurrentReviews=2, maxRetries=5, retryDelay=30,
+                 maxRetryDelay=600, **kwargs):
         self.gerrit_notify = notify
+        self.sshCommand = sshCommand
+        self.controlPath = controlPath and os.path.expanduser(controlPath)
+        self.controlPersist = controlPersist
+        self.maxConcurrentReviews = maxConcurrentReviews
+        self.maxRetries = maxRetries
+        self.retryDelay = retryDelay
+        self.maxRetryDelay = maxRetryDelay
+
+        # (project, revision) -> review waiting to be sent, in queue order
+        self.reviewQueue = {}
+        self.reviewOrder = []
+        self.reviewsInFlight = set()
+        self.retryTimers = set()
+        self.versionTimer = None
+        self.controlStarting = None
+        self.reviewStats = {
+            'queued': 0,
+            'coalesced': 0,
+            'sent': 0,
+            'failed': 0,
+            'retried': 0,
+            'dropped': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+        }
 
         GerritStatusPush.__init__(self, **kwargs)
 
+    def _sshOptions(self):
+        # commands never become the master, a persisting master would keep
+        # their output open
+        if not self.controlPath:
+            return []
+
+        return ['-o', 'ControlMaster=no',
+                '-o', 'ControlPath=%s' % self.controlPath]
+
+    def _gerritCmd(self, *args):
+        command = [self.sshCommand] + self._sshOptions()
+
+        if self.gerrit_identity_file is not None:
+            command.extend(['-i', self.gerrit_identity_file])
+
+        command.extend(['@'.join((self.gerrit_username, self.gerrit_server)),
+                        '-p', str(self.gerrit_port), 'gerrit'])
+        command.extend(args)
+
+        return command
+
+    def _controlCmd(self):
+        command = [self.sshCommand, '-f', '-N', '-M',
+                   '-o', 'ControlPath=%s' % self.controlPath,
+                   '-o', 'ControlPersist=%d' % self.controlPersist]
+
+        if self.gerrit_identity_file is not None:
+            command.extend(['-i', self.gerrit_identity_file])
+
+        command.extend(['@'.join((self.gerrit_username, self.gerrit_server)),
+                        '-p', str(self.gerrit_port)])
+
+        # the master stays in the background with nothing of ours open
+        return ['sh', '-c', 'exec "$0" "$@" </dev/null >/dev/null 2>&1'] + command
+
+    def _startControlMaster(self):
+        """Starts the shared connection unless it is up. Returns a Deferred
+        firing once it is up, or once starting it failed."""
+        if not self.controlPath or os.path.exists(self.controlPath):
+            return defer.succeed(None)
+
+        if self.controlStarting is None:
+            command = self._controlCmd()
+            self.controlStarting = utils.getProcessValue(command[0],
+                command[1:], env=os.environ)
+
+            def started(code):
+                self.controlStarting = None
+                if code != 0:
+                    log.msg("gerrit: cannot start the shared ssh connection "
+                            "(exit %d), connecting directly" % code)
+            self.controlStarting.addCallback(started)
+            self.controlStarting.addErrback(log.err,
+                "gerrit: cannot start the shared ssh connection")
+
+        # every caller waits, but only for the start itself
+        d = defer.Deferred()
+        def notify(res):
+            d.callback(None)
+            return res
+        self.controlStarting.addBoth(notify)
+        return d
+
+    def stopService(self):
+        if self.versionTimer is not None and self.versionTimer.active():
+            self.versionTimer.cancel()
+
+        for timer in self.retryTimers:
+            if timer.active():
+                timer.cancel()
+        self.retryTimers.clear()
+
+        if self.reviewOrder:
+            log.msg("gerrit: dropping %d queued review(s) on shutdown" %
+                    len(self.reviewOrder))
+
+        # close the shared connection rather than leave it to ControlPersist
+        if self.controlPath and os.path.exists(self.controlPath):
+            command = [self.sshCommand] + self._sshOptions() + ['-O', 'exit',
+                '-p', str(self.gerrit_port),
+                '@'.join((self.gerrit_username, self.gerrit_server))]
+            utils.getProcessOutputAndValue(command[0], command[1:],
+                                           env=os.environ)
+
+        return GerritStatusPush.stopService(self)
+
     def sendCodeReview(self, project, revision, result):
+        message = result.get('message', None)
+        labels = result.get('labels', None)
+        if not message and not labels:
+            return
+
+        key = (str(project), str(revision))
+        self.reviewStats['queued'] += 1
+
+        review = self.reviewQueue.get(key)
+        if review is not None:
+            # one review carries everything still waiting for this revision
+            self.reviewStats['coalesced'] += 1
+            if message:
+                review['messages'].append(message)
+            review['labels'].update(labels or {})
+        else:
+            self.reviewQueue[key] = {
+                'messages': [message] if message else [],
+                'labels': dict(labels or {}),
+                'attempts': 0,
+                'queued_at': time.time(),
+            }
+            self.reviewOrder.append(key)
+
+        self._dispatchReviews()
+
+    def _dispatchReviews(self):
         gerrit_version = self.getCachedVersion()
         if gerrit_version is None:
-            self.callWithVersion(lambda: self.sendCodeReview(project, revision,
-                                                             result))
+            # look the version up once, and again if that gets no answer
+            if self.reviewOrder and self.versionTimer is None:
+                self.versionTimer = reactor.callLater(self.retryDelay,
+                                                      self._versionFound)
+                self.callWithVersion(self._versionFound)
             return
 
-        command = self._gerritCmd("review", "--project %s" % str(project))
+        # one review per revision at a time keeps them in order on Gerrit
+        for key in list(self.reviewOrder):
+            if len(self.reviewsInFlight) >= self.maxConcurrentReviews:
+                break
+            if key in self.reviewsInFlight:
+                continue
+            if self.reviewQueue[key].get('retry_at', 0) > time.time():
+                continue
+
+            self.reviewOrder.remove(key)
+            review = self.reviewQueue.pop(key)
+            self._sendReview(key, review, gerrit_version)
+
+    def _versionFound(self):
+        if self.versionTimer is not None and self.versionTimer.active():
+            self.versionTimer.cancel()
+        self.versionTimer = None
+        self._dispatchReviews()
+
+    def _reviewCmd(self, key, review, gerrit_version):
+        project, revision = key
+        command = self._gerritCmd("review", "--project %s" % project)
 
         if self.gerrit_notify is not None:
             command.extend(["--notify %s" % str(self.gerrit_notify)])
 
-        message = result.get('message', None)
+        message = '\n\n'.join(review['messages'])
         if message:
             command.append("--message '%s'" % message.replace("'", "\""))
 
-        labels = result.get('labels', None)
-        if labels:
-            assert gerrit_version
+        if review['labels']:
             if gerrit_version < LooseVersion("2.6"):
                 add_label = _old_add_label
             else:
                 add_label = _new_add_label
 
-            for label, value in labels.items():
+            for label, value in review['labels'].items():
                 command.extend(add_label(label, value))
 
-        command.append(str(revision))
-        print command
-        reactor.spawnProcess(self.LocalPP(self), command[0], command)
+        command.append(revision)
+        return command
+
+    def _sendReview(self, key, review, gerrit_version):
+        command = self._reviewCmd(key, review, gerrit_version)
+        review['attempts'] += 1
+        started = time.time()
+        self.reviewsInFlight.add(key)
+
+        d = self._startControlMaster()
+        d.addCallback(lambda _: utils.getProcessOutputAndValue(command[0],
+            command[1:], env=os.environ))
+
+        def done(res):
+            out, err, code = res
+            self.reviewsInFlight.discard(key)
+            if code == 0:
+                latency = time.time() - started
+                self.reviewStats['sent'] += 1
+                self.reviewStats['latency_total'] += latency
+                self.reviewStats['latency_max'] = \
+                    max(self.reviewStats['latency_max'], latency)
+                log.msg("gerrit: review of %s sent in %.1fs, %.1fs after "
+                        "queueing (attempt %d)" % (key[1], latency,
+                        time.time() - review['queued_at'], review['attempts']))
+            else:
+                self._reviewFailed(key, review, "exit %d: %s" %
+                                   (code, err.strip() or out.strip()))
+        d.addCallback(done)
+
+        def failed(why):
+            self.reviewsInFlight.discard(key)
+            self._reviewFailed(key, review, why.getErrorMessage())
+        d.addErrback(failed)
+
+        d.addBoth(lambda _: self._dispatchReviews())
+
+    def _reviewFailed(self, key, review, why):
+        self.reviewStats['failed'] += 1
+
+        if review['attempts'] > self.maxRetries:
+            self.reviewStats['dropped'] += 1
+            log.msg("gerrit: giving up on review of %s after %d attempts: %s" %
+                    (key[1], review['attempts'], why))
+            return
+
+        delay = min(self.retryDelay * 2 ** (review['attempts'] - 1),
+                    self.maxRetryDelay)
+        log.msg("gerrit: review of %s failed (%s), retrying in %ds" %
+                (key[1], why, delay))
+
+        # the review keeps its place, later reviews of the revision join it
+        newer = self.reviewQueue.pop(key, None)
+        if newer is not None:
+            self.reviewOrder.remove(key)
+            review['messages'].extend(newer['messages'])
+            review['labels'].update(newer['labels'])
+
+        review['retry_at'] = time.time() + delay
+        self.reviewQueue[key] = review
+        self.reviewOrder.insert(0, key)
+
+        def retry():
+            self.retryTimers.discard(timer)
+            self.reviewStats['retried'] += 1
+            self._dispatchReviews()
+
+        timer = reactor.callLater(delay, retry)
+        self.retryTimers.add(timer)
+
+    @defer.inlineCallbacks
+    def getSupersededBy(self, buildset, builds):
+        """Returns a Deferred firing with the patchset which superseded the
+        one the buildset built, if superseding it cancelled any of its build
+        requests or stopped any of its builds, or None."""
+        build = builds[0]
+        newer = yield supersededBy(self.master,
+                                   build.getProperty('event.change.number'),
+                                   build.getProperty('event.patchSet.number'))
+        if newer is None:
+            defer.returnValue(None)
+            return
+
+        # a cancelled request completes without a build
+        breqs = yield self.master.db.buildrequests.getBuildRequests(
+            bsid=buildset['bsid'])
+        requested = {}
+        for breq in breqs:
+            requested[breq['buildername']] = requested.get(breq['buildername'], 0) + 1
+        built = {}
+        for build in builds:
+            name = build.getBuilder().getName()
+            built[name] = built.get(name, 0) + 1
+
+        cancelled = [name for name, count in requested.items()
+                     if count > built.get(name, 0)]
+        stopped = [build for build in builds if build.getResults() == EXCEPTION]
+        if cancelled or stopped:
+            defer.returnValue(newer)
+        else:
+            defer.returnValue(None)
+
+    @defer.inlineCallbacks
+    def sendBuildSetSummary(self, buildset, builds):
+        # each build info also holds the build, so the summaryCB can look at
+        # its properties, and under 'superseded' what getSupersededBy() says
+        summaryCB = self.summaryCB
+        if not summaryCB:
+            return
+
+        superseded = yield self.getSupersededBy(buildset, builds)
+        byURL = dict((self.master_status.getURLForThing(build), build)
+                     for build in builds)
+        byName = dict((build.getBuilder().getName(), build) for build in builds)
+
+        def withBuilds(buildInfoList, *args):
+            for buildInfo in buildInfoList:
+                buildInfo['build'] = byURL.get(buildInfo['url']) or \
+                    byName.get(buildInfo['name'])
+                buildInfo['superseded'] = superseded
+            return summaryCB(buildInfoList, *args)
+
+        self.summaryCB = withBuilds
+        try:
+            GerritStatusPush.sendBuildSetSummary(self, buildset, builds)
+        finally:
+            self.summaryCB = summaryCB
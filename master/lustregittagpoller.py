@@ -1,8 +1,8 @@
 # -*- python -*-
 # ex: set syntax=python:
 
-import itertools
 import os
+import re
 
 from buildbot import config
 from twisted.internet import defer
@@ -21,12 +21,30 @@ class LustreTagPoller(GitPoller):
     tags associated revision (SHA). On each poll iteration, all references are
     checked against the prior set. A tag is considered new if it doesn't exist in
     the set. A tag is considered change when the tag has been seen but its revision
-    has changed. The set is maintain in the buildbot master's database.
+    has changed. A tag is considered removed when it is in the set but no longer
+    exists in the remote repository. The set is maintain in the buildbot master's
+    database and is only written back when a tag was added, changed or removed.
+
+    If incremental is True (the default), the remote tags are listed with
+    'git ls-remote' and compared against the prior set before anything is
+    fetched. Only new or moved tags are fetched and nothing is fetched at all
+    when no tag has changed. This keeps a short pollInterval cheap for both the
+    master and the remote. If incremental is False, every poll fetches all tags.
 
     If workdir is None, 'lustretagpoller-work' becomes the working directory for
     this poller. The branch and branches arguments are not accepted by this class."""
 
-    def __init__(self, **kwargs):
+    compare_attrs = GitPoller.compare_attrs + ["incremental"]
+
+    # number of revisions whose metadata is collected by a single git log
+    batchSize = 500
+
+    # number of changes submitted to the build master at the same time
+    maxConcurrentChanges = 8
+
+    def __init__(self, incremental=True, **kwargs):
+        self.incremental = incremental
+
         if kwargs.get('workdir') is None:
             kwargs['workdir'] = 'lustretagpoller-work'
 
@@ -62,50 +80,145 @@ class LustreTagPoller(GitPoller):
 
         return d
 
+    def _getRemoteRefs(self):
+        """Collect and parse all remote tag references without fetching"""
+
+        d = self._dovccmd('ls-remote', ['--tags', self.repourl])
+
+        @d.addCallback
+        def parseRemoteRefs(rows):
+            refs = {}
+            for row in rows.splitlines():
+                if '\t' not in row:
+                    continue
+
+                sha, ref = row.split('\t')
+
+                # skip the peeled commit of annotated tags, show-ref doesn't list them
+                if ref.endswith('^{}'):
+                    continue
+
+                if not self._filter_ref(ref):
+                    refs[ref] = sha
+
+            return refs
+
+        return d
+
+    @defer.inlineCallbacks
+    def _fetchRefs(self):
+        """Fetch only the tags which are new or have moved since the last poll
+
+        Returns all remote tag references, including those left unfetched."""
+
+        remoteRefs = yield self._getRemoteRefs()
+
+        changedRefs = dict((ref, sha) for ref, sha in remoteRefs.iteritems()
+                           if self.lastRev.get(ref) != sha)
+
+        if not changedRefs:
+            log.msg("LustreTagPoller: no new or changed tags, skipping fetch")
+            defer.returnValue(remoteRefs)
+
+        # initial run, seed the object store with a single fetch of all tags
+        if not self.lastRev:
+            log.msg("LustreTagPoller: fetch --tags")
+            yield self._dovccmd('fetch', ['--tags', self.repourl], path=self.workdir)
+            defer.returnValue(remoteRefs)
+
+        log.msg("LustreTagPoller: fetching %d new or changed tag(s)" % len(changedRefs))
+        refspecs = ['+%s:%s' % (ref, ref) for ref in sorted(changedRefs)]
+        yield self._dovccmd('fetch', ['--no-tags', self.repourl] + refspecs,
+                            path=self.workdir)
+
+        defer.returnValue(remoteRefs)
+
     def _filter_ref(self, ref):
         """Filter refs that are not tags"""
         return not ref.startswith("refs/tags/")
 
+    def _decode_file(self, file):
+        # git use octal char sequences in quotes when non ASCII
+        match = re.match('^"(.*)"$', file)
+        if match:
+            file = match.groups()[0].decode('string_escape')
+        return self._decode(file)
+
     @defer.inlineCallbacks
-    def _process_change(self, ref, rev):
-        """Determines if a tag should be submitted to build master as a change """
-        # initial run, don't parse all history
-        if not self.lastRev:
-            return
+    def _get_commit_metadata(self, revs):
+        """Collect the timestamp, author, files and comments of many revisions
 
-        # if a tag has been previously seen, and it's revision hasn't changes, there's nothing to process
-        if ref in self.lastRev and self.lastRev[ref] == rev:
+        A single rev-parse and a single log are run for each batch of revisions
+        rather than four log processes per revision. Returns a dictionary of
+        revision to (timestamp, author, files, comments)."""
+
+        metadata = {}
+        for i in xrange(0, len(revs), self.batchSize):
+            batch = revs[i:i + self.batchSize]
+
+            # annotated tags reference a tag object, peel them to their commit
+            peeled = yield self._dovccmd('rev-parse', ['%s^{commit}' % rev for rev in batch],
+                                         path=self.workdir)
+            commits = dict(zip(batch, peeled.split()))
+
+            args = ['--no-walk=unsorted', '--name-only',
+                    r'--format=%x1e%H%x1f%ct%x1f%aN <%aE>%x1f%s%n%b%x1f']
+            args.extend(sorted(set(commits.values())))
+            args.append('--')
+            output = yield self._dovccmd('log', args, path=self.workdir)
+
+            records = {}
+            for record in output.split('\x1e')[1:]:
+                sha, timestamp, author, comments, files = record.split('\x1f')
+
+                if self.usetimestamps:
+                    timestamp = float(timestamp)
+                else:
+                    timestamp = None
+
+                author = self._decode(author)
+                if len(author) == 0:
+                    raise EnvironmentError('could not get commit author for rev %s' % sha)
+
+                files = [self._decode_file(f) for f in files.splitlines() if len(f)]
+                records[sha] = (timestamp, author, files, self._decode(comments.strip()))
+
+            for rev, sha in commits.iteritems():
+                metadata[rev] = records[sha]
+
+        defer.returnValue(metadata)
+
+    @defer.inlineCallbacks
+    def _process_changes(self, changed):
+        """Submits new or changed tags to the build master as changes """
+        # initial run, don't parse all history
+        if not self.lastRev or not changed:
             return
 
-        log.msg('LustreTagPoller: processing %s(%s) from "%s"'% (ref, rev, self.repourl))
-
-        dl = defer.DeferredList([
-            self._get_commit_timestamp(rev),
-            self._get_commit_author(rev),
-            self._get_commit_files(rev),
-            self._get_commit_comments(rev),
-        ], consumeErrors=True)
-
-        results = yield dl
-
-        # check for failures
-        failures = [r[1] for r in results if not r[0]]
-        if failures:
-            # just fail on the first error; they're probably all related!
-            raise failures[0]
-
-        timestamp, author, files, comments = [r[1] for r in results]
-        yield self.master.addChange(
-            author=author,
-            revision=rev,
-            files=files,
-            comments=comments,
-            when_timestamp=epoch2datetime(timestamp),
-            branch=ref,
-            category=self.category,
-            project=self.project,
-            repository=self.repourl,
-            src='git')
+        log.msg('LustreTagPoller: processing %d tag(s) from "%s": %s' %
+                (len(changed), self.repourl, sorted(changed)))
+
+        metadata = yield self._get_commit_metadata(sorted(set(changed.values())))
+
+        def addChange(ref, rev):
+            timestamp, author, files, comments = metadata[rev]
+            return self.master.addChange(
+                author=author,
+                revision=rev,
+                files=files,
+                comments=comments,
+                when_timestamp=epoch2datetime(timestamp),
+                branch=ref,
+                category=self.category,
+                project=self.project,
+                repository=self.repourl,
+                src='git')
+
+        # submit the oldest tags first, with a bounded number in flight
+        sem = defer.DeferredSemaphore(self.maxConcurrentChanges)
+        dl = [sem.run(addChange, ref, rev) for ref, rev in
+              sorted(changed.iteritems(), key=lambda (ref, rev): (metadata[rev][0], ref))]
+        yield defer.gatherResults(dl, consumeErrors=True)
 
     @defer.inlineCallbacks
     def poll(self):
@@ -113,16 +226,32 @@ class LustreTagPoller(GitPoller):
         if not os.path.exists(self.workdir):
             yield self._dovccmd('init', ['--bare', self.workdir])
 
-        log.msg("LustreTagPoller: fetch --tags")
-        yield self._dovccmd('fetch', ['--tags', self.repourl], path=self.workdir)
+        if self.incremental:
+            newRefs = yield self._fetchRefs()
+        else:
+            log.msg("LustreTagPoller: fetch --tags")
+            yield self._dovccmd('fetch', ['--tags', '--prune', self.repourl],
+                                path=self.workdir)
+
+            newRefs = yield self._getRefs()
 
-        newRefs = yield self._getRefs()
+        # if a tag has been previously seen, and it's revision hasn't changes, there's nothing to process
+        changedRefs = dict((ref, sha) for ref, sha in newRefs.iteritems()
+                           if self.lastRev.get(ref) != sha)
+        removedRefs = [ref for ref in self.lastRev if ref not in newRefs]
 
         log.msg("LustreTagPoller: processing tags")
-        for ref, sha in newRefs.iteritems():
-            yield self._process_change(ref, sha)
+        yield self._process_changes(changedRefs)
+
+        # only write the state back when the set of tags actually changed
+        if changedRefs or removedRefs:
+            log.msg("LustreTagPoller: saving state, %d new or changed and %d removed tag(s)" %
+                    (len(changedRefs), len(removedRefs)))
+
+            self.lastRev.update(changedRefs)
+            for ref in removedRefs:
+                del self.lastRev[ref]
 
-        self.lastRev.update(newRefs)
-        yield self.setState('lastRev', self.lastRev)
+            yield self.setState('lastRev', self.lastRev)
 
         log.msg("LustreTagPoller: poll iteration complete")
@@ -0,0 +1,71 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+import re
+
+from buildbot.schedulers.triggerable import Triggerable
+
+def compileRules(rules):
+    """Compiles the patterns of a list of (description, pattern, selector)
+    impact rules, see analyzeImpact()."""
+    return [(description, re.compile(pattern), selector)
+            for description, pattern, selector in rules]
+
+def selects(selector, props):
+    # None selects no builder, a dict the builders with all of its properties
+    if selector is None:
+        return False
+    return all(props.get(name) == value for name, value in selector.items())
+
+def analyzeImpact(files, builders, rules):
+    """Decides which builders a change to the given files needs.
+
+    builders maps the names of the candidate builders to their properties.
+    rules is a list of (description, pattern, selector) tuples, of which the
+    first whose pattern matches a file from its start decides which builders
+    that file needs: None for no builder at all, or a dict of properties a
+    builder must have (for example {'withzfs': 'yes'}). A file no rule matches
+    needs every builder, as does an empty list of files.
+
+    Returns the list of needed builder names and a dict mapping the names of
+    the others to the reason they are not needed.
+    """
+    rules = compileRules(rules)
+    if not files:
+        return sorted(builders), {}
+
+    needed = set()
+    matched = []
+    for f in files:
+        for description, pattern, selector in rules:
+            if pattern.match(f):
+                needed.update(name for name, props in builders.items()
+                              if selects(selector, props))
+                if description not in matched:
+                    matched.append(description)
+                break
+        else:
+            return sorted(builders), {}
+
+    reason = "the change only touches %s" % ", ".join(matched)
+    skipped = dict((name, reason) for name in builders if name not in needed)
+    return sorted(needed), skipped
+
+class LustreImpactTriggerable(Triggerable):
+
+    """Triggerable scheduler which only builds the builders a change needs.
+
+    When the triggering build passes the 'impacted_builders' property, the
+    buildset only holds requests for those of its builders, so the builds
+    still share a single buildset and a single summary. Without the property
+    all builders are requested, as for tags which always build everything.
+    """
+
+    def addBuildsetForSourceStampSetDetails(self, reason, sourcestamps,
+                                            properties, builderNames=None):
+        impacted = properties.getProperty('impacted_builders')
+        if builderNames is None and impacted is not None:
+            builderNames = [name for name in self.builderNames if name in impacted]
+
+        return Triggerable.addBuildsetForSourceStampSetDetails(
+            self, reason, sourcestamps, properties, builderNames=builderNames)
@@ -0,0 +1,219 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Instance types and spot prices for choosing the instance of a latent slave.
+#
+# A price feed tells LustreEC2Slave the current hourly spot price of the
+# instance types it may start. Together with the build durations recorded per
+# instance type, InstanceCostPolicy (see lustrescheduling) then picks the type
+# and bid for every instance it boots. Run this file to try a choice without
+# AWS, for example:
+#
+#   python lustreinstances.py --prices spot-prices.json --deadline 5400 \
+#       --durations '{"m3.large": 3000}' m3.large m3.xlarge c4.2xlarge
+
+import json
+import optparse
+import os
+import sys
+import time
+
+from twisted.internet import threads
+from twisted.python import log
+
+from lustrescheduling import InstanceCostPolicy, scaleDuration
+
+# vCPUs and MiB of memory of the instance types build slots and unmeasured
+# build durations are sized from
+instance_resources = {
+    "m3.large"    : (2, 7680),
+    "m3.xlarge"   : (4, 15360),
+    "m3.2xlarge"  : (8, 30720),
+    "c4.2xlarge"  : (8, 15360),
+    "c4.4xlarge"  : (16, 30720),
+    "c4.8xlarge"  : (36, 61440),
+    "m4.2xlarge"  : (8, 32768),
+    "m4.4xlarge"  : (16, 65536),
+    "m4.10xlarge" : (40, 163840),
+}
+
+def averagePrices(prices):
+    """Returns the average price of each instance type of a sequence of
+    (instance type, price) tuples"""
+    totals = {}
+    for instance_type, price in prices:
+        total, count = totals.get(instance_type, (0.0, 0))
+        totals[instance_type] = (total + float(price), count + 1)
+    return dict((t, total / count) for t, (total, count) in totals.items())
+
+def parsePrices(data, zone=None):
+    """Returns the prices of a price file: either a JSON object mapping
+    instance types to hourly prices, or the output of 'aws ec2
+    describe-spot-price-history', which is averaged per instance type over
+    the entries of the given availability zone (or all of them)."""
+    if 'SpotPriceHistory' not in data:
+        return dict((t, float(price)) for t, price in data.items())
+
+    return averagePrices((p['InstanceType'], p['SpotPrice'])
+                         for p in data['SpotPriceHistory']
+                         if zone is None or p.get('AvailabilityZone') == zone)
+
+class PriceFeed(object):
+    """Source of the current hourly spot prices of instance types.
+
+    getPrices() returns a dict mapping those of the given instance types whose
+    price it knows to that price, or a Deferred firing with one. The slave
+    asking is passed along for feeds which need its EC2 connection."""
+
+    def getPrices(self, slave, instance_types):
+        # knows no prices, the slaves start their configured type and bid
+        return {}
+
+class StaticPriceFeed(PriceFeed):
+    """Fixed prices, for testing or for the prices of on demand instances"""
+
+    def __init__(self, prices):
+        self.prices = dict(prices)
+
+    def getPrices(self, slave, instance_types):
+        return dict((t, float(self.prices[t])) for t in instance_types
+                    if t in self.prices)
+
+class FilePriceFeed(PriceFeed):
+    """Prices read from a JSON file, see parsePrices().
+
+    The file is read again whenever it changes, for example when a cron job
+    such as updateSpotPrices.sh refreshes it. A spot price history is
+    averaged over the entries of zone, by default the availability zone the
+    slave asking launches its instances in. A missing file, or one not
+    updated for max_age seconds, gives no prices, so the slaves fall back to
+    their configured instance type and bid."""
+
+    def __init__(self, path, zone=None, max_age=6 * 60 * 60):
+        self.path = path
+        self.zone = zone
+        self.max_age = max_age
+        self.mtime = None
+        self.data = {}
+        self.prices = {}
+
+    def load(self, zone):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return {}
+
+        if self.max_age and time.time() - mtime > self.max_age:
+            log.msg("spot prices in %s are stale, ignoring them" % self.path)
+            return {}
+
+        if mtime != self.mtime:
+            with open(self.path) as f:
+                self.data = json.load(f)
+            self.mtime = mtime
+            self.prices = {}
+        if zone not in self.prices:
+            self.prices[zone] = parsePrices(self.data, zone)
+        return self.prices[zone]
+
+    def getPrices(self, slave, instance_types):
+        zone = self.zone or getattr(slave, 'placement', None)
+        prices = self.load(zone)
+        return dict((t, prices[t]) for t in instance_types if t in prices)
+
+class EC2PriceFeed(PriceFeed):
+    """Spot prices averaged over the last hours from the EC2 API, queried
+    with the connection and availability zone of the slave asking, as
+    EC2LatentBuildSlave does for its own bid."""
+
+    def __init__(self, hours=24):
+        self.hours = hours
+
+    def getPrices(self, slave, instance_types):
+        return threads.deferToThread(self._getPrices, slave, instance_types)
+
+    def _getPrices(self, slave, instance_types):
+        start = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                              time.gmtime(time.time() - self.hours * 60 * 60))
+        history = slave.conn.get_spot_price_history(start_time=start,
+            product_description=getattr(slave, 'product_description',
+                                        'Linux/UNIX (Amazon VPC)'),
+            availability_zone=slave.placement)
+        return averagePrices((p.instance_type, p.price) for p in history
+                             if p.instance_type in instance_types)
+
+def instanceCandidates(instance_types, measured, prices, boot_seconds,
+                       default_type, default_seconds=30 * 60):
+    """Returns the candidates for InstanceCostPolicy among instance_types.
+
+    measured maps the instance types builds were timed on to their expected
+    build duration. The duration on any other type is scaled by vCPUs from
+    the measured type closest to it in size, or from default_seconds on
+    default_type while nothing has been measured. A type of unknown size is
+    only a candidate once measured."""
+    reference = measured or {default_type: default_seconds}
+
+    candidates = []
+    for t in instance_types:
+        if t in reference:
+            seconds = reference[t]
+        else:
+            known = [r for r in reference if r in instance_resources]
+            if t not in instance_resources or not known:
+                continue
+            cpus = instance_resources[t][0]
+            ref = min(known, key=lambda r: abs(instance_resources[r][0] - cpus))
+            seconds = scaleDuration(reference[ref], instance_resources[ref][0],
+                                    cpus)
+
+        candidates.append({
+            'instance_type': t,
+            'seconds': int(seconds),
+            'measured': t in measured,
+            'price': prices.get(t),
+            'boot_seconds': int(boot_seconds),
+        })
+    return candidates
+
+def main(args):
+    parser = optparse.OptionParser(
+        usage="%prog --prices FILE [options] instance_type...")
+    parser.add_option("--prices", help="JSON price file, see parsePrices()")
+    parser.add_option("--zone", default=None,
+                      help="availability zone of a spot price history")
+    parser.add_option("--durations", default="{}",
+                      help="JSON object of measured build seconds per type")
+    parser.add_option("--default-type", default="m3.large",
+                      help="type default_seconds applies to until measured")
+    parser.add_option("--default-seconds", type="int", default=30 * 60)
+    parser.add_option("--boot", type="int", default=5 * 60,
+                      help="seconds an instance takes to boot")
+    parser.add_option("--deadline", type="int", default=None,
+                      help="seconds a build may take, boot included")
+    parser.add_option("--max-price", type="float", default=None)
+    parser.add_option("--bid-multiplier", type="float", default=1.2)
+    opts, args = parser.parse_args(args)
+
+    if not opts.prices or not args:
+        parser.print_usage(sys.stderr)
+        return 1
+
+    prices = FilePriceFeed(opts.prices, opts.zone, max_age=None).getPrices(None, args)
+    candidates = instanceCandidates(args, json.loads(opts.durations), prices,
+                                    opts.boot, opts.default_type,
+                                    opts.default_seconds)
+
+    policy = InstanceCostPolicy(opts.bid_multiplier)
+    choice = policy.choose(candidates, opts.deadline, opts.max_price)
+    for line in policy.describe():
+        sys.stdout.write(line + "\n")
+
+    if choice is None:
+        sys.stdout.write("no priced instance type\n")
+        return 1
+    sys.stdout.write("chose %s bidding %.4f\n" % (choice[0]['instance_type'],
+                                                  choice[1]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
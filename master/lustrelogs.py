@@ -0,0 +1,152 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Digests and streaming reads of the build logs stored by the master.
+#
+# The master keeps every step log under <builder>/<build>-log-<step>-<log>,
+# compressed once finished (see logCompressionMethod in master.cfg). Logs of
+# configure and make are far too large to quote or to read whole, so steps
+# feed their output through a LogDigest, which keeps the compiler warnings and
+# errors and the make target which failed. The full log stays on disk and can
+# be streamed, a block at a time, without decompressing it first:
+#
+#   python lustrelogs.py cat <log file>
+#   python lustrelogs.py digest <log file>
+#
+# cat writes the stdout and stderr of the log, digest prints its digest.
+
+import bz2
+import gzip
+import re
+import sys
+
+# the channels of the chunks in a stored log
+STDOUT, STDERR, HEADER = 0, 1, 2
+
+class LogDigest(object):
+
+    """Collects the interesting lines of a compiler or configure log.
+
+    Lines are passed to feed() one at a time. Warnings and errors are counted,
+    the first maxLines of them are kept along with the first target make
+    reported as failing."""
+
+    warningPattern = re.compile(r'(^configure: WARNING:|'
+                                r'^[^\s:]+:\d+:(\d+:)? warning:)')
+    errorPattern = re.compile(r'(^configure: error:|'
+                              r'^[^\s:]+:\d+:(\d+:)? (fatal )?error:|'
+                              r'^error: |'
+                              r'undefined reference to)')
+    targetPattern = re.compile(r'^make(\[\d+\])?: \*\*\* '
+                               r'\[([^\]:]+:\d+: )?(.+?)\] Error \d+')
+
+    def __init__(self, maxLines=50):
+        self.maxLines = maxLines
+        self.warnings = 0
+        self.errors = 0
+        self.target = None
+        self.lines = []
+
+    def feed(self, line):
+        line = line.rstrip()
+
+        m = self.targetPattern.search(line)
+        if m:
+            # make reports the failure once per directory level, the first
+            # report is the deepest and names the target which really failed
+            if self.target is None:
+                self.target = m.group(3)
+            return
+
+        if self.errorPattern.search(line):
+            self.errors += 1
+        elif self.warningPattern.search(line):
+            self.warnings += 1
+        else:
+            return
+
+        if len(self.lines) < self.maxLines:
+            self.lines.append(line)
+
+    def empty(self):
+        return not (self.warnings or self.errors or self.target)
+
+    def getText(self):
+        text = ["%d warning(s), %d error(s)" % (self.warnings, self.errors)]
+        if self.target:
+            text.append("failed target: %s" % self.target)
+        text.extend(self.lines)
+        if self.warnings + self.errors > len(self.lines):
+            text.append("... %d more" %
+                        (self.warnings + self.errors - len(self.lines)))
+        return "\n".join(text) + "\n"
+
+def openLog(path):
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    elif path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def readChunks(path, channels=(STDOUT, STDERR), blocksize=64 * 1024):
+    """Yields the (channel, text) chunks of a stored log, reading the file a
+    block at a time. The log is a sequence of netstrings, each holding the
+    channel digit followed by the text."""
+    f = openLog(path)
+    try:
+        buf = b''
+        while True:
+            block = f.read(blocksize)
+            buf += block
+
+            pos = 0
+            while True:
+                colon = buf.find(b':', pos)
+                if colon < 0:
+                    break
+                length = int(buf[pos:colon])
+                end = colon + 1 + length
+                if end >= len(buf):
+                    break
+
+                channel = int(buf[colon + 1:colon + 2])
+                if channel in channels:
+                    yield channel, buf[colon + 2:end]
+                pos = end + 1
+
+            buf = buf[pos:]
+            if not block:
+                break
+    finally:
+        f.close()
+
+def readLines(path, channels=(STDOUT, STDERR)):
+    # yields the complete lines of the chosen channels of a stored log
+    partial = b''
+    for channel, text in readChunks(path, channels):
+        lines = (partial + text).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8', 'replace')
+    if partial:
+        yield partial.decode('utf-8', 'replace')
+
+def main(args):
+    if len(args) != 2 or args[0] not in ('cat', 'digest'):
+        sys.stderr.write("usage: lustrelogs.py cat|digest <log file>\n")
+        return 1
+
+    if args[0] == 'cat':
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        for channel, text in readChunks(args[1]):
+            out.write(text)
+        return 0
+
+    digest = LogDigest()
+    for line in readLines(args[1]):
+        digest.feed(line)
+    sys.stdout.write(digest.getText())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,304 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+import os
+import time
+
+from buildbot.status.base import StatusReceiverMultiService
+from buildbot.status.results import Results
+from buildbot.util import datetime2epoch
+from twisted.application import internet
+from twisted.internet import defer, task
+from twisted.python import log
+from twisted.web import resource, server
+
+# upper bounds, in seconds, of the duration histogram buckets
+duration_buckets = [10, 30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600,
+                    5400, 7200, 10800]
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                                     .replace('"', '\\"'))
+                             for name, value in sorted(labels.items()))
+
+class MetricsRegistry(object):
+
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Every metric is identified by its name and a dict of labels. Metric names
+    are registered with describe() before use, which also sets their type."""
+
+    def __init__(self):
+        self.types = {}
+        self.help = {}
+        self.values = {}
+        self.histograms = {}
+
+    def describe(self, name, kind, text):
+        self.types[name] = kind
+        self.help[name] = text
+
+    def _key(self, name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        counts, total, count = self.histograms.get(key,
+            ([0] * len(duration_buckets), 0.0, 0))
+        for i, bound in enumerate(duration_buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.histograms[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.types):
+            lines.append("# HELP %s %s" % (name, self.help[name]))
+            lines.append("# TYPE %s %s" % (name, self.types[name]))
+
+            if self.types[name] == 'histogram':
+                for key in sorted(k for k in self.histograms if k[0] == name):
+                    labels = dict(key[1])
+                    counts, total, count = self.histograms[key]
+                    for bound, bucket in zip(duration_buckets, counts):
+                        lines.append("%s_bucket%s %d" % (name,
+                            _labels(dict(labels, le=bound)), bucket))
+                    lines.append("%s_bucket%s %d" % (name,
+                        _labels(dict(labels, le='+Inf')), count))
+                    lines.append("%s_sum%s %.3f" % (name, _labels(labels), total))
+                    lines.append("%s_count%s %d" % (name, _labels(labels), count))
+                continue
+
+            for key in sorted(k for k in self.values if k[0] == name):
+                value = self.values[key]
+                lines.append("%s%s %s" % (name, _labels(dict(key[1])),
+                             ('%d' % value) if isinstance(value, (int, long))
+                             else ('%.3f' % value)))
+
+        return "\n".join(lines) + "\n"
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return self.metrics.render()
+
+class LustreMetrics(StatusReceiverMultiService):
+
+    """Records where the time of the build pipeline goes.
+
+    For every builder this keeps histograms of build and step durations and of
+    the time build requests waited in the queue, and counters of the bytes the
+    steps moved (every '*_bytes' step statistic, such as those
+    StatsShellCommand collects and the transfer steps' upload_bytes and
+    download_bytes). For latent slaves it exports how long their instances
+    took to boot and connect, and for every patchset how long it took from the
+    tarball build request until the last build of the change finished. The review
+    counters of the Gerrit status push are included when one is given.
+
+    The metrics are written in the Prometheus text format to path, relative to
+    the master's base directory, every interval seconds and, when port is set,
+    served on that port at /metrics for Prometheus to scrape.
+    """
+
+    def __init__(self, path='metrics.prom', port=None, interval=60, gerrit=None):
+        StatusReceiverMultiService.__init__(self)
+        self.path = path
+        self.port = port
+        self.interval = interval
+        self.gerrit = gerrit
+        self.metrics = MetricsRegistry()
+        self.writer = None
+        self.buildsetSubscription = None
+
+        # (change, patchset) -> the first time a buildset was submitted for it
+        self.changeStarted = {}
+
+        m = self.metrics
+        m.describe('lustre_build_seconds', 'histogram',
+                   'Duration of builds by builder and result.')
+        m.describe('lustre_build_queue_seconds', 'histogram',
+                   'Time build requests waited before their build started.')
+        m.describe('lustre_step_seconds', 'histogram',
+                   'Duration of build steps by builder and step.')
+        m.describe('lustre_step_bytes_total', 'counter',
+                   'Bytes reported by step statistics, by builder, step and statistic.')
+        m.describe('lustre_change_turnaround_seconds', 'histogram',
+                   'Time from the first build request of a patchset until its '
+                   'last build finished.')
+        m.describe('lustre_slave_substantiations_total', 'counter',
+                   'Latent slave instances which booted and connected.')
+        m.describe('lustre_slave_substantiate_seconds_total', 'counter',
+                   'Total time latent slave instances took to boot and connect.')
+        m.describe('lustre_slave_substantiate_seconds', 'gauge',
+                   'Rolling average time a latent slave took to boot and connect.')
+        m.describe('lustre_gerrit_reviews_total', 'counter',
+                   'Gerrit reviews by what happened to them.')
+        m.describe('lustre_gerrit_review_seconds_total', 'counter',
+                   'Total time spent sending Gerrit reviews.')
+
+        if port is not None:
+            site = server.Site(MetricsResource(self))
+            internet.TCPServer(port, site).setServiceParent(self)
+
+    def setServiceParent(self, parent):
+        StatusReceiverMultiService.setServiceParent(self, parent)
+        self.master_status = self.parent
+        self.master_status.subscribe(self)
+        self.master = self.master_status.master
+
+    def disownServiceParent(self):
+        self.master_status.unsubscribe(self)
+        self.master_status = None
+        return StatusReceiverMultiService.disownServiceParent(self)
+
+    def startService(self):
+        self.buildsetSubscription = \
+            self.master.subscribeToBuildsetCompletions(self.buildsetFinished)
+        if self.path:
+            self.writer = task.LoopingCall(self.write)
+            self.writer.start(self.interval, now=False)
+        return StatusReceiverMultiService.startService(self)
+
+    def stopService(self):
+        if self.buildsetSubscription is not None:
+            self.buildsetSubscription.unsubscribe()
+            self.buildsetSubscription = None
+        if self.writer is not None and self.writer.running:
+            self.writer.stop()
+            self.write()
+        return StatusReceiverMultiService.stopService(self)
+
+    def builderAdded(self, name, builder):
+        return self  # subscribe to this builder
+
+    def buildStarted(self, builderName, build):
+        started = build.getTimes()[0]
+        for submitted in self.getSubmitTimes(builderName, build):
+            self.metrics.observe('lustre_build_queue_seconds',
+                                 max(0, started - submitted), builder=builderName)
+        return self  # subscribe to this build's steps
+
+    def getSubmitTimes(self, builderName, build):
+        # the status of a build does not know its requests, the running build does
+        builder = self.master.botmaster.builders.get(builderName)
+        if builder is None:
+            return []
+
+        for running in builder.building:
+            if running.build_status is build:
+                return [r.submittedAt for r in running.requests
+                        if r.submittedAt is not None]
+        return []
+
+    def stepFinished(self, build, step, results):
+        builderName = build.getBuilder().getName()
+        started, finished = step.getTimes()
+        if started is None or finished is None:
+            return
+
+        self.metrics.observe('lustre_step_seconds', finished - started,
+                             builder=builderName, step=step.getName())
+
+        for name, value in step.getStatistics().items():
+            if name.endswith('_bytes') and isinstance(value, (int, long)):
+                self.metrics.inc('lustre_step_bytes_total', value,
+                                 builder=builderName, step=step.getName(),
+                                 statistic=name)
+
+    def buildFinished(self, builderName, build, results):
+        started, finished = build.getTimes()
+        if started is not None and finished is not None:
+            self.metrics.observe('lustre_build_seconds', finished - started,
+                                 builder=builderName, result=Results[results])
+
+    @defer.inlineCallbacks
+    def buildsetFinished(self, bsid, result):
+        db = self.master.db
+        props = yield db.buildsets.getBuildsetProperties(bsid)
+        change = self.getChange(props)
+        if change is None:
+            return
+
+        bsdict = yield db.buildsets.getBuildset(bsid)
+
+        submitted = datetime2epoch(bsdict['submitted_at'])
+        first = min(self.changeStarted.get(change, submitted), submitted)
+
+        # the change is done once the builds its tarball build triggered are
+        for other in (yield db.buildsets.getBuildsets(complete=False)):
+            otherProps = yield db.buildsets.getBuildsetProperties(other['bsid'])
+            if self.getChange(otherProps) == change:
+                self.changeStarted[change] = first
+                return
+
+        self.changeStarted.pop(change, None)
+        complete = datetime2epoch(bsdict['complete_at']) if bsdict['complete_at'] \
+            else time.time()
+        self.metrics.observe('lustre_change_turnaround_seconds', complete - first)
+        log.msg("metrics: change %d patchset %d done %ds after its first "
+                "request" % (change[0], change[1], complete - first))
+
+        # forget changes whose last builds were never seen to finish
+        for key, when in self.changeStarted.items():
+            if complete - when > 7 * 86400:
+                del self.changeStarted[key]
+
+    def getChange(self, props):
+        # the change number and patchset number of a buildset, or None
+        try:
+            return (int(props['event.change.number'][0]),
+                    int(props['event.patchSet.number'][0]))
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def collect(self):
+        # values kept elsewhere are read when the metrics are rendered
+        for slave in self.master.botmaster.slaves.values():
+            count = getattr(slave, 'substantiate_count', None)
+            if count is None:
+                continue
+            name = slave.slavename
+            self.metrics.set('lustre_slave_substantiations_total', count, slave=name)
+            self.metrics.set('lustre_slave_substantiate_seconds_total',
+                             slave.substantiate_total, slave=name)
+            if slave.substantiate_seconds is not None:
+                self.metrics.set('lustre_slave_substantiate_seconds',
+                                 slave.substantiate_seconds, slave=name)
+
+        if self.gerrit is not None:
+            stats = self.gerrit.reviewStats
+            for state in ('queued', 'coalesced', 'sent', 'failed', 'retried',
+                          'dropped'):
+                self.metrics.set('lustre_gerrit_reviews_total', stats[state],
+                                 state=state)
+            self.metrics.set('lustre_gerrit_review_seconds_total',
+                             stats['latency_total'])
+
+    def render(self):
+        self.collect()
+        return self.metrics.render()
+
+    def write(self):
+        path = os.path.join(self.master.basedir, self.path)
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.render())
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            log.msg("metrics: cannot write %s: %s" % (path, e))
@@ -0,0 +1,302 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Retention of the build products published under public_html/downloads.
+#
+# Every change directory (<change>/<patchset> for patchsets, tags/<tag> for
+# tags) is recorded in a sqlite index when the master publishes into it, with
+# its size and the time it was last accessed. Its size is the sum of the sizes
+# recorded for the files published into it, so a file published again is not
+# counted twice. The retention policies are applied to the index alone, so the
+# downloads tree is never walked:
+#
+#   - tags are kept forever
+#   - only the newest keep patchsets of each change are kept
+#   - patchsets are removed max_age days after they were last accessed
+#   - the least recently accessed patchsets are removed while the total size
+#     exceeds the quota
+#
+# Usage:
+#
+#   python lustreretention.py apply [options] <index> <downloads dir>
+#   python lustreretention.py report [options] <index> <downloads dir>
+#   python lustreretention.py scan <index> <downloads dir>
+#   python lustreretention.py access <index> < paths
+#
+# report prints what apply would remove without removing anything. scan
+# records the files of a tree published before the index existed. It walks
+# the tree only the first time it runs on an index, later runs do nothing.
+# access reads download paths, one per line (for instance the request
+# paths of a web server log), and marks the directories they fall in as
+# accessed.
+
+import optparse
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    change INTEGER,
+    patchset INTEGER,
+    tag TEXT,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_change ON artifacts (change, patchset);
+CREATE INDEX IF NOT EXISTS artifacts_accessed ON artifacts (accessed);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    bytes INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+patchsetPath = re.compile(r'^(\d+)/(\d+)$')
+tagPath = re.compile(r'^tags/([^/]+)$')
+
+def parsePath(path):
+    """Returns (change, patchset, tag) for a change directory path relative
+    to the downloads directory, or None if it is not one."""
+    m = patchsetPath.match(path)
+    if m:
+        return int(m.group(1)), int(m.group(2)), None
+
+    m = tagPath.match(path)
+    if m:
+        return None, None, m.group(1)
+
+    return None
+
+def canonicalPath(path):
+    # the master and the cron job may reach the downloads tree by different
+    # paths, the files are keyed by where they really are
+    return os.path.join(os.path.realpath(os.path.dirname(path)),
+                        os.path.basename(path))
+
+def directoryFiles(path):
+    """Returns a dict of the size of every regular file under path"""
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            full = os.path.join(dirpath, name)
+            st = os.lstat(full)
+            if not os.path.islink(full):
+                files[full] = st.st_size
+    return files
+
+class RetentionIndex(object):
+
+    def __init__(self, path):
+        # the master and the cron job share the index, wait for each other
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def record(self, path, files, when=None):
+        """Records the files published into the change directory path,
+        relative to the downloads directory. files maps the path of each file
+        to its bytes, a file recorded before gets its new size. Publishing
+        counts as an access."""
+        path = path.strip('/')
+        parsed = parsePath(path)
+        if parsed is None:
+            return False
+
+        change, patchset, tag = parsed
+        when = when or time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                [(canonicalPath(f), path, bytes) for f, bytes in files.items()])
+            bytes = self.db.execute(
+                "SELECT COALESCE(SUM(bytes), 0) FROM files WHERE dir = ?",
+                (path,)).fetchone()[0]
+
+            cur = self.db.execute(
+                "UPDATE artifacts SET bytes = ?, accessed = MAX(accessed, ?) "
+                "WHERE path = ?", (bytes, when, path))
+            if cur.rowcount == 0:
+                self.db.execute(
+                    "INSERT INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (path, change, patchset, tag, bytes, when, when))
+        return True
+
+    def touch(self, paths, when=None):
+        """Marks the change directories containing paths as accessed"""
+        when = when or time.time()
+        touched = set()
+        for path in paths:
+            parts = path.strip('/').split('/')
+            if parts and parts[0] == 'downloads':
+                parts = parts[1:]
+
+            candidate = '/'.join(parts[:2])
+            if parsePath(candidate) is not None:
+                touched.add(candidate)
+
+        with self.db:
+            self.db.executemany(
+                "UPDATE artifacts SET accessed = MAX(accessed, ?) WHERE path = ?",
+                [(when, p) for p in touched])
+        return len(touched)
+
+    def plan(self, keep=None, max_age=None, quota=None, now=None):
+        """Returns the (path, bytes, reason) of every directory the policies
+        remove, tags excluded."""
+        now = now or time.time()
+        doomed = {}
+
+        rows = self.db.execute(
+            "SELECT path, change, patchset, bytes, accessed FROM artifacts "
+            "WHERE tag IS NULL ORDER BY change, patchset DESC").fetchall()
+
+        count = {}
+        for path, change, patchset, bytes, accessed in rows:
+            count[change] = count.get(change, 0) + 1
+            if keep is not None and count[change] > keep:
+                doomed[path] = (bytes, "older than the last %d patchsets" % keep)
+            elif max_age is not None and now - accessed > max_age * 86400:
+                doomed[path] = (bytes, "not accessed for %d days" % max_age)
+
+        if quota is not None:
+            total = self.db.execute(
+                "SELECT COALESCE(SUM(bytes), 0) FROM artifacts").fetchone()[0]
+            total -= sum(bytes for bytes, reason in doomed.values())
+
+            lru = sorted(rows, key=lambda row: row[4])
+            for path, change, patchset, bytes, accessed in lru:
+                if total <= quota:
+                    break
+                if path in doomed:
+                    continue
+                doomed[path] = (bytes, "over the %d GiB quota" % (quota >> 30))
+                total -= bytes
+
+        return sorted((path, bytes, reason)
+                      for path, (bytes, reason) in doomed.items())
+
+    def remove(self, paths):
+        with self.db:
+            self.db.executemany("DELETE FROM artifacts WHERE path = ?",
+                                [(p,) for p in paths])
+            self.db.executemany("DELETE FROM files WHERE dir = ?",
+                                [(p,) for p in paths])
+
+    def scanned(self):
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE name = 'scanned'").fetchone()
+        return row is not None
+
+    def scan(self, root):
+        """Records the files of every change directory under root, unless
+        a scan of this index completed before. Directories the master already
+        recorded keep their access times. Returns the number of directories
+        recorded, or None when the index was scanned before."""
+        if self.scanned():
+            return None
+
+        recorded = 0
+        for top in os.listdir(root):
+            if not os.path.isdir(os.path.join(root, top)):
+                continue
+            for sub in os.listdir(os.path.join(root, top)):
+                path = "%s/%s" % (top, sub)
+                full = os.path.join(root, path)
+                if parsePath(path) is None or not os.path.isdir(full):
+                    continue
+                mtime = os.stat(full).st_mtime
+                self.record(path, directoryFiles(full), when=mtime)
+                recorded += 1
+
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('scanned', ?)",
+                            (str(time.time()),))
+        return recorded
+
+def apply(index, root, plan, dry_run=False):
+    freed = 0
+    removed = []
+    for path, bytes, reason in plan:
+        sys.stdout.write("%s %s (%.1f MiB): %s\n" %
+                         ("would remove" if dry_run else "removing", path,
+                          bytes / (1024.0 * 1024.0), reason))
+        freed += bytes
+        if dry_run:
+            continue
+
+        full = os.path.join(root, path)
+        if os.path.isdir(full):
+            shutil.rmtree(full)
+        removed.append(path)
+
+        # drop the change directory once its last patchset is gone
+        parent = os.path.dirname(full)
+        try:
+            os.rmdir(parent)
+        except OSError:
+            pass
+
+    index.remove(removed)
+
+    total = index.db.execute(
+        "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM artifacts").fetchone()
+    sys.stdout.write("%s %d directories, %.1f MiB; %d directories, %.1f MiB "
+                     "remain\n" % ("would remove" if dry_run else "removed",
+                     len(plan), freed / (1024.0 * 1024.0),
+                     total[0] - (len(plan) if dry_run else 0),
+                     (total[1] - (freed if dry_run else 0)) / (1024.0 * 1024.0)))
+
+def main(args):
+    parser = optparse.OptionParser(
+        usage="%prog apply|report|scan|access [options] <index> [<downloads dir>]")
+    parser.add_option("--keep", type="int", default=None,
+                      help="patchsets kept per change")
+    parser.add_option("--max-age", type="int", default=14,
+                      help="days a patchset is kept after its last access")
+    parser.add_option("--quota", type="int", default=None,
+                      help="GiB all change directories may use")
+    opts, args = parser.parse_args(args)
+
+    if len(args) < 2 or args[0] not in ('apply', 'report', 'scan', 'access'):
+        parser.print_usage(sys.stderr)
+        return 1
+
+    index = RetentionIndex(args[1])
+    command = args[0]
+
+    if command == 'access':
+        touched = index.touch(line.strip() for line in sys.stdin)
+        sys.stdout.write("marked %d directories accessed\n" % touched)
+        return 0
+
+    if len(args) != 3:
+        parser.print_usage(sys.stderr)
+        return 1
+
+    root = args[2]
+    if command == 'scan':
+        recorded = index.scan(root)
+        if recorded is not None:
+            sys.stdout.write("recorded %d directories\n" % recorded)
+        return 0
+
+    quota = opts.quota << 30 if opts.quota is not None else None
+    plan = index.plan(keep=opts.keep, max_age=opts.max_age, quota=quota)
+    apply(index, root, plan, dry_run=(command == 'report'))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
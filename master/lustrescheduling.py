@@ -0,0 +1,225 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Scheduling policies used by the master. Nothing in here depends on buildbot,
+# the policies only see plain values gathered from the master's objects, so
+# they can be exercised outside of a running master.
+
+class SlaveSelectionPolicy(object):
+    """Chooses a slave for a builder from a list of candidates.
+
+    Each candidate is a (slave, inputs) tuple where inputs is a dict of the
+    values the policy scores. The candidate with the highest score is picked,
+    ties going to the earliest candidate. The scores of the last choice are
+    kept in lastChoice so callers can log why a slave was picked.
+    """
+
+    def __init__(self):
+        self.lastChoice = []
+
+    def score(self, inputs):
+        # every slave is as good as any other, the earliest is picked
+        return 0
+
+    def choose(self, candidates):
+        best = None
+        bestScore = None
+
+        self.lastChoice = []
+        for slave, inputs in candidates:
+            score = self.score(inputs)
+            self.lastChoice.append(dict(inputs, score=score))
+            if bestScore is None or score > bestScore:
+                best, bestScore = slave, score
+
+        return best
+
+    def describe(self):
+        """Returns the last choice as one line per candidate, best first"""
+        lines = []
+        for inputs in sorted(self.lastChoice, key=lambda i: -i['score']):
+            lines.append("%s score=%d %s" % (inputs.get('name'), inputs['score'],
+                " ".join("%s=%s" % (k, v) for k, v in sorted(inputs.items())
+                         if k not in ('name', 'score'))))
+        return lines
+
+class FirstSlavePolicy(SlaveSelectionPolicy):
+    """Prefers a slave which is already running, then the first one listed"""
+
+    def score(self, inputs):
+        return 0 if inputs.get('substantiate_seconds', 0) else 1
+
+class WarmSlavePolicy(SlaveSelectionPolicy):
+    """Scores slaves by the time they are expected to save the next build.
+
+    Every input is converted to seconds. A slave gains the time a cold slave
+    would spend installing dependencies (deps), building spl and zfs for the
+    requested tags (zfs) and warming its caches for the same branch (branch).
+    It loses the time the build is expected to wait for the instance to boot
+    (substantiate_seconds) and a penalty for each build it already runs for
+    other builders (load).
+
+    Expected inputs:
+        name                  slave name, only used for logging
+        deps                  True if the build dependencies are installed
+        zfs                   True if spl and zfs for the requested tags are
+                              already installed
+        branch                True if the slave built the requested branch
+                              recently
+        load                  number of builds running on the slave
+        substantiate_seconds  expected seconds until the slave can build
+    """
+
+    def __init__(self, deps_seconds=300, zfs_seconds=900, branch_seconds=120,
+                 load_seconds=600):
+        SlaveSelectionPolicy.__init__(self)
+        self.deps_seconds = deps_seconds
+        self.zfs_seconds = zfs_seconds
+        self.branch_seconds = branch_seconds
+        self.load_seconds = load_seconds
+
+    def score(self, inputs):
+        score = 0
+        if inputs.get('deps'):
+            score += self.deps_seconds
+        if inputs.get('zfs'):
+            score += self.zfs_seconds
+        if inputs.get('branch'):
+            score += self.branch_seconds
+
+        score -= inputs.get('load', 0) * self.load_seconds
+        score -= inputs.get('substantiate_seconds', 0)
+        return score
+
+class DurationEstimate(object):
+    """Rolling estimate of how long a builder's builds take.
+
+    Each new duration moves the estimate by weight of the difference, so a
+    handful of builds is enough to follow a slowdown while a single outlier
+    does not swing it. Until a build has been seen the default is returned.
+    """
+
+    def __init__(self, default=30 * 60, weight=0.25):
+        self.default = default
+        self.weight = weight
+        self.seconds = None
+        self.count = 0
+
+    def add(self, seconds):
+        if self.seconds is None:
+            self.seconds = float(seconds)
+        else:
+            self.seconds += self.weight * (seconds - self.seconds)
+        self.count += 1
+
+    def get(self):
+        if self.seconds is None:
+            return self.default
+        return self.seconds
+
+class CriticalPathPolicy(object):
+    """Orders builders with pending requests by their critical path.
+
+    A builder's critical path is its own expected duration plus the longest
+    expected duration of the builders its builds trigger. Builders gating
+    other builds therefore come first, and among the rest the longest builds
+    start first so the last one finishes as early as possible. Ties are
+    broken by the number of gated builders and then by the oldest request.
+
+    Each entry is a dict with:
+        name     builder name
+        seconds  expected duration of one build
+        path     critical path in seconds
+        gated    number of builders waiting on this one
+        oldest   submit time of the oldest pending request, or None
+    """
+
+    def rank(self, entries):
+        def key(entry):
+            oldest = entry.get('oldest')
+            return (-entry['path'], -entry['gated'],
+                    oldest is None, oldest)
+
+        return sorted(entries, key=key)
+
+def criticalPath(name, durations, downstream):
+    """Returns the critical path in seconds of builder name, given the
+    expected duration of each builder and the builders each one triggers"""
+    later = [durations.get(n, 0) for n in downstream.get(name, [])]
+    return durations.get(name, 0) + max(later or [0])
+
+class InstanceCostPolicy(object):
+    """Picks the instance type and spot bid for a builder's next instance.
+
+    The expected cost of a build on an instance type is its hourly price
+    times the hours the instance is up for the build, booting and building.
+    Of the candidates expected to boot and build within the deadline the
+    cheapest is picked, ties going to the faster one. When none makes the
+    deadline the fastest is picked. Candidates without a known price, or
+    whose price is above max_price, are never picked. The bid is the price
+    times bid_multiplier, capped at max_price. The candidates of the last
+    choice are kept in lastChoice so callers can log why a type was picked.
+
+    Each candidate is a dict with:
+        instance_type  EC2 instance type
+        seconds        expected duration of a build on it
+        measured       True if seconds comes from finished builds, False if
+                       it was scaled from another type
+        price          current hourly spot price, or None if unknown
+        boot_seconds   expected seconds until the instance can build
+    """
+
+    def __init__(self, bid_multiplier=1.2):
+        self.bid_multiplier = bid_multiplier
+        self.lastChoice = []
+
+    def choose(self, candidates, deadline=None, max_price=None):
+        """Returns the chosen candidate and the bid, or None"""
+        self.lastChoice = []
+        priced = []
+        for c in candidates:
+            c = dict(c)
+            if c.get('price') is not None:
+                c['cost'] = c['price'] * (c['boot_seconds'] + c['seconds']) / 3600.0
+                c['fits'] = deadline is None or \
+                    c['boot_seconds'] + c['seconds'] <= deadline
+                if max_price is None or c['price'] <= max_price:
+                    priced.append(c)
+            self.lastChoice.append(c)
+
+        if not priced:
+            return None
+
+        fits = [c for c in priced if c['fits']]
+        if fits:
+            best = min(fits, key=lambda c: (c['cost'], c['seconds']))
+        else:
+            best = min(priced, key=lambda c: (c['seconds'], c['cost']))
+
+        bid = best['price'] * self.bid_multiplier
+        if max_price is not None:
+            bid = min(bid, max_price)
+        best['chosen'] = True
+        return best, bid
+
+    def describe(self):
+        """Returns the last choice as one line per candidate, cheapest first"""
+        lines = []
+        for c in sorted(self.lastChoice, key=lambda c: (c.get('cost') is None,
+                                                        c.get('cost'))):
+            if c.get('price') is None:
+                lines.append("%s no price seconds=%d" % (c['instance_type'],
+                                                         c['seconds']))
+                continue
+            lines.append("%s%s cost=%.4f price=%.4f seconds=%d boot=%d "
+                         "measured=%s fits=%s" % (c['instance_type'],
+                         " (chosen)" if c.get('chosen') else "", c['cost'],
+                         c['price'], c['seconds'], c['boot_seconds'],
+                         c['measured'], c['fits']))
+        return lines
+
+def scaleDuration(seconds, cpus, other_cpus, parallel=0.9):
+    """Returns the expected duration on an instance with other_cpus vCPUs of a
+    build which takes seconds on one with cpus vCPUs. Only the parallel
+    fraction of the build speeds up with more vCPUs."""
+    return seconds * ((1 - parallel) + parallel * float(cpus) / other_cpus)
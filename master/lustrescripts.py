@@ -0,0 +1,143 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Publishes the build slave scripts as a bundle served by the master.
+#
+# The bundle is a gzipped tar of the files in the scripts directory, named
+# after its sha256 digest. It is built reproducibly, so the same scripts
+# always give the same digest and restarting the master republishes nothing.
+# The configuration only computes the digest, ScriptPublisher writes the
+# bundle when the master starts or is reconfigured, so checking the
+# configuration leaves public_html alone. Build steps run the scripts with
+# bbrun pinned to the digest (see the bbscripts property), which downloads a
+# version once and keeps it in a cache on the slave. bbrun itself is published
+# next to the bundles for the instances' user data to fetch.
+
+import gzip
+import hashlib
+import io
+import os
+import sys
+import tarfile
+
+from twisted.python import log
+from buildbot.status.base import StatusReceiverMultiService
+
+def buildBundle(scripts_dir):
+    """Returns the gzipped tar of the files in scripts_dir, with their
+    modes, owners and times fixed so only their names and contents count"""
+    buf = io.BytesIO()
+    gz = gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0)
+    tar = tarfile.open(mode='w', fileobj=gz, format=tarfile.USTAR_FORMAT)
+
+    for name in sorted(os.listdir(scripts_dir)):
+        path = os.path.join(scripts_dir, name)
+        if not os.path.isfile(path):
+            continue
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = 0o755
+        info.mtime = 0
+        tar.addfile(info, io.BytesIO(data))
+
+    tar.close()
+    gz.close()
+    return buf.getvalue()
+
+def scriptsDigest(scripts_dir):
+    """Returns the digest the bundle of scripts_dir is published under,
+    without publishing it, or None if scripts_dir does not exist"""
+    if not os.path.isdir(scripts_dir):
+        return None
+    return hashlib.sha256(buildBundle(scripts_dir)).hexdigest()
+
+def publishScripts(scripts_dir, dest_dir, keep=10):
+    """Publishes the scripts of scripts_dir in dest_dir.
+
+    Writes bundle-<digest>.tar.gz, a copy of bbrun and 'current', which holds
+    the digest of the newest bundle. Only the newest keep bundles are kept,
+    older ones may still be pinned by running builds. Returns the digest, or
+    None if scripts_dir does not exist, in which case the steps fetch every
+    script from bburl instead."""
+    if not os.path.isdir(scripts_dir):
+        log.msg("scripts: no %s, not publishing a script bundle" % scripts_dir)
+        return None
+
+    bundle = buildBundle(scripts_dir)
+    digest = hashlib.sha256(bundle).hexdigest()
+
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+
+    path = os.path.join(dest_dir, "bundle-%s.tar.gz" % digest)
+    if not os.path.exists(path):
+        writeFile(path, bundle)
+        log.msg("scripts: published bundle %s" % digest)
+    else:
+        os.utime(path, None)
+
+    with open(os.path.join(scripts_dir, "bbrun"), 'rb') as f:
+        writeFile(os.path.join(dest_dir, "bbrun"), f.read())
+    writeFile(os.path.join(dest_dir, "current"), (digest + "\n").encode())
+
+    bundles = sorted((os.path.join(dest_dir, name) for name in os.listdir(dest_dir)
+                      if name.startswith("bundle-") and name.endswith(".tar.gz")),
+                     key=os.path.getmtime, reverse=True)
+    for old in bundles[keep:]:
+        os.unlink(old)
+
+    return digest
+
+class ScriptPublisher(StatusReceiverMultiService):
+
+    """Publishes the scripts of scripts_dir in dest_dir, see
+    publishScripts(), when the master starts and on every reconfig.
+
+    digest is what scriptsDigest() gives while the configuration is loaded,
+    for the bbscripts property. The bundle published is built again, so a
+    change to the scripts in between is logged.
+    """
+
+    def __init__(self, scripts_dir, dest_dir, keep=10):
+        StatusReceiverMultiService.__init__(self)
+        self.scripts_dir = scripts_dir
+        self.dest_dir = dest_dir
+        self.keep = keep
+        self.digest = scriptsDigest(scripts_dir)
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        if self.digest is None:
+            log.msg("scripts: no %s, not publishing a script bundle" %
+                    self.scripts_dir)
+            return
+
+        digest = publishScripts(self.scripts_dir, self.dest_dir, self.keep)
+        if digest != self.digest:
+            log.msg("scripts: %s changed since the configuration was loaded, "
+                    "builds ask for bundle %s but %s was published" %
+                    (self.scripts_dir, self.digest, digest))
+
+def writeFile(path, data):
+    # readers never see a partly written file
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+def main(args):
+    if len(args) != 2:
+        sys.stderr.write("usage: lustrescripts.py <scripts dir> <publish dir>\n")
+        return 1
+
+    digest = publishScripts(args[0], args[1])
+    if digest is None:
+        return 1
+    sys.stdout.write(digest + "\n")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
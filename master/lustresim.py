@@ -0,0 +1,651 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Offline simulator of the master's scheduling policies.
+#
+# Replays a trace of Gerrit patchsets and tags against a model of the builders
+# and latent slaves, driven by the same policy objects the master uses (see
+# lustrescheduling): the slave selection policy of each builder's nextSlave
+# and the builder ordering of prioritizeBuilders. Slaves are modelled with
+# their boot time, build_wait_timeout, max_builds and a limited spot capacity,
+# builders with a duration per build. Nothing talks to EC2 or Gerrit.
+#
+# Usage:
+#
+#   python lustresim.py [options] (--config master.cfg | --builders file.json)
+#
+# --config loads the builders, slaves and policies from the master's
+# configuration, which needs buildbot and a password.py next to it.
+# --builders reads a JSON description instead:
+#
+#   {"builders": [{"name": "tarball", "slaves": ["t1"], "seconds": 900,
+#                  "downstream": ["el7"]},
+#                 {"name": "el7", "slaves": ["e1", "e2"], "seconds": 2400,
+#                  "prewarm": true}],
+#    "slaves": [{"name": "t1", "build_wait_timeout": 18000},
+#               {"name": "e1"}, {"name": "e2", "max_builds": 1}]}
+#
+# The trace is either a file of Gerrit stream-events JSON lines
+# (patchset-created and ref-updated of refs/tags/*) given with --trace, or
+# a synthetic one of --hours hours. Build durations can be overridden with
+# --durations, a JSON file mapping builder names to seconds.
+#
+# Turnaround is the time from a patchset's event until the last build it
+# triggered finished. A change still unfinished when the trace runs out, for
+# instance because a builder has no slave, is counted until the end of the
+# run and reported as unfinished. Instance hours count every hour a latent slave's
+# instance was up, idle hours those it was up without building. Cost hours
+# weigh instance hours by the price of the instance relative to a one slot
+# instance.
+#
+# --slots makes every latent slave of the builders which trigger no others,
+# the package builders, an instance running that many builds at once (see
+# LustreEC2Slave's slots), costing --slot-cost times as much per
+# hour and building at --slot-speed times the speed of a one slot instance.
+
+import heapq
+import itertools
+import json
+import optparse
+import os
+import random
+import sys
+
+from lustrescheduling import WarmSlavePolicy, FirstSlavePolicy, \
+    CriticalPathPolicy, DurationEstimate, criticalPath
+
+class SimSlave(object):
+
+    def __init__(self, name, max_builds=1, build_wait_timeout=60, latent=True,
+                 boot_seconds=300, slots=1, cost=1.0, speed=1.0):
+        self.name = name
+        self.max_builds = max_builds
+        self.build_wait_timeout = build_wait_timeout
+        self.latent = latent
+        self.boot_seconds = boot_seconds
+        self.slots = slots
+        self.cost = cost
+        self.speed = speed
+
+        self.state = 'off' if latent else 'up'
+        self.running = 0
+        self.attached = []
+        self.deps = not latent
+        self.branches = set()
+        self.up_since = None
+        self.busy_since = None
+        self.hold_until = 0
+        self.timer = 0
+
+        self.boots = 0
+        self.instance_seconds = 0
+        self.busy_seconds = 0
+
+class SimBuilder(object):
+
+    def __init__(self, name, slaves, seconds, downstream=None, prewarm=False,
+                 slavePolicy=None):
+        self.name = name
+        self.slaves = slaves
+        self.seconds = seconds
+        self.downstream = downstream or []
+        self.prewarm = prewarm
+        self.slavePolicy = slavePolicy or WarmSlavePolicy()
+        self.pending = []
+        self.estimate = DurationEstimate()
+
+class SimRequest(object):
+
+    def __init__(self, builder, submitted, change, branch):
+        self.builder = builder
+        self.submitted = submitted
+        self.change = change
+        self.branch = branch
+
+class Simulator(object):
+
+    """Discrete event simulation of builds on latent slaves.
+
+    deps_seconds and branch_seconds are added to a build on a slave which has
+    not installed the build dependencies yet, or has not built the branch since
+    it booted. spot_capacity bounds the number of instances up at once and
+    spot_failure is the chance an instance request is not fulfilled, in which
+    case the slave is retried after its boot time. With supersede, a patchset
+    cancels the pending requests of the older patchsets of its change.
+    """
+
+    def __init__(self, builders, order=None, deps_seconds=300, branch_seconds=120,
+                 spot_capacity=None, spot_failure=0.0, jitter=0.1, supersede=True,
+                 prewarm_hold=3600, seed=0):
+        self.builders = dict((b.name, b) for b in builders)
+        self.order = order or CriticalPathPolicy()
+        self.deps_seconds = deps_seconds
+        self.branch_seconds = branch_seconds
+        self.spot_capacity = spot_capacity
+        self.spot_failure = spot_failure
+        self.jitter = jitter
+        self.supersede = supersede
+        self.prewarm_hold = prewarm_hold
+        self.random = random.Random(seed)
+
+        self.slaves = {}
+        for b in builders:
+            for s in b.slaves:
+                self.slaves[s.name] = s
+        self.downstream = dict((b.name, b.downstream) for b in builders)
+        self.roots = [b for b in builders
+                      if not [o for o in builders if b.name in o.downstream]]
+
+        self.now = 0
+        self.events = []
+        self.sequence = itertools.count()
+
+        # (change, patchset) -> [event time, outstanding builds]
+        self.changes = {}
+        self.latest = {}
+        self.turnaround = []
+        self.queue_wait = []
+        self.builds = 0
+        self.superseded = 0
+        self.failed_boots = 0
+        self.unfinished = 0
+
+    def schedule(self, when, action, *args):
+        heapq.heappush(self.events, (when, next(self.sequence), action, args))
+
+    # trace events
+
+    def submit(self, kind, change, patchset, branch):
+        key = (change, patchset)
+        if kind == 'tag':
+            key = ('tag', change)
+
+        if self.supersede and kind == 'patchset':
+            older = self.latest.get(change)
+            if older is not None and older < patchset:
+                self.cancel((change, older))
+            self.latest[change] = max(patchset, older or 0)
+
+        self.changes[key] = [self.now, 0]
+        for b in self.roots:
+            self.request(b, key, branch)
+        self.distribute()
+
+    def request(self, builder, key, branch):
+        builder.pending.append(SimRequest(builder, self.now, key, branch))
+        self.changes[key][1] += 1
+
+    def cancel(self, key):
+        for b in self.builders.values():
+            keep = [r for r in b.pending if r.change != key]
+            self.superseded += len(b.pending) - len(keep)
+            b.pending = keep
+        self.changes.pop(key, None)
+
+    # scheduling, mirroring the master's build request distributor
+
+    def distribute(self):
+        waiting = [b for b in self.builders.values() if b.pending]
+        if not waiting:
+            return
+
+        durations = dict((name, b.estimate.get())
+                         for name, b in self.builders.items())
+        entries = [{'name': b.name,
+                    'seconds': durations[b.name],
+                    'path': criticalPath(b.name, durations, self.downstream),
+                    'gated': len(b.downstream),
+                    'oldest': min(r.submitted for r in b.pending),
+                    'builder': b} for b in waiting]
+
+        # as LustreBuilderPrioritizer, a builder which can start now first
+        ranked = []
+        for availability in range(3):
+            ranked.extend(self.order.rank(
+                [e for e in entries
+                 if self.availability(e['builder']) == availability]))
+
+        for entry in ranked:
+            b = entry['builder']
+            while b.pending:
+                slave = self.chooseSlave(b, b.pending[0].branch)
+                if slave is None:
+                    break
+                self.startBuild(slave, b.pending.pop(0))
+
+    def availability(self, builder):
+        # 0 with an idle slave, 1 with none busy, 2 otherwise
+        if [s for s in builder.slaves
+            if s.state == 'up' and s.running < s.max_builds]:
+            return 0
+        if [s for s in builder.slaves if s.state != 'off']:
+            return 2
+        return 1
+
+    def instancesUp(self):
+        return len([s for s in self.slaves.values()
+                    if s.latent and s.state != 'off'])
+
+    def canBoot(self):
+        return self.spot_capacity is None or \
+            self.instancesUp() < self.spot_capacity
+
+    def chooseSlave(self, builder, branch):
+        idle = [s for s in builder.slaves
+                if s.state == 'up' and s.running < s.max_builds]
+
+        # wait for a slave which is booting rather than boot another
+        if not idle and [s for s in builder.slaves if s.state == 'booting'
+                         and len(s.attached) < s.max_builds]:
+            booting = [s for s in builder.slaves if s.state == 'booting'
+                       and len(s.attached) < s.max_builds]
+            return booting[0]
+
+        candidates = list(idle)
+        if self.canBoot():
+            candidates += [s for s in builder.slaves if s.state == 'off']
+        if not candidates:
+            return None
+
+        return builder.slavePolicy.choose([(s, {
+            'name': s.name,
+            'deps': s.state == 'up' and s.deps,
+            'zfs': s.state == 'up' and s.deps,
+            'branch': branch in s.branches,
+            # every slot has a share of its own
+            'load': s.running if s.slots == 1 else 0,
+            'substantiate_seconds': 0 if s.state == 'up' else s.boot_seconds,
+        }) for s in candidates])
+
+    def boot(self, slave):
+        slave.state = 'booting'
+        slave.timer += 1
+        slave.up_since = self.now
+        self.schedule(self.now + slave.boot_seconds, self.booted, slave)
+
+    def booted(self, slave):
+        if self.random.random() < self.spot_failure:
+            # the spot request was not fulfilled, the attached requests wait
+            self.failed_boots += 1
+            slave.instance_seconds += self.now - slave.up_since
+            slave.state = 'off'
+            for req in slave.attached:
+                req.builder.pending.insert(0, req)
+            slave.attached = []
+            self.distribute()
+            return
+
+        slave.state = 'up'
+        slave.boots += 1
+        slave.deps = False
+        slave.branches = set()
+
+        attached, slave.attached = slave.attached, []
+        for req in attached:
+            self.runBuild(slave, req)
+        if not slave.running:
+            self.idle(slave)
+        self.distribute()
+
+    def startBuild(self, slave, req):
+        if slave.state == 'off':
+            self.boot(slave)
+        if slave.state == 'booting':
+            slave.attached.append(req)
+            return
+        self.runBuild(slave, req)
+
+    def runBuild(self, slave, req):
+        builder = req.builder
+        self.queue_wait.append(self.now - req.submitted)
+
+        seconds = builder.seconds * (1 + self.random.uniform(-self.jitter, self.jitter))
+        seconds /= slave.speed
+        if not slave.deps:
+            seconds += self.deps_seconds
+        if req.branch not in slave.branches:
+            seconds += self.branch_seconds
+        slave.deps = True
+        slave.branches.add(req.branch)
+
+        if slave.running == 0:
+            slave.busy_since = self.now
+        slave.running += 1
+        slave.timer += 1
+        self.builds += 1
+
+        # a root build boots the slaves of the builders it will trigger
+        for name in builder.downstream:
+            self.prewarm(self.builders[name])
+
+        self.schedule(self.now + seconds, self.finishBuild, slave, req, seconds)
+
+    def prewarm(self, builder):
+        if not builder.prewarm:
+            return
+        if [s for s in builder.slaves if s.state != 'off']:
+            return
+
+        off = [s for s in builder.slaves if s.state == 'off']
+        if off and self.canBoot():
+            off[0].hold_until = self.now + self.prewarm_hold
+            self.boot(off[0])
+
+    def finishBuild(self, slave, req, seconds):
+        builder = req.builder
+        builder.estimate.add(seconds)
+
+        slave.running -= 1
+        if slave.running == 0:
+            slave.busy_seconds += self.now - slave.busy_since
+            self.idle(slave)
+
+        entry = self.changes.get(req.change)
+        if entry is not None:
+            for name in builder.downstream:
+                self.request(self.builders[name], req.change, req.branch)
+            entry[1] -= 1
+            if entry[1] == 0:
+                self.turnaround.append(self.now - entry[0])
+                del self.changes[req.change]
+
+        self.distribute()
+
+    def idle(self, slave):
+        if not slave.latent:
+            return
+        slave.timer += 1
+        timeout = max(slave.build_wait_timeout, slave.hold_until - self.now)
+        self.schedule(self.now + timeout, self.shutdown, slave, slave.timer)
+
+    def shutdown(self, slave, timer):
+        # a build or boot since the timer was set cancels it
+        if timer != slave.timer or slave.state != 'up' or slave.running:
+            return
+        slave.state = 'off'
+        slave.instance_seconds += self.now - slave.up_since
+
+    def run(self, trace):
+        for when, kind, change, patchset, branch in trace:
+            self.schedule(when, self.submit, kind, change, patchset, branch)
+
+        while self.events:
+            when, _, action, args = heapq.heappop(self.events)
+            self.now = when
+            action(*args)
+
+        for slave in self.slaves.values():
+            if slave.state != 'off':
+                slave.instance_seconds += self.now - slave.up_since
+
+        # censored at the end rather than left out, which would flatter the
+        # percentiles of a configuration that never finishes some changes
+        self.unfinished = len(self.changes)
+        for started, outstanding in self.changes.values():
+            self.turnaround.append(self.now - started)
+
+        return self.report()
+
+    def report(self):
+        latent = [s for s in self.slaves.values() if s.latent]
+        instance = sum(s.instance_seconds for s in latent)
+        busy = sum(s.busy_seconds for s in latent)
+        cost = sum(s.instance_seconds * s.cost for s in latent)
+        return {
+            'builds': self.builds,
+            'superseded_requests': self.superseded,
+            'unfinished_changes': self.unfinished,
+            'turnaround': percentiles(self.turnaround),
+            'queue_wait': percentiles(self.queue_wait),
+            'boots': sum(s.boots for s in latent),
+            'failed_boots': self.failed_boots,
+            'instance_hours': instance / 3600.0,
+            'idle_hours': (instance - busy) / 3600.0,
+            'cost_hours': cost / 3600.0,
+            'builds_per_instance_hour': self.builds * 3600.0 / instance if instance else 0,
+            'builds_per_cost_hour': self.builds * 3600.0 / cost if cost else 0,
+        }
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def pick(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99),
+            'max': values[-1], 'count': len(values)}
+
+def syntheticTrace(hours, rate=4.0, revise=0.3, tags=0.01, seed=0):
+    """Returns patchset and tag events arriving at rate per hour for hours.
+    revise is the chance an event is a new patchset of a recent change,
+    tags the chance it is a tag."""
+    rng = random.Random(seed)
+    trace = []
+    now = 0.0
+    changes = []
+    number = 10000
+
+    while True:
+        now += rng.expovariate(rate / 3600.0)
+        if now > hours * 3600:
+            break
+
+        if rng.random() < tags:
+            trace.append((now, 'tag', 'v%d' % len(trace), None, 'master'))
+        elif changes and rng.random() < revise:
+            change = rng.choice(changes[-20:])
+            change[1] += 1
+            trace.append((now, 'patchset', change[0], change[1], 'master'))
+        else:
+            number += 1
+            changes.append([number, 1])
+            trace.append((now, 'patchset', number, 1, 'master'))
+
+    return trace
+
+def gerritTrace(lines):
+    """Returns the events of Gerrit stream-events JSON lines, timed from the
+    first of them"""
+    trace = []
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+
+        when = event.get('eventCreatedOn')
+        if event.get('type') == 'patchset-created':
+            trace.append((when, 'patchset', int(event['change']['number']),
+                          int(event['patchSet']['number']),
+                          event['change'].get('branch', 'master')))
+        elif event.get('type') == 'ref-updated':
+            ref = event['refUpdate']['refName']
+            if ref.startswith('refs/tags/'):
+                trace.append((when, 'tag', ref[len('refs/tags/'):], None,
+                              'master'))
+
+    trace = [t for t in trace if t[0] is not None]
+    if trace:
+        start = min(t[0] for t in trace)
+        trace = sorted((t[0] - start,) + t[1:] for t in trace)
+    return trace
+
+def loadBuilders(path, durations):
+    with open(path) as f:
+        config = json.load(f)
+
+    slaves = dict((s['name'], SimSlave(s['name'],
+                   max_builds=s.get('max_builds', 1),
+                   build_wait_timeout=s.get('build_wait_timeout', 60),
+                   latent=s.get('latent', True),
+                   boot_seconds=s.get('boot_seconds', 300)))
+                  for s in config['slaves'])
+
+    return [SimBuilder(b['name'], [slaves[n] for n in b['slaves']],
+                       durations.get(b['name'], b.get('seconds', 1800)),
+                       downstream=b.get('downstream'),
+                       prewarm=b.get('prewarm', False))
+            for b in config['builders']]
+
+def loadMasterConfig(path, durations, boot_seconds):
+    """Returns the builders and the builder ordering policy of a master.cfg"""
+    from buildbot.config import MasterConfig
+    from buildbot.buildslave import AbstractLatentBuildSlave
+
+    basedir, filename = os.path.split(os.path.abspath(path))
+    config = MasterConfig.loadConfig(basedir, filename)
+
+    # the slot slaves of an instance are modelled as one slave with slots
+    owners = [s for s in config.slaves if not hasattr(s, 'owner')]
+    slaves = {}
+    for s in owners:
+        slots = 1 + len(getattr(s, 'slot_slaves', []))
+        slaves[s.slavename] = SimSlave(s.slavename,
+            max_builds=slots if slots > 1 else s.max_builds or 1,
+            build_wait_timeout=getattr(s, 'build_wait_timeout', 0),
+            latent=isinstance(s, AbstractLatentBuildSlave),
+            boot_seconds=getattr(s, 'substantiate_seconds', None) or boot_seconds,
+            slots=slots, cost=slots)
+    for s in config.slaves:
+        if hasattr(s, 'owner'):
+            slaves[s.slavename] = slaves[s.owner.slavename]
+
+    prioritizer = config.prioritizeBuilders
+    downstream = getattr(prioritizer, 'downstream', {})
+
+    builders = []
+    for b in config.builders:
+        builderSlaves = []
+        for n in b.slavenames:
+            if slaves[n] not in builderSlaves:
+                builderSlaves.append(slaves[n])
+        builders.append(SimBuilder(b.name, builderSlaves,
+            durations.get(b.name, DurationEstimate().get()),
+            downstream=downstream.get(b.name),
+            prewarm=b.properties.get('prewarm') == 'yes',
+            slavePolicy=getattr(b.nextSlave, 'policy', None)))
+
+    return builders, getattr(prioritizer, 'policy', None)
+
+class FifoPolicy(object):
+    """Orders builders by their oldest request, buildbot's default"""
+
+    def rank(self, entries):
+        return sorted(entries, key=lambda e: e['oldest'])
+
+def main(args):
+    parser = optparse.OptionParser(
+        usage="%prog [options] (--config master.cfg | --builders file.json)")
+    parser.add_option("--config", help="load builders from this master.cfg")
+    parser.add_option("--builders", help="load builders from this JSON file")
+    parser.add_option("--durations", help="JSON file of seconds per builder")
+    parser.add_option("--trace", help="Gerrit stream-events JSON lines")
+    parser.add_option("--hours", type="float", default=24 * 7,
+                      help="length of a synthetic trace")
+    parser.add_option("--rate", type="float", default=2.0,
+                      help="patchsets per hour of a synthetic trace")
+    parser.add_option("--boot", type="int", default=300,
+                      help="seconds a latent slave takes to boot")
+    parser.add_option("--build-wait-timeout", type="int", default=None,
+                      help="override every slave's build_wait_timeout")
+    parser.add_option("--max-builds", type="int", default=None,
+                      help="override every slave's max_builds")
+    parser.add_option("--num-slaves", type="int", default=None,
+                      help="slaves per builder, adding or dropping slaves")
+    parser.add_option("--slots", type="int", default=None,
+                      help="builds every latent slave's instance runs at once")
+    parser.add_option("--slot-cost", type="float", default=None,
+                      help="hourly price of a --slots instance relative to "
+                           "a one slot one, by default the number of slots")
+    parser.add_option("--slot-speed", type="float", default=1.0,
+                      help="speed of a slot relative to a one slot instance")
+    parser.add_option("--spot-capacity", type="int", default=None,
+                      help="instances which may be up at once")
+    parser.add_option("--spot-failure", type="float", default=0.0,
+                      help="chance an instance request is not fulfilled")
+    parser.add_option("--slave-policy", choices=['config', 'warm', 'first'],
+                      default='config', help="slave selection policy")
+    parser.add_option("--order", choices=['config', 'critical', 'fifo'],
+                      default='config', help="builder ordering policy")
+    parser.add_option("--no-supersede", action="store_true",
+                      help="build every patchset of a change")
+    parser.add_option("--seed", type="int", default=0)
+    opts, args = parser.parse_args(args)
+
+    if bool(opts.config) == bool(opts.builders):
+        parser.print_usage(sys.stderr)
+        return 1
+
+    durations = {}
+    if opts.durations:
+        with open(opts.durations) as f:
+            durations = json.load(f)
+
+    order = None
+    if opts.config:
+        builders, order = loadMasterConfig(opts.config, durations, opts.boot)
+    else:
+        builders = loadBuilders(opts.builders, durations)
+
+    if opts.order == 'critical':
+        order = CriticalPathPolicy()
+    elif opts.order == 'fifo':
+        order = FifoPolicy()
+
+    for b in builders:
+        if opts.slave_policy == 'warm':
+            b.slavePolicy = WarmSlavePolicy()
+        elif opts.slave_policy == 'first':
+            b.slavePolicy = FirstSlavePolicy()
+
+        if opts.num_slaves is not None:
+            while len(b.slaves) < opts.num_slaves:
+                model = b.slaves[0]
+                b.slaves.append(SimSlave("%s-sim%d" % (model.name, len(b.slaves)),
+                    model.max_builds, model.build_wait_timeout, model.latent,
+                    model.boot_seconds, model.slots, model.cost, model.speed))
+            del b.slaves[opts.num_slaves:]
+
+        for s in b.slaves:
+            if opts.build_wait_timeout is not None:
+                s.build_wait_timeout = opts.build_wait_timeout
+            if opts.max_builds is not None:
+                s.max_builds = opts.max_builds
+            if opts.slots is not None and s.latent and not b.downstream:
+                s.slots = s.max_builds = opts.slots
+                s.cost = opts.slot_cost if opts.slot_cost is not None else opts.slots
+                s.speed = opts.slot_speed if opts.slots > 1 else 1.0
+
+    if opts.trace:
+        with open(opts.trace) as f:
+            trace = gerritTrace(f)
+    else:
+        trace = syntheticTrace(opts.hours, rate=opts.rate, seed=opts.seed)
+
+    sim = Simulator(builders, order=order, spot_capacity=opts.spot_capacity,
+                    spot_failure=opts.spot_failure,
+                    supersede=not opts.no_supersede, seed=opts.seed)
+    result = sim.run(trace)
+
+    sys.stdout.write("%d events, %d builds, %d requests superseded\n" %
+                     (len(trace), result['builds'], result['superseded_requests']))
+    for name in ('turnaround', 'queue_wait'):
+        p = result[name]
+        if p:
+            sys.stdout.write("%-10s p50 %5.0fm  p90 %5.0fm  p99 %5.0fm  max %5.0fm\n" %
+                             (name, p['p50'] / 60.0, p['p90'] / 60.0,
+                              p['p99'] / 60.0, p['max'] / 60.0))
+    if result['unfinished_changes']:
+        sys.stdout.write("%d changes unfinished at the end, their turnaround "
+                         "counts until then\n" % result['unfinished_changes'])
+    sys.stdout.write("instances %d boots (%d failed), %.1f instance hours, "
+                     "%.1f idle\n" % (result['boots'], result['failed_boots'],
+                     result['instance_hours'], result['idle_hours']))
+    sys.stdout.write("throughput %.2f builds per instance hour, %.2f per cost "
+                     "hour (%.1f cost hours)\n" % (result['builds_per_instance_hour'],
+                     result['builds_per_cost_hour'], result['cost_hours']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
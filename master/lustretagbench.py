@@ -0,0 +1,155 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Benchmark of the commit metadata collection of LustreTagPoller.
+#
+# Usage:
+#
+#   python lustretagbench.py [--tags 3000] [--check 300] [--repo <bare repo>]
+#
+# Without --repo a synthetic bare repository is created in a temporary
+# directory with one commit per tag, every other tag annotated. Every tag is
+# then treated as changed and submitted twice: once per tag, running the four
+# 'git log' processes of GitPoller for each as LustreTagPoller used to, and
+# once through the poller's batched _process_changes(). The time of each is
+# printed. For the first --check tags both paths must submit the same
+# changes, otherwise the benchmark fails.
+#
+# It needs buildbot and git, but no running master.
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, task
+from buildbot.util import epoch2datetime
+
+from lustregittagpoller import LustreTagPoller
+
+class RecordingMaster(object):
+    """Stands in for the master, keeping the changes submitted by tag"""
+
+    def __init__(self):
+        self.changes = {}
+
+    def addChange(self, **kwargs):
+        self.changes[kwargs['branch']] = kwargs
+        return defer.succeed(None)
+
+class PerTagPoller(LustreTagPoller):
+    """LustreTagPoller collecting the metadata of every tag on its own, with
+    one process for each of its timestamp, author, files and comments"""
+
+    @defer.inlineCallbacks
+    def _process_changes(self, changed):
+        for ref, rev in sorted(changed.items()):
+            results = yield defer.gatherResults([
+                self._get_commit_timestamp(rev),
+                self._get_commit_author(rev),
+                self._get_commit_files(rev),
+                self._get_commit_comments(rev),
+            ], consumeErrors=True)
+
+            timestamp, author, files, comments = results
+            yield self.master.addChange(
+                author=author,
+                revision=rev,
+                files=files,
+                comments=comments,
+                when_timestamp=epoch2datetime(timestamp),
+                branch=ref,
+                category=self.category,
+                project=self.project,
+                repository=self.repourl,
+                src='git')
+
+def createRepository(path, tags):
+    """Creates a bare repository at path with a commit for each of tags
+    tags, every other one annotated"""
+    subprocess.check_call(['git', 'init', '-q', '--bare', path])
+
+    stream = []
+    for i in range(tags):
+        stream.append('commit refs/heads/master\nmark :%d\n'
+                      'committer Bench <bench@example.com> %d +0000\n'
+                      'data 13\ncommit %06d\nM 644 inline f%d\ndata 2\n%d\n' %
+                      (i + 1, 1400000000 + i, i, i % 50, i % 10))
+        name = '2.%d.%d' % (i // 100, i % 100)
+        if i % 2:
+            stream.append('tag %s\nfrom :%d\n'
+                          'tagger Bench <bench@example.com> %d +0000\n'
+                          'data 3\nrc\n' % (name, i + 1, 1400000000 + i))
+        else:
+            stream.append('reset refs/tags/%s\nfrom :%d\n' % (name, i + 1))
+
+    p = subprocess.Popen(['git', 'fast-import', '--quiet'],
+                         stdin=subprocess.PIPE, cwd=path)
+    p.communicate('\n'.join(stream))
+    if p.returncode != 0:
+        raise EnvironmentError('git fast-import failed')
+
+def makePoller(cls, repo):
+    poller = cls(repourl=repo, workdir=repo, category='tags')
+    poller.master = RecordingMaster()
+    # not the first poll, which only records the tags
+    poller.lastRev = {'refs/tags/none': None}
+    return poller
+
+@defer.inlineCallbacks
+def benchmark(repo, check):
+    tags = yield makePoller(LustreTagPoller, repo)._getRefs()
+    sys.stdout.write("%d tags\n" % len(tags))
+
+    times = {}
+    for name, cls in (('per-tag', PerTagPoller), ('batched', LustreTagPoller)):
+        poller = makePoller(cls, repo)
+        started = time.time()
+        yield poller._process_changes(tags)
+        times[name] = time.time() - started
+        sys.stdout.write("%-8s %8.2fs, %d changes\n" %
+                         (name + ':', times[name], len(poller.master.changes)))
+
+    subset = dict(sorted(tags.items())[:check])
+    pollers = [makePoller(cls, repo) for cls in (PerTagPoller, LustreTagPoller)]
+    for poller in pollers:
+        yield poller._process_changes(subset)
+
+    same = pollers[0].master.changes == pollers[1].master.changes
+    sys.stdout.write("first %d tags: %s\n" %
+                     (len(subset), same and "identical changes" or "CHANGES DIFFER"))
+    defer.returnValue(same)
+
+def main(args):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--tags", type="int", default=3000,
+                      help="tags of the synthetic repository")
+    parser.add_option("--check", type="int", default=300,
+                      help="tags whose changes both paths must agree on")
+    parser.add_option("--repo", default=None,
+                      help="existing bare repository to use instead")
+    opts, args = parser.parse_args(args)
+
+    tmpdir = None
+    repo = opts.repo
+    if repo is None:
+        tmpdir = tempfile.mkdtemp(prefix='lustretagbench.')
+        repo = os.path.join(tmpdir, 'repo.git')
+        createRepository(repo, opts.tags)
+
+    result = []
+    try:
+        task.react(lambda reactor: benchmark(repo, opts.check).addCallback(result.append))
+    except SystemExit:
+        pass
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    return 0 if result and result[0] else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,101 @@
+#!/bin/bash
+
+# Stands in for ssh to a Gerrit server, so the review queue of
+# LustreGerritStatusPush can be exercised without one.  Pass its path as
+# sshCommand.
+#
+#   fake-gerrit.sh [ssh options] <user@host> [-p <port>] gerrit <command> ...
+#
+# 'gerrit version' prints a version.  'gerrit review' writes its arguments,
+# NUL separated, to a new file review.<n> in $FAKE_GERRIT_DIR, numbered in
+# the order the reviews arrive.  While $FAKE_GERRIT_DIR/fail holds a number
+# above 0, a review instead decrements it and fails.  $FAKE_GERRIT_DELAY
+# seconds are slept before a review is answered.
+#
+# A shared connection is faked with a file: '-M' creates the ControlPath and
+# '-O exit' removes it.
+
+CONTROL_PATH=
+MASTER=no
+OPERATION=
+HOST=
+ARGS=()
+
+while [ $# -gt 0 ]; do
+    case "$1" in
+      -o)
+        case "$2" in
+          ControlPath=*)
+            CONTROL_PATH="${2#ControlPath=}"
+            ;;
+        esac
+        shift 2
+        ;;
+      -O)
+        OPERATION="$2"
+        shift 2
+        ;;
+      -i|-p)
+        shift 2
+        ;;
+      -M)
+        MASTER=yes
+        shift
+        ;;
+      -*)
+        shift
+        ;;
+      *)
+        if [ -n "$HOST" ]; then
+            # the remote command, options included
+            ARGS=("$@")
+            break
+        fi
+        HOST="$1"
+        shift
+        ;;
+    esac
+done
+
+if [ "$OPERATION" = "exit" ]; then
+    rm -f "$CONTROL_PATH"
+    exit 0
+fi
+
+if [ "$MASTER" = "yes" ]; then
+    touch "$CONTROL_PATH"
+    exit 0
+fi
+
+if [ "${ARGS[0]}" != "gerrit" ]; then
+    echo "fake-gerrit: unsupported command: ${ARGS[*]}" >&2
+    exit 1
+fi
+
+case "${ARGS[1]}" in
+  version)
+    echo "gerrit version 2.14.1"
+    ;;
+  review)
+    sleep "${FAKE_GERRIT_DELAY:-0}"
+
+    exec 9>"$FAKE_GERRIT_DIR/lock"
+    flock 9
+
+    FAILURES=$(cat "$FAKE_GERRIT_DIR/fail" 2>/dev/null || echo 0)
+    if [ "$FAILURES" -gt 0 ]; then
+        echo $((FAILURES - 1)) > "$FAKE_GERRIT_DIR/fail"
+        echo "fatal: fake failure" >&2
+        exit 1
+    fi
+
+    N=$(ls "$FAKE_GERRIT_DIR" | grep -c '^review\.')
+    printf '%s\0' "${ARGS[@]:2}" > "$FAKE_GERRIT_DIR/review.$N"
+    ;;
+  *)
+    echo "fake-gerrit: unsupported gerrit command: ${ARGS[1]}" >&2
+    exit 1
+    ;;
+esac
+
+exit 0
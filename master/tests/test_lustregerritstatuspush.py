@@ -0,0 +1,161 @@
+# Tests of the review queue of LustreGerritStatusPush against
+# fake-gerrit.sh, which stands in for ssh to a Gerrit server.
+#
+# Usage, from the master directory:
+#
+#   trial tests
+
+import os
+import sys
+import time
+
+from twisted.internet import defer, task, reactor
+from twisted.trial import unittest
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(tests_dir))
+
+from lustregerritstatuspush import LustreGerritStatusPush
+
+class TestReviewQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.gerrit_dir = os.path.abspath(self.mktemp())
+        os.makedirs(self.gerrit_dir)
+
+        self.environ = dict(os.environ)
+        os.environ['FAKE_GERRIT_DIR'] = self.gerrit_dir
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+        # stopService() would also close the connection in the background
+        push = getattr(self, 'push', None)
+        if push is not None:
+            for timer in list(push.retryTimers) + [push.versionTimer]:
+                if timer is not None and timer.active():
+                    timer.cancel()
+
+    def makePush(self, **kwargs):
+        kwargs.setdefault('retryDelay', 0.1)
+        self.push = LustreGerritStatusPush(
+            server='gerrit.example.com', username='buildbot',
+            sshCommand=os.path.join(tests_dir, 'fake-gerrit.sh'),
+            controlPath=os.path.join(self.gerrit_dir, 'control'), **kwargs)
+        return self.push
+
+    def setFailures(self, count):
+        with open(os.path.join(self.gerrit_dir, 'fail'), 'w') as f:
+            f.write('%d\n' % count)
+
+    def getReviews(self):
+        # the arguments of each review the fake server received, in order
+        reviews = []
+        n = 0
+        while os.path.exists(os.path.join(self.gerrit_dir, 'review.%d' % n)):
+            with open(os.path.join(self.gerrit_dir, 'review.%d' % n)) as f:
+                reviews.append(f.read().split('\0')[:-1])
+            n += 1
+        return reviews
+
+    @defer.inlineCallbacks
+    def waitFor(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail("timed out, stats %r" % self.push.reviewStats)
+            yield task.deferLater(reactor, 0.05, lambda: None)
+
+    def idle(self):
+        return not self.push.reviewOrder and not self.push.reviewsInFlight
+
+    @defer.inlineCallbacks
+    def test_coalesce(self):
+        push = self.makePush()
+        push.sendCodeReview('lustre', 'aaa', {'message': 'first',
+                                              'labels': {'Verified': 1}})
+        push.sendCodeReview('lustre', 'aaa', {'message': 'second',
+                                              'labels': {'Code-Review': -1}})
+        push.sendCodeReview('lustre', 'bbb', {'message': 'other'})
+
+        yield self.waitFor(lambda: push.reviewStats['sent'] == 2)
+
+        reviews = self.getReviews()
+        self.assertEqual(len(reviews), 2)
+        byRevision = dict((review[-1], review) for review in reviews)
+        self.assertIn("--message 'first\n\nsecond'", byRevision['aaa'])
+        self.assertIn('--label Verified=1', byRevision['aaa'])
+        self.assertIn('--label Code-Review=-1', byRevision['aaa'])
+        self.assertIn("--message 'other'", byRevision['bbb'])
+
+        self.assertEqual(push.reviewStats['queued'], 3)
+        self.assertEqual(push.reviewStats['coalesced'], 1)
+
+        # the reviews went over the shared connection
+        self.assertTrue(os.path.exists(push.controlPath))
+
+    @defer.inlineCallbacks
+    def test_queue_order(self):
+        os.environ['FAKE_GERRIT_DELAY'] = '0.2'
+        push = self.makePush(maxConcurrentReviews=1)
+        for revision in ('aaa', 'bbb', 'ccc'):
+            push.sendCodeReview('lustre', revision, {'message': revision})
+
+        # queued while aaa is sent, so they join the waiting review
+        yield self.waitFor(lambda: push.reviewsInFlight)
+        push.sendCodeReview('lustre', 'bbb', {'message': 'bbb again'})
+
+        yield self.waitFor(lambda: push.reviewStats['sent'] == 3)
+
+        reviews = self.getReviews()
+        self.assertEqual([review[-1] for review in reviews],
+                         ['aaa', 'bbb', 'ccc'])
+        self.assertIn("--message 'bbb\n\nbbb again'", reviews[1])
+        self.assertEqual(push.reviewStats['coalesced'], 1)
+
+    @defer.inlineCallbacks
+    def test_retry(self):
+        self.setFailures(2)
+        push = self.makePush()
+        push.sendCodeReview('lustre', 'aaa', {'message': 'retried'})
+
+        yield self.waitFor(lambda: push.reviewStats['sent'] == 1)
+
+        reviews = self.getReviews()
+        self.assertEqual(len(reviews), 1)
+        self.assertIn("--message 'retried'", reviews[0])
+        self.assertEqual(push.reviewStats['failed'], 2)
+        self.assertEqual(push.reviewStats['retried'], 2)
+        self.assertEqual(push.reviewStats['dropped'], 0)
+
+    @defer.inlineCallbacks
+    def test_retry_coalesce(self):
+        # a review queued while the revision's failed one waits joins it
+        self.setFailures(1)
+        push = self.makePush(retryDelay=0.5)
+        push.sendCodeReview('lustre', 'aaa', {'message': 'first'})
+
+        yield self.waitFor(lambda: push.reviewStats['failed'] == 1)
+        push.sendCodeReview('lustre', 'aaa', {'message': 'second'})
+
+        yield self.waitFor(lambda: push.reviewStats['sent'] == 1)
+
+        reviews = self.getReviews()
+        self.assertEqual(len(reviews), 1)
+        self.assertIn("--message 'first\n\nsecond'", reviews[0])
+        self.assertEqual(push.reviewStats['coalesced'], 1)
+
+    @defer.inlineCallbacks
+    def test_give_up(self):
+        self.setFailures(10)
+        push = self.makePush(maxRetries=2)
+        push.sendCodeReview('lustre', 'aaa', {'message': 'dropped'})
+
+        yield self.waitFor(lambda: push.reviewStats['dropped'] == 1)
+        yield self.waitFor(self.idle)
+
+        self.assertEqual(self.getReviews(), [])
+        self.assertEqual(push.reviewStats['failed'], 3)
+        self.assertEqual(push.reviewStats['retried'], 2)
+        self.assertEqual(push.reviewStats['sent'], 0)
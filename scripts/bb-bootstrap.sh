@@ -47,6 +47,18 @@ fi
 if test ! "$BB_URL"; then
     BB_URL="https://raw.githubusercontent.com/opensfs/lustre-buildbot-config/master/scripts/"
 fi
+if test ! "$BB_PKG_PROXY"; then
+    BB_PKG_PROXY=""
+fi
+# Where the master publishes its script bundle for bbrun, empty without one.
+if test ! "$BB_SCRIPTS_URL"; then
+    BB_SCRIPTS_URL=""
+fi
+# Further build slots of the instance as space separated name:password pairs,
+# each runs a buildslave of its own.
+if test ! "$BB_SLOTS"; then
+    BB_SLOTS=""
+fi
 
 if test ! -f /etc/buildslave; then
     echo "BB_MASTER=\"$BB_MASTER\""      > /etc/buildslave
@@ -55,6 +67,8 @@ if test ! -f /etc/buildslave; then
     echo "BB_ADMIN=\"$BB_ADMIN\""       >> /etc/buildslave
     echo "BB_DIR=\"$BB_DIR\""           >> /etc/buildslave
     echo "BB_URL=\"$BB_URL\""           >> /etc/buildslave
+    echo "BB_PKG_PROXY=\"$BB_PKG_PROXY\"" >> /etc/buildslave
+    echo "BB_SCRIPTS_URL=\"$BB_SCRIPTS_URL\"" >> /etc/buildslave
 fi
 
 BB_PARAMS="${BB_DIR} ${BB_MASTER} ${BB_NAME} ${BB_PASSWORD}"
@@ -70,6 +84,33 @@ METAROOT="http://${METAIP}/latest"
 CURL="curl --fail --silent"
 
 
+# Point the package manager at a caching proxy on the build master so
+# packages are downloaded from upstream mirrors only once.
+configure_pkg_proxy () {
+    PROXY="$1"
+
+    if [ -z "$PROXY" ] || [ -f /etc/buildbot_pkg_proxy ]; then
+        return 0
+    fi
+
+    if [ -f /etc/yum.conf ]; then
+        echo "proxy=$PROXY" | sudo tee -a /etc/yum.conf >/dev/null
+    fi
+    if [ -f /etc/dnf/dnf.conf ]; then
+        echo "proxy=$PROXY" | sudo tee -a /etc/dnf/dnf.conf >/dev/null
+    fi
+    if [ -d /etc/apt/apt.conf.d ]; then
+        echo "Acquire::http::Proxy \"$PROXY\";" | \
+            sudo tee /etc/apt/apt.conf.d/01buildbot-proxy >/dev/null
+    fi
+    if [ -f /etc/sysconfig/proxy ]; then
+        sudo sed -i -e "s|^PROXY_ENABLED=.*|PROXY_ENABLED=\"yes\"|" \
+            -e "s|^HTTP_PROXY=.*|HTTP_PROXY=\"$PROXY\"|" /etc/sysconfig/proxy
+    fi
+
+    sudo touch /etc/buildbot_pkg_proxy
+}
+
 testbin () {
     BIN_PATH="$(which ${1})"
     if [ ! -x "${BIN_PATH}" -o -z "${BIN_PATH}" ]; then
@@ -78,6 +119,10 @@ testbin () {
     return 0
 }
 
+configure_pkg_proxy "$BB_PKG_PROXY"
+
+START=$(date +%s)
+
 case "$BB_NAME" in
 Amazon*)
     yum -y install deltarpm gcc python-pip python-devel
@@ -273,6 +318,23 @@ Ubuntu*)
     ;;
 esac
 
+# Install the utilities the build steps run the slave scripts with, from the
+# bundle this script came from when bbrun runs it.
+for TOOL in runurl bbrun; do
+    if test -n "$BB_SCRIPTS_DIR"; then
+        install -m 755 "$BB_SCRIPTS_DIR/$TOOL" /usr/bin/$TOOL
+    else
+        wget -qO/usr/bin/$TOOL $BB_URL/$TOOL
+        chmod 755 /usr/bin/$TOOL
+    fi
+done
+
+# The buildslaves of all slots share bbrun's cache of script bundles.
+mkdir -p /var/cache/bb-scripts
+chown -R buildbot /var/cache/bb-scripts
+
+BOOTSTRAP_SECONDS=$(($(date +%s) - START))
+
 # Generic buildslave configuration
 if test ! -d $BB_DIR; then
     mkdir -p $BB_DIR
@@ -294,9 +356,27 @@ uname -a >> $BB_DIR/info/host
 grep MemTotal /proc/meminfo >> $BB_DIR/info/host
 grep 'model name' /proc/cpuinfo >> $BB_DIR/info/host
 grep 'processor' /proc/cpuinfo >> $BB_DIR/info/host
+echo "Bootstrap install time: ${BOOTSTRAP_SECONDS}s (proxy: ${BB_PKG_PROXY:-none})" >> $BB_DIR/info/host
 
 # Finally, start it.
 sudo -u buildbot $BUILDSLAVE start $BB_DIR
 
+# Start a buildslave for every further slot, sharing the slave's info.
+for SLOT in $BB_SLOTS; do
+    SLOT_NAME="${SLOT%%:*}"
+    SLOT_PASSWORD="${SLOT#*:}"
+    SLOT_DIR="${BB_DIR}-${SLOT_NAME##*-}"
+
+    if test ! -d $SLOT_DIR; then
+        mkdir -p $SLOT_DIR
+        chown buildbot.buildbot $SLOT_DIR
+        sudo -u buildbot $BUILDSLAVE create-slave --umask=022 --usepty=0 \
+            $SLOT_DIR $BB_MASTER $SLOT_NAME $SLOT_PASSWORD
+    fi
+
+    cp $BB_DIR/info/* $SLOT_DIR/info/
+    sudo -u buildbot $BUILDSLAVE start $SLOT_DIR
+done
+
 # If all goes well, at this point you should see a buildbot slave joining your
 # farm.  You can then manage the rest of the work from the buildbot master.
@@ -17,6 +17,8 @@ GIT_ZFS=https://github.com/zfsonlinux/zfs.git
 BUILD_ROOT=
 SPL_TAG="master"
 ZFS_TAG="master"
+CACHE_URL=
+CACHE_OUTPUT=
 
 # Utility functions
 message () {
@@ -38,6 +40,11 @@ die () {
 
 install_packages () {
     SUDO="sudo"
+    PKG_DIR="$1"
+
+    # one build slot of the instance installs packages at a time
+    exec 9>/tmp/bb-packages.lock
+    flock 9
 
     case "$BB_NAME" in
     Amazon*)
@@ -81,13 +88,45 @@ install_packages () {
         echo "$BB_NAME unknown platform" 2>&1
         ;;
     esac
+    flock -u 9
+
+    # keep a copy of what was installed so it can be cached on the master
+    if [ -n "$CACHE_OUTPUT" ] && [ -n "$PKG_DIR" ]; then
+        mkdir -p ${BUILD_ROOT}/cache/$PKG_DIR
+        cp *.rpm *.deb ${BUILD_ROOT}/cache/$PKG_DIR/ 2>/dev/null
+    fi
+}
+
+# Install spl and zfs packages previously built for this platform, kernel and
+# tags from the build master's cache.  Returns non-zero on a cache miss.
+install_cached_packages () {
+    [ -z "${CACHE_URL}" ] && return 1
+
+    wget -qO ${BUILD_ROOT}/cached.tar.gz ${CACHE_URL} || return 1
+    mkdir ${BUILD_ROOT}/cached
+    tar -xzf ${BUILD_ROOT}/cached.tar.gz -C ${BUILD_ROOT}/cached || return 1
+
+    for PKG in spl zfs; do
+        pushd ${BUILD_ROOT}/cached/$PKG &>/dev/null || return 1
+        install_packages
+        popd &>/dev/null
+        sudo touch /etc/buildbot_$PKG
+    done
+
+    return 0
 }
 
-while getopts vs:z: FLAG; do
+while getopts vs:z:c:o: FLAG; do
     case "$FLAG" in
       v)
         VERBOSE=1
         ;;
+      c)
+        CACHE_URL="$OPTARG"
+        ;;
+      o)
+        CACHE_OUTPUT="$(cd $(dirname "$OPTARG") && pwd)/$(basename "$OPTARG")"
+        ;;
       z)
         ZFS_TAG="$OPTARG"
         ;;
@@ -110,6 +149,14 @@ CONFIG_OPTIONS=""
 # enter build root
 pushd ${BUILD_ROOT} &>/dev/null
 
+if [ ! -f /etc/buildbot_spl ] && [ ! -f /etc/buildbot_zfs ] && install_cached_packages; then
+  message "spl and zfs installed from the build master's cache."
+  echo "bb-stat: zfs_cache_hit=1"
+  popd &>/dev/null
+  cleanup
+  exit 0
+fi
+
 if [ ! -f /etc/buildbot_spl ]; then
   message " == REPO ${GIT_SPL} TAG ${SPL_TAG} =="
   git clone ${GIT_SPL} ./spl || die "Failed to get SPL source"
@@ -120,7 +167,7 @@ if [ ! -f /etc/buildbot_spl ]; then
   ./configure $CONFIG_OPTIONS || die "SPL configure failed"
   make $MAKE_FLAGS || die "SPL make pkg failed"
 
-  install_packages
+  install_packages spl
 
   sudo touch /etc/buildbot_spl
   popd &>/dev/null
@@ -135,7 +182,7 @@ if [ ! -f /etc/buildbot_zfs ]; then
   ./configure $CONFIG_OPTIONS || die "ZFS configure failed"
   make $MAKE_FLAGS || die "ZFS make rpm failed"
 
-  install_packages
+  install_packages zfs
 
   sudo touch /etc/buildbot_zfs
   popd &>/dev/null
@@ -143,6 +190,13 @@ fi
 
 popd &>/dev/null
 
+# bundle the freshly built packages for upload to the build master
+echo "bb-stat: zfs_cache_hit=0"
+if [ -n "$CACHE_OUTPUT" ] && [ -d ${BUILD_ROOT}/cache/spl ] && [ -d ${BUILD_ROOT}/cache/zfs ]; then
+  tar -czf $CACHE_OUTPUT -C ${BUILD_ROOT}/cache spl zfs || die "Failed to bundle packages"
+  echo "bb-stat: zfs_cache_bytes=$(stat -c %s $CACHE_OUTPUT)"
+fi
+
 cleanup
 
 exit 0
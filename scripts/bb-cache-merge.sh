@@ -0,0 +1,88 @@
+#!/bin/bash
+
+# Merge a cache delta uploaded by a build slave into the build master's copy
+# of that cache and republish the bundle slaves download.  This script runs
+# on the build master.
+#
+#   bb-cache-merge.sh -r <store root> -k <key> -i <delta> -b <bundle dir> -m <MiB>
+#
+# The unpacked caches for every key live under <store root>/<key>.  Once the
+# delta is merged the least recently used files, across all keys, are
+# removed until the store fits in <MiB>.  File modification times are used
+# for recency: both ccache and the delta preserve them.  The bundle for
+# <key> is then rewritten as <bundle dir>/<key>.tar.gz.
+
+STORE=
+KEY=
+DELTA=
+BUNDLES=
+MAX_MIB=4096
+
+while getopts r:k:i:b:m: FLAG; do
+    case "$FLAG" in
+      r)
+        STORE="$OPTARG"
+        ;;
+      k)
+        KEY="$OPTARG"
+        ;;
+      i)
+        DELTA="$OPTARG"
+        ;;
+      b)
+        BUNDLES="$OPTARG"
+        ;;
+      m)
+        MAX_MIB="$OPTARG"
+        ;;
+    esac
+done
+shift $((OPTIND-1))
+
+if [ -z "$STORE" ] || [ -z "$KEY" ] || [ -z "$DELTA" ] || [ -z "$BUNDLES" ]; then
+    echo "usage: $0 -r <store root> -k <key> -i <delta> -b <bundle dir> [-m <MiB>]"
+    exit 1
+fi
+
+mkdir -p "$STORE/$KEY" "$BUNDLES"
+
+# serialize merges, slaves of the same builder share a key
+exec 9>"$STORE/.lock"
+flock 9
+
+tar -xzf "$DELTA" -C "$STORE/$KEY" || exit 1
+rm -f "$DELTA"
+
+# evict the least recently used files until the store is within budget
+MAX_BYTES=$((MAX_MIB * 1024 * 1024))
+TOTAL=$(du -sb "$STORE" | cut -f1)
+EVICTED=0
+
+if [ $TOTAL -gt $MAX_BYTES ]; then
+    while read -r MTIME SIZE FILE; do
+        [ $TOTAL -le $MAX_BYTES ] && break
+        rm -f "$FILE"
+        TOTAL=$((TOTAL - SIZE))
+        EVICTED=$((EVICTED + SIZE))
+    done < <(find "$STORE" -mindepth 2 -type f -printf '%T@ %s %p\n' | sort -n)
+
+    # drop keys which no longer hold anything along with their bundles
+    for DIR in "$STORE"/*/; do
+        if [ -z "$(find "$DIR" -type f)" ]; then
+            rm -rf "$DIR"
+            rm -f "$BUNDLES/$(basename "$DIR").tar.gz"
+        fi
+    done
+fi
+
+if [ -d "$STORE/$KEY" ]; then
+    TMP=$(mktemp "$BUNDLES/.$KEY.XXXXXX")
+    tar -czf "$TMP" -C "$STORE/$KEY" . && chmod 644 "$TMP" && \
+        mv -f "$TMP" "$BUNDLES/$KEY.tar.gz"
+    rm -f "$TMP"
+fi
+
+echo "bb-stat: cache_store_bytes=$TOTAL"
+echo "bb-stat: cache_evicted_bytes=$EVICTED"
+
+exit 0
@@ -0,0 +1,113 @@
+#!/bin/bash
+
+# Fetch and update build caches kept on the build master.
+#
+#   bb-cache.sh fetch -u <url> -d <dir>
+#       Download the cache bundle at <url> and extract it into <dir>.  A
+#       missing bundle is a cache miss and is not an error.  The time of the
+#       fetch is recorded so that a later 'delta' only picks up new files.
+#
+#   bb-cache.sh delta -d <dir> -o <file> [-x <name>]
+#       Pack every file in <dir> created or touched since the last fetch
+#       into <file> so it can be uploaded and merged on the master.  Files
+#       called <name> are left out.  Exits with 3 when there is nothing to
+#       upload.
+#
+# Statistics are printed as 'bb-stat: name=value' lines which are collected
+# by the build step.
+
+# Check for a local cached configuration.
+if test -f /etc/buildslave; then
+    . /etc/buildslave
+fi
+
+set -x
+
+ACTION=$1
+shift
+
+CACHE_URL=
+CACHE_DIR=
+OUTPUT=
+EXCLUDE=.bb-cache-stamp
+
+while getopts u:d:o:x: FLAG; do
+    case "$FLAG" in
+      u)
+        CACHE_URL="$OPTARG"
+        ;;
+      d)
+        CACHE_DIR="$OPTARG"
+        ;;
+      o)
+        OUTPUT="$OPTARG"
+        ;;
+      x)
+        EXCLUDE="$OPTARG"
+        ;;
+    esac
+done
+shift $((OPTIND-1))
+
+if [ -z "$CACHE_DIR" ]; then
+    echo "Missing cache directory"
+    exit 1
+fi
+
+STAMP="$CACHE_DIR/.bb-cache-stamp"
+
+case "$ACTION" in
+fetch)
+    mkdir -p "$CACHE_DIR"
+    touch "$STAMP"
+    BUNDLE=$(mktemp)
+
+    if wget -qO "$BUNDLE" "$CACHE_URL"; then
+        tar -xzf "$BUNDLE" -C "$CACHE_DIR" || exit 1
+        BYTES=$(stat -c %s "$BUNDLE")
+        HIT=1
+    else
+        BYTES=0
+        HIT=0
+    fi
+
+    rm -f "$BUNDLE"
+
+    # files extracted from the bundle are not part of the next delta
+    touch "$STAMP"
+
+    set +x
+    echo "bb-stat: cache_hit=$HIT"
+    echo "bb-stat: cache_fetched_bytes=$BYTES"
+    ;;
+
+delta)
+    if [ -z "$OUTPUT" ] || [ ! -f "$STAMP" ]; then
+        echo "Cache was not fetched, nothing to upload."
+        exit 3
+    fi
+
+    FILES=$(mktemp)
+    (cd "$CACHE_DIR" && find . -type f -newer .bb-cache-stamp ! -name .bb-cache-stamp ! -name "$EXCLUDE") > "$FILES"
+
+    if [ ! -s "$FILES" ]; then
+        rm -f "$FILES"
+        set +x
+        echo "bb-stat: cache_delta_bytes=0"
+        exit 3
+    fi
+
+    tar -czf "$OUTPUT" -C "$CACHE_DIR" -T "$FILES" || exit 1
+    rm -f "$FILES"
+
+    set +x
+    echo "bb-stat: cache_delta_bytes=$(stat -c %s "$OUTPUT")"
+    ;;
+
+*)
+    echo "Unknown action '$ACTION'"
+    exit 1
+    ;;
+esac
+
+exit 0
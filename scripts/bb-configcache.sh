@@ -0,0 +1,125 @@
+#!/bin/bash
+
+# Share Lustre's autoconf cache (config.cache) through the build master.
+# Run every action from the top of the extracted source tree.
+#
+#   bb-configcache.sh fetch -u <url> -k <key>
+#       Download <url>/<key>-<hash>.cache as config.cache, where <hash> is
+#       taken from configure.ac and every .m4 file of the tree.  A cache made
+#       from other configure inputs can then never be used.  A missing
+#       cache, or one whose header names another key, is a cache miss.
+#
+#   bb-configcache.sh configure -- <configure command>
+#       Run the configure command with --cache-file=config.cache.  If it
+#       fails with a fetched cache, the cache is discarded and configure is
+#       run once more from scratch.
+#
+#   bb-configcache.sh save -o <file>
+#       Write config.cache with its key header into <file> for upload to the
+#       master.  Exits with 3 when the fetched cache was used unchanged.
+#
+# Statistics are printed as 'bb-stat: name=value' lines which are collected
+# by the build step.
+
+# Check for a local cached configuration.
+if test -f /etc/buildslave; then
+    . /etc/buildslave
+fi
+
+ACTION=$1
+shift
+
+CACHE_URL=
+KEY=
+OUTPUT=
+
+while getopts u:k:o: FLAG; do
+    case "$FLAG" in
+      u)
+        CACHE_URL="$OPTARG"
+        ;;
+      k)
+        KEY="$OPTARG"
+        ;;
+      o)
+        OUTPUT="$OPTARG"
+        ;;
+    esac
+done
+shift $((OPTIND-1))
+
+CACHE=config.cache
+# the cache as fetched, to tell whether configure added to it
+FETCHED=.bb-configcache-fetched
+# the full key of this tree, written by fetch
+KEYFILE=.bb-configcache-key
+
+case "$ACTION" in
+fetch)
+    if [ -z "$CACHE_URL" ] || [ -z "$KEY" ] || [ ! -f configure.ac ]; then
+        echo "Missing cache url, key or configure.ac"
+        exit 1
+    fi
+
+    HASH=$(find . -name configure.ac -o -name '*.m4' | LC_ALL=C sort | \
+        xargs cat | sha1sum | cut -c1-16)
+    FULLKEY="$KEY-$HASH"
+    echo "$FULLKEY" > $KEYFILE
+    rm -f $CACHE $FETCHED
+
+    HIT=0
+    if wget -qO $FETCHED "$CACHE_URL/$FULLKEY.cache"; then
+        if [ "$(head -1 $FETCHED)" = "# bb-configcache $FULLKEY" ]; then
+            sed -i 1d $FETCHED
+            cp $FETCHED $CACHE
+            HIT=1
+        else
+            echo "Discarding $FULLKEY.cache, it was made for another key"
+        fi
+    fi
+
+    if [ $HIT -eq 0 ]; then
+        rm -f $FETCHED
+    fi
+
+    echo "bb-stat: configcache_hit=$HIT"
+    echo "bb-stat: configcache_key=$FULLKEY"
+    ;;
+
+configure)
+    "$@" --cache-file=$CACHE && exit 0
+
+    if [ ! -f $FETCHED ]; then
+        exit 1
+    fi
+
+    # a cached result no longer holds, for instance after a package update
+    echo "configure failed with the cached results, retrying without them"
+    rm -f $CACHE $FETCHED
+    echo "bb-stat: configcache_discarded=1"
+    "$@" --cache-file=$CACHE || exit 1
+    ;;
+
+save)
+    if [ -z "$OUTPUT" ] || [ ! -f $KEYFILE ] || [ ! -s $CACHE ]; then
+        echo "No configure cache to upload."
+        exit 3
+    fi
+
+    if [ -f $FETCHED ] && cmp -s $CACHE $FETCHED; then
+        echo "The configure cache is unchanged."
+        echo "bb-stat: configcache_bytes=0"
+        exit 3
+    fi
+
+    (echo "# bb-configcache $(cat $KEYFILE)"; cat $CACHE) > "$OUTPUT" || exit 1
+    echo "bb-stat: configcache_bytes=$(stat -c %s "$OUTPUT")"
+    ;;
+
+*)
+    echo "Unknown action '$ACTION'"
+    exit 1
+    ;;
+esac
+
+exit 0
@@ -11,6 +11,15 @@ fi
 
 set -x
 
+# The build slots of an instance may install at once, but apt-get and zypper
+# fail rather than wait for another's lock.
+exec 9>/tmp/bb-packages.lock
+flock 9
+
+# bb-bootstrap.sh already pointed the package manager at the master's
+# package proxy, if there is one
+START=$(date +%s)
+
 case "$BB_NAME" in
 Amazon*)
     # Required development packages.
@@ -46,7 +55,7 @@ CentOS*)
     # Required utilties.
     sudo yum -y install git rpm-build wget curl lsscsi parted attr dbench bc \
         watchdog createrepo mock python python-docutils mdadm xfig transfig \
-        keyutils keyutils-libs libyaml
+        keyutils keyutils-libs libyaml ccache pigz zstd
 
     # add user to the mock group
     sudo usermod -a -G mock buildbot
@@ -88,7 +97,7 @@ Fedora*)
     # Required utilties.
     sudo dnf -y install git rpm-build wget curl lsscsi parted attr dbench \
         watchdog createrepo mock python python-pip python-docutils xfig transfig \
-        keyutils keyutils-libs
+        keyutils keyutils-libs ccache pigz zstd
 
     # add user to the mock group
     sudo usermod -a -G mock buildbot
@@ -120,7 +129,7 @@ RHEL*)
     sudo yum -y $EXTRA_REPO install git rpm-build wget curl lsscsi \
         parted attr dbench bc watchdog createrepo mock python \
         python-pip python-docutils mdadm xfig transfig \
-        keyutils keyutils-libs
+        keyutils keyutils-libs ccache pigz zstd
 
     # add user to the mock group
     sudo usermod -a -G mock buildbot
@@ -175,7 +184,7 @@ Ubuntu*)
     sudo apt-get --yes install git alien fakeroot wget curl \
         lsscsi parted gdebi attr dbench watchdog \
         python python-pip python-docutils xfig transfig \
-        keyutils libkeyutils1 libyaml-0-2
+        keyutils libkeyutils1 libyaml-0-2 ccache pigz
 
     # Required development libraries
     sudo apt-get --yes install linux-headers-$(uname -r) \
@@ -189,3 +198,11 @@ Ubuntu*)
     echo "$BB_NAME unknown platform"
     ;;
 esac
+RC=$?
+
+# record how long this boot spent installing dependencies
+set +x
+echo "bb-stat: deps_seconds=$(($(date +%s) - START))"
+echo "bb-stat: deps_proxy=$([ -f /etc/buildbot_pkg_proxy ] && echo 1 || echo 0)"
+
+exit $RC
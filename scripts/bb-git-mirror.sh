@@ -0,0 +1,69 @@
+#!/bin/bash
+
+# Maintain a local bare mirror of a git repository for use as a reference
+# repository (git clone --reference) by the Gerrit source step.  The mirror
+# is seeded from the build master's mirror, or a shared volume, and then only
+# updated incrementally.  Timing and transfer statistics are printed as
+# 'bb-stat: name=value' lines which are collected by the build step.
+
+# Check for a local cached configuration.
+if test -f /etc/buildslave; then
+    . /etc/buildslave
+fi
+
+set -x
+
+MIRROR_URL=
+MIRROR_DIR="lustre-release.git"
+
+while getopts u:d: FLAG; do
+    case "$FLAG" in
+      u)
+        MIRROR_URL="$OPTARG"
+        ;;
+      d)
+        MIRROR_DIR="$OPTARG"
+        ;;
+    esac
+done
+shift $((OPTIND-1))
+
+if [ -z "$MIRROR_URL" ]; then
+    echo "No mirror configured. Skipping..."
+    exit 3
+fi
+
+dir_bytes () {
+    if [ -e "$1" ]; then
+        du -sbL "$1" | cut -f1
+    else
+        echo 0
+    fi
+}
+
+START=$(date +%s)
+BYTES_BEFORE=$(dir_bytes $MIRROR_DIR/objects)
+
+if [ -d "$MIRROR_URL" ]; then
+    # a mirror on a shared volume is used in place
+    ln -sfn "$MIRROR_URL" "$MIRROR_DIR"
+elif [ ! -d "$MIRROR_DIR" ]; then
+    if ! git clone --mirror "$MIRROR_URL" "$MIRROR_DIR"; then
+        # leave an empty repository behind so --reference keeps working
+        rm -rf "$MIRROR_DIR"
+        git init --bare "$MIRROR_DIR"
+    fi
+else
+    # never let gc prune objects a running clone may borrow via alternates
+    git --git-dir="$MIRROR_DIR" -c gc.auto=0 fetch --prune "$MIRROR_URL" \
+        '+refs/heads/*:refs/heads/*' '+refs/tags/*:refs/tags/*'
+fi
+
+END=$(date +%s)
+BYTES_AFTER=$(dir_bytes $MIRROR_DIR/objects)
+
+set +x
+echo "bb-stat: mirror_seconds=$((END - START))"
+echo "bb-stat: mirror_bytes=$((BYTES_AFTER - BYTES_BEFORE))"
+
+exit 0
@@ -0,0 +1,143 @@
+#!/bin/bash
+
+# Generate the yum repositories for a build's published RPMs.  This script
+# runs on the build master after the deliverables are published.
+#
+#   bb-repo.sh -d <repo dir> -u <url> -a <arch> -c <checksum cache>
+#              [-r <rolling repo dir> -U <rolling url> -n <build> -b <builder>
+#               -k <keep>]
+#
+# Metadata is created for <repo dir>/SRPM and <repo dir>/<arch>/kmod, and a
+# lustre.repo file pointing at <url> is written next to them.  Package
+# checksums are cached in <checksum cache> and metadata is only updated, so
+# an RPM which was read before is never read again.
+#
+# With -r the RPMs are also linked into the rolling repository <rolling repo
+# dir>, which merges successive builds of a branch or of all tags.  The RPMs
+# of the last <keep> builds from <builder> are kept there (0 keeps all), the
+# RPMs of older builds are removed before its metadata is updated.
+
+REPO=
+URL=
+ARCH=
+CACHEDIR=
+ROLLING=
+ROLLING_URL=
+BUILD=
+BUILDER=
+KEEP=0
+
+while getopts d:u:a:c:r:U:n:b:k: FLAG; do
+    case "$FLAG" in
+      d)
+        REPO="$OPTARG"
+        ;;
+      u)
+        URL="$OPTARG"
+        ;;
+      a)
+        ARCH="$OPTARG"
+        ;;
+      c)
+        CACHEDIR="$OPTARG"
+        ;;
+      r)
+        ROLLING="$OPTARG"
+        ;;
+      U)
+        ROLLING_URL="$OPTARG"
+        ;;
+      n)
+        BUILD="$OPTARG"
+        ;;
+      b)
+        BUILDER="$OPTARG"
+        ;;
+      k)
+        KEEP="$OPTARG"
+        ;;
+    esac
+done
+shift $((OPTIND-1))
+
+if [ -z "$REPO" ] || [ -z "$URL" ] || [ -z "$ARCH" ] || [ -z "$CACHEDIR" ]; then
+    echo "usage: $0 -d <repo dir> -u <url> -a <arch> -c <checksum cache> [-r <rolling repo dir> -U <rolling url> -n <build> -b <builder> -k <keep>]"
+    exit 1
+fi
+
+if [ -n "$ROLLING" ] && ([ -z "$ROLLING_URL" ] || [ -z "$BUILD" ] || [ -z "$BUILDER" ]); then
+    echo "A rolling repository needs -U, -n and -b"
+    exit 1
+fi
+
+if hash createrepo_c 2>/dev/null; then
+    CREATEREPO=createrepo_c
+else
+    CREATEREPO=createrepo
+fi
+
+START=$(date +%s)
+mkdir -p "$CACHEDIR"
+
+# update the metadata of a directory of RPMs, reusing what is unchanged
+update_repo () {
+    local DIR="$1"
+
+    mkdir -p "$DIR"
+    $CREATEREPO --quiet --update --cachedir "$(readlink -f "$CACHEDIR")" \
+        --workers $(nproc) "$DIR" || return 1
+    find "$DIR" -maxdepth 1 -name '*.rpm' | wc -l
+}
+
+write_repo_file () {
+    printf "[lustre-SRPM]\nname=lustre-SRPM\nbaseurl=%s/SRPM/\nenabled=1\ngpgcheck=0\n\n[lustre-RPM]\nname=lustre-RPM\nbaseurl=%s/%s/kmod/\nenabled=1\ngpgcheck=0\n" \
+        "$2" "$2" "$ARCH" > "$1/lustre.repo"
+}
+
+SRPMS=$(update_repo "$REPO/SRPM") || exit 1
+RPMS=$(update_repo "$REPO/$ARCH/kmod") || exit 1
+write_repo_file "$REPO" "$URL"
+
+echo "bb-stat: repo_packages=$((SRPMS + RPMS))"
+
+if [ -n "$ROLLING" ]; then
+    mkdir -p "$ROLLING/.builds/$BUILDER"
+
+    # builders of other architectures share the SRPM directory
+    exec 9>"$ROLLING/.lock"
+    flock 9
+
+    MANIFEST="$ROLLING/.builds/$BUILDER/$BUILD"
+    : > "$MANIFEST"
+    for SUBDIR in SRPM "$ARCH/kmod"; do
+        mkdir -p "$ROLLING/$SUBDIR"
+        for RPM in "$REPO/$SUBDIR"/*.rpm; do
+            [ -f "$RPM" ] || continue
+            ln -f "$RPM" "$ROLLING/$SUBDIR/" || exit 1
+            echo "$SUBDIR/$(basename "$RPM")" >> "$MANIFEST"
+        done
+    done
+
+    # drop the builds of this builder beyond the newest KEEP, keeping any
+    # package another remaining build still lists
+    if [ "$KEEP" -gt 0 ]; then
+        ls -td "$ROLLING/.builds/$BUILDER"/* | tail -n +$((KEEP + 1)) | \
+        while read -r OLD; do
+            KEPT=$(ls -d "$ROLLING/.builds"/*/* | grep -vxF "$OLD")
+            grep -vxF -f <(cat $KEPT) "$OLD" | while read -r PKG; do
+                rm -f "$ROLLING/$PKG"
+            done
+            rm -f "$OLD"
+        done
+    fi
+
+    ROLLING_SRPMS=$(update_repo "$ROLLING/SRPM") || exit 1
+    ROLLING_RPMS=$(update_repo "$ROLLING/$ARCH/kmod") || exit 1
+    write_repo_file "$ROLLING" "$ROLLING_URL"
+
+    echo "bb-stat: rolling_packages=$((ROLLING_SRPMS + ROLLING_RPMS))"
+fi
+
+echo "bb-stat: repo_seconds=$(($(date +%s) - START))"
+
+exit 0
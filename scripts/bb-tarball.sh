@@ -0,0 +1,138 @@
+#!/bin/bash
+
+# Create and extract Lustre source tarballs using every CPU.
+#
+#   bb-tarball.sh create -f <format>
+#       Run 'make distdir' in the current, configured tree and pack the
+#       result.  <format> is 'gz' for a .tar.gz compressed with pigz (gzip
+#       when pigz is missing) or 'zst' for a .tar.zst compressed with zstd.
+#
+#   bb-tarball.sh extract -t <tarball>
+#       Extract <tarball> into the current directory, stripping its top
+#       level directory.  The compression is taken from the file name.  Only
+#       a summary is printed, not every file.
+#
+# Statistics are printed as 'bb-stat: name=value' lines which are collected
+# by the build step.
+
+# Check for a local cached configuration.
+if test -f /etc/buildslave; then
+    . /etc/buildslave
+fi
+
+ACTION=$1
+shift
+
+FORMAT=gz
+TARBALL=
+
+while getopts f:t: FLAG; do
+    case "$FLAG" in
+      f)
+        FORMAT="$OPTARG"
+        ;;
+      t)
+        TARBALL="$OPTARG"
+        ;;
+    esac
+done
+shift $((OPTIND-1))
+
+# print the command compressing (or with -dc decompressing) a format
+compressor () {
+    case "$1" in
+    gz)
+        if hash pigz 2>/dev/null; then
+            echo "pigz -p $(nproc)"
+        else
+            echo "gzip"
+        fi
+        ;;
+    zst)
+        if hash zstd 2>/dev/null; then
+            echo "zstd -q -T$(nproc)"
+        fi
+        ;;
+    esac
+}
+
+START=$(date +%s)
+
+case "$ACTION" in
+create)
+    COMPRESS=$(compressor $FORMAT)
+    if [ -z "$COMPRESS" ]; then
+        echo "No compressor for tarball format '$FORMAT'"
+        exit 1
+    fi
+
+    set -x
+    make -s distdir || exit 1
+    set +x
+
+    DISTDIR=$(ls -d lustre-[0-9]*/ | head -1)
+    DISTDIR=${DISTDIR%/}
+    if [ -z "$DISTDIR" ]; then
+        echo "make distdir did not create a lustre-<version> directory"
+        exit 1
+    fi
+
+    OUTPUT="$DISTDIR.tar.$FORMAT"
+    rm -f lustre-[0-9]*.tar.*
+
+    # like 'make dist' follow symlinks and do not record the build user,
+    # sort the entries where tar supports it so the output is repeatable
+    SORT=
+    if tar --sort=name --version >/dev/null 2>&1; then
+        SORT=--sort=name
+    fi
+
+    tar -ch --owner=0 --group=0 $SORT -f - "$DISTDIR" | $COMPRESS > "$OUTPUT"
+    RC=("${PIPESTATUS[@]}")
+    rm -rf "$DISTDIR"
+    if [ ${RC[0]} -ne 0 ] || [ ${RC[1]} -ne 0 ] || [ ! -s "$OUTPUT" ]; then
+        exit 1
+    fi
+
+    echo "bb-stat: dist_seconds=$(($(date +%s) - START))"
+    echo "bb-stat: tarball_bytes=$(stat -c %s "$OUTPUT")"
+    ;;
+
+extract)
+    case "$TARBALL" in
+    *.tar.gz|*.tgz)
+        DECOMPRESS="$(compressor gz) -dc"
+        ;;
+    *.tar.zst)
+        DECOMPRESS="$(compressor zst) -dc"
+        ;;
+    esac
+
+    if [ ! -f "$TARBALL" ] || [ "$DECOMPRESS" = " -dc" ]; then
+        echo "Cannot extract '$TARBALL'"
+        exit 1
+    fi
+
+    # list to a file rather than the log, then summarize
+    LISTING=$(mktemp)
+    $DECOMPRESS "$TARBALL" | tar -xvf - --strip-components=1 > "$LISTING"
+    RC=$((${PIPESTATUS[0]} | ${PIPESTATUS[1]}))
+    FILES=$(grep -cv '/$' "$LISTING")
+    rm -f "$LISTING"
+    if [ $RC -ne 0 ]; then
+        exit 1
+    fi
+
+    echo "Extracted $FILES files from $TARBALL"
+    echo "bb-stat: extract_seconds=$(($(date +%s) - START))"
+    echo "bb-stat: extract_files=$FILES"
+    echo "bb-stat: extract_bytes=$(du -sb --exclude="$TARBALL" . | cut -f1)"
+    ;;
+
+*)
+    echo "Unknown action '$ACTION'"
+    exit 1
+    ;;
+esac
+
+exit 0
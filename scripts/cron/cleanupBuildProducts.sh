@@ -1,23 +1,69 @@
 #!/bin/bash
 
-# This script can be used by a cron job to clean up
-# patch set build products that are older than 14 days old
-# and it will also remove change folders that are empty
+# This script can be used by a cron job to clean up patch set build
+# products.  It applies the retention policies of lustreretention.py
+# to the index the master keeps of its published change directories,
+# so the downloads tree itself is never walked.  Tags are always kept.
+#
+#   cleanupBuildProducts.sh [-n] [-a days] [-k count] [-q GiB]
+#                           [-i index] [-s artifact store] <downloads dir>
+#
+#   -n  only report what would be removed
+#   -a  remove patch sets not accessed for this many days (default 14)
+#   -k  keep only the newest count patch sets of each change
+#   -q  remove the least recently accessed patch sets beyond GiB
+#   -i  the retention index (default <downloads dir>/../../retention.sqlite)
+#   -s  the master's artifact store, stored files no longer published
+#       anywhere are removed from it afterwards
+
+COMMAND=apply
+OPTIONS="--max-age 14"
+INDEX=
+ARTIFACTSTORE=
+
+while getopts na:k:q:i:s: FLAG; do
+    case "$FLAG" in
+      n)
+        COMMAND=report
+        ;;
+      a)
+        OPTIONS="$OPTIONS --max-age $OPTARG"
+        ;;
+      k)
+        OPTIONS="$OPTIONS --keep $OPTARG"
+        ;;
+      q)
+        OPTIONS="$OPTIONS --quota $OPTARG"
+        ;;
+      i)
+        INDEX="$OPTARG"
+        ;;
+      s)
+        ARTIFACTSTORE="$OPTARG"
+        ;;
+    esac
+done
+shift $((OPTIND-1))
 
 BUILDPRODDIR=$1
+RETENTION="python $(dirname $0)/../../master/lustreretention.py"
 
-if [ ! -d $BUILDPRODDIR ]; then
-    exit 0 
+if [ ! -d "$BUILDPRODDIR" ]; then
+    exit 0
 fi
 
-pushd $BUILDPRODDIR
+if [ -z "$INDEX" ]; then
+    INDEX="$BUILDPRODDIR/../../retention.sqlite"
+fi
 
-# clean up the patchset folders that were created more than 14 days ago
-find -depth -regex "\./[0-9]+/[0-9]+" -type d -ctime +14 -print0 | xargs --null rm -rvf
+# records the change directories published before the index existed, once
+$RETENTION scan "$INDEX" "$BUILDPRODDIR" || exit 1
 
-# remove empty change folders
-rmdir $BUILDPRODDIR/* 2>/dev/null
+$RETENTION $COMMAND $OPTIONS "$INDEX" "$BUILDPRODDIR" || exit 1
 
-popd
+# drop stored files whose last published link was removed above
+if [ "$COMMAND" = apply -a -n "$ARTIFACTSTORE" -a -d "$ARTIFACTSTORE" ]; then
+    python $(dirname $0)/../../master/lustreartifactstore.py gc $ARTIFACTSTORE
+fi
 
 exit 0
@@ -0,0 +1,29 @@
+#!/bin/bash
+
+# This script can be used by a cron job to keep a bare mirror of
+# the lustre repository up to date on the build master. Build slaves
+# use it as a reference repository so a fresh slave only needs to
+# transfer the objects of the patch set being built.
+
+REPOURL=$1
+MIRRORDIR=$2
+
+if [ -z "$REPOURL" ] || [ -z "$MIRRORDIR" ]; then
+    echo "usage: $0 <repository url> <mirror directory>"
+    exit 1
+fi
+
+if [ ! -d $MIRRORDIR ]; then
+    git clone --mirror $REPOURL $MIRRORDIR || exit 1
+fi
+
+pushd $MIRRORDIR
+
+git remote update --prune
+
+# allow the mirror to be cloned over plain http from public_html
+git update-server-info
+
+popd
+
+exit 0
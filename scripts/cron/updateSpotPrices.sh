@@ -0,0 +1,51 @@
+#!/bin/bash
+
+# This script can be used by a cron job to refresh the spot prices the
+# build slaves pick their instance type and bid from (see FilePriceFeed
+# in lustreinstances.py).  It writes the spot price history of the last
+# hours for the given instance types, as returned by the aws command
+# line tool, to <price file>.
+#
+#   updateSpotPrices.sh [-r region] [-z zone] [-H hours] <price file>
+#                       <instance type>...
+
+REGION=us-west-1
+ZONE=
+HOURS=6
+
+while getopts r:z:H: FLAG; do
+    case "$FLAG" in
+      r)
+        REGION="$OPTARG"
+        ;;
+      z)
+        ZONE="$OPTARG"
+        ;;
+      H)
+        HOURS="$OPTARG"
+        ;;
+    esac
+done
+shift $((OPTIND-1))
+
+PRICEFILE=$1
+shift
+
+if [ -z "$PRICEFILE" ] || [ $# -eq 0 ]; then
+    echo "usage: $0 [-r region] [-z zone] [-H hours] <price file> <instance type>..."
+    exit 1
+fi
+
+OPTIONS=
+if [ -n "$ZONE" ]; then
+    OPTIONS="--availability-zone $ZONE"
+fi
+
+# only replace the prices once the new ones are complete
+aws ec2 describe-spot-price-history --region "$REGION" $OPTIONS \
+    --start-time "$(date -u -d "$HOURS hours ago" +%Y-%m-%dT%H:%M:%SZ)" \
+    --product-descriptions "Linux/UNIX (Amazon VPC)" \
+    --instance-types "$@" --output json > "$PRICEFILE.tmp" || exit 1
+mv "$PRICEFILE.tmp" "$PRICEFILE"
+
+exit 0